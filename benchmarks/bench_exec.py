@@ -0,0 +1,62 @@
+import argparse
+import io
+import os
+import subprocess
+import sys
+import time
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from unittestbash import BashFunctionAnalyzer
+from unittestbash.bash_worker import escape_double_quoted
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.sh')
+
+
+def mock_set(size):
+    # mock_commands the way the tests write them, mostly echo stand-ins
+    return {f'tool_{i}': ['echo', f'tool {i} "output" with $dollars'] for i in range(size)}
+
+
+def shell_string(run):
+    # What run_function handed to /bin/sh before: the whole script escaped into one "bash -c" string
+    script = run.argv[2]
+    if run.stdin is not None:
+        script = script.replace(' "$@"; ', f' "$@" <<EOF\n{run.stdin}EOF\n', 1)
+    return f'bash -c "{escape_double_quoted(script)}" bash ' + ' '.join(f"'{arg}'" for arg in run.args)
+
+
+def bench(calls, execute):
+    start = time.perf_counter()
+    for _ in range(calls):
+        execute()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bash -c through /bin/sh against a direct argv exec")
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--mocks', type=int, nargs='+', default=[0, 50, 500])
+    args = parser.parse_args()
+
+    with redirect_stdout(io.StringIO()):
+        analyzer = BashFunctionAnalyzer(MAIN_SCRIPT)
+    for size in args.mocks:
+        with redirect_stdout(io.StringIO()):
+            run = analyzer._prepare_run('prompt_backup_confirmation', mock_commands=mock_set(size),
+                                        mock_read_values=['yes'], args=['a b'])
+        command = shell_string(run)
+        through_sh = bench(args.calls, lambda: subprocess.run(command, shell=True, text=True, capture_output=True))
+        direct = bench(args.calls, lambda: subprocess.run(run.argv, text=True, capture_output=True, input=run.stdin))
+        print(f"{size:>4} mocks, {args.calls} calls: /bin/sh {through_sh:7.3f}s  argv {direct:7.3f}s  "
+              f"({through_sh / direct:.2f}x)")
+        with redirect_stdout(io.StringIO()):
+            full = bench(args.calls, lambda: analyzer.run_function('prompt_backup_confirmation',
+                                                                   mock_commands=mock_set(size),
+                                                                   mock_read_values=['yes']))
+        print(f"{size:>4} mocks, {args.calls} calls: run_function {full:7.3f}s  {args.calls / full:8.1f} calls/s")
+
+
+if __name__ == '__main__':
+    main()
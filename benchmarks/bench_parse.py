@@ -0,0 +1,68 @@
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from unittestbash import BashFunctionAnalyzer
+from unittestbash import bash_parser
+from unittestbash.unittestbash import _PARSE_CACHE
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.sh')
+
+
+def synthetic_script(lines):
+    # The functions of main.sh over and over, renamed so every copy is a function of its own
+    with open(MAIN_SCRIPT) as main_file:
+        body = main_file.read().split('\n', 1)[1]
+    copies = []
+    copy = 0
+    while sum(part.count('\n') for part in copies) < lines:
+        copies.append(body.replace('() {', f'_{copy}() {{'))
+        copy += 1
+    return '#!/bin/bash\n' + ''.join(copies)
+
+
+def best_of(repeat, function, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def analyze(path):
+    _PARSE_CACHE.clear()
+    with redirect_stdout(io.StringIO()):
+        BashFunctionAnalyzer(path).functions_info  # The script is parsed on first use
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Script parsing throughput of BashFunctionAnalyzer")
+    parser.add_argument('--lines', type=int, nargs='+', default=[1_000, 10_000, 50_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for lines in args.lines:
+        text = synthetic_script(lines)
+        with tempfile.NamedTemporaryFile('w', suffix='.sh', delete=False) as script:
+            script.write(text)
+        try:
+            total = text.count('\n')
+            tokenizing = best_of(args.repeat, bash_parser.tokenize, text)
+            parsing = best_of(args.repeat, bash_parser.parse, text)
+            analyzing = best_of(args.repeat, analyze, script.name)
+            print(f"{total:>7} lines: tokenize {tokenizing:7.3f}s  parse {parsing:7.3f}s  "
+                  f"analyzer {analyzing:7.3f}s  {total / analyzing:10,.0f} lines/s")
+        finally:
+            os.unlink(script.name)
+
+
+if __name__ == '__main__':
+    main()
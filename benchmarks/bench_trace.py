@@ -0,0 +1,105 @@
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from unittestbash import BashFunctionAnalyzer, BashRunResult, LineSet
+from unittestbash.unittestbash import _CommandIndex
+
+# A retry loop in the spirit of stop_service in main.sh, so the trace mixes plain commands, control
+# structures, conditions, command substitutions and variable assignments
+SCRIPT = """#!/bin/bash
+retry_service() {
+    service_name=$1
+    retry_count=100000
+    while true; do
+        ((retry_count-=1))
+        if [ $retry_count -le 0 ]; then
+          break
+        fi
+        sudo monit stop "$service_name" > /dev/null 2>&1
+        status=$(sudo monit status "$service_name" | grep "Not monitored")
+        if [[ "$status" == "Not monitored" ]]; then
+            result=0
+        fi
+    done
+}
+"""
+
+LOOP = [
+    "+ line 5: true",
+    "+ line 6: (( retry_count-=1 ))",
+    "+ line 7: '[' {count} -le 0 ']'",
+    "+ line 10: sudo monit stop mysql",
+    "++ line 11: sudo monit status mysql",
+    "++ line 11: grep 'Not monitored'",
+    "+ line 11: status=",
+    "+ line 12: [[ '' == \\N\\o\\t\\ \\m\\o\\n\\i\\t\\o\\r\\e\\d ]]",
+]
+
+
+def synthetic_trace(lines):
+    trace = ["+ line 1: retry_service mysql", "+ line 3: service_name=mysql", "+ line 4: retry_count=100000"]
+    count = 100000
+    while len(trace) < lines:
+        count -= 1
+        trace.extend(line.format(count=count) for line in LOOP)
+    return trace[:lines]
+
+
+def bench_process_output_lines(analyzer, lines, repeat, indexed=False):
+    # indexed=True also builds the command index, as run_function does (and run_benchmarks.py measures)
+    best = None
+    for _ in range(repeat):
+        trace = synthetic_trace(lines)
+        start = time.perf_counter()
+        analyzer._process_output_lines(trace, LineSet(), 'retry_service',
+                                       command_index=_CommandIndex() if indexed else None)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_assertions(analyzer, lines, assertions):
+    # The index is built while the trace is parsed, the assertions only look it up
+    trace = synthetic_trace(lines)
+    start = time.perf_counter()
+    command_index = _CommandIndex()
+    analyzer._process_output_lines(trace, LineSet(), 'retry_service', command_index=command_index)
+    analyzer.last_result = BashRunResult('retry_service', '', trace, 0, LineSet(), command_index)
+    parsed = time.perf_counter()
+    for i in range(assertions):
+        analyzer.get_calls(f"sudo monit {'stop' if i % 2 else 'status'}")
+        analyzer.assert_run("(( retry_count-=1 ))")
+    return parsed - start, time.perf_counter() - parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Trace parsing throughput of BashFunctionAnalyzer")
+    parser.add_argument('--lines', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile('w', suffix='.sh', delete=False) as script:
+        script.write(SCRIPT)
+    try:
+        with redirect_stdout(io.StringIO()):
+            analyzer = BashFunctionAnalyzer(script.name)
+        for lines in args.lines:
+            elapsed = bench_process_output_lines(analyzer, lines, args.repeat)
+            print(f"_process_output_lines {lines:>9} lines: {elapsed:8.3f}s  {lines / elapsed:12,.0f} lines/s")
+            elapsed = bench_process_output_lines(analyzer, lines, args.repeat, indexed=True)
+            print(f"  with the index      {lines:>9} lines: {elapsed:8.3f}s  {lines / elapsed:12,.0f} lines/s")
+            parsing, asserting = bench_assertions(analyzer, lines, 20)
+            print(f"20 assertions         {lines:>9} lines: {asserting:8.3f}s  (indexed while parsing in {parsing:.3f}s)")
+    finally:
+        os.unlink(script.name)
+
+
+if __name__ == '__main__':
+    main()
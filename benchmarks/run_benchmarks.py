@@ -0,0 +1,233 @@
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from unittestbash import BashFunctionAnalyzer, BashRunResult, LineSet, bash_parser
+from unittestbash.unittestbash import _PARSE_CACHE, _CommandIndex
+
+from bench_parse import MAIN_SCRIPT, synthetic_script
+from bench_trace import SCRIPT as TRACE_SCRIPT, synthetic_trace
+
+# The whole suite in one run, every result in seconds (lower is better) under a stable name, written as JSON.
+# With --baseline the results are compared to an earlier run and the exit status is 1 when one of them got
+# slower by more than --threshold, for CI:
+#   python benchmarks/run_benchmarks.py --quick -o baseline.json            (on the reference commit)
+#   python benchmarks/run_benchmarks.py --quick --baseline baseline.json    (on the change)
+
+# parser_lines is the same in both: tokenize and parse of a large script, without the coverage benchmarks that
+# the script_lines sizes get
+SIZES = {'quick': {'script_lines': [1_000, 10_000], 'trace_lines': [10_000, 100_000], 'parser_lines': 50_000},
+         'full': {'script_lines': [1_000, 10_000, 50_000], 'trace_lines': [10_000, 100_000, 1_000_000],
+                  'parser_lines': 50_000}}
+
+
+def best_of(repeat, function):
+    # Best time of repeat calls, the least disturbed by the rest of the machine
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def quiet(function, *args, **kwargs):
+    with redirect_stdout(io.StringIO()):
+        return function(*args, **kwargs)
+
+
+def bench_parse(results, script_lines, repeat):
+    # _extract_functions_info and the rest of the parse, the parse cache cleared before every run
+    for lines in script_lines:
+        with tempfile.NamedTemporaryFile('w', suffix='.sh', delete=False) as script:
+            script.write(synthetic_script(lines))
+        try:
+            def parse():
+                _PARSE_CACHE.clear()
+                analyzer = quiet(BashFunctionAnalyzer, script.name)
+                analyzer.functions_info  # The script is parsed on first use
+                return analyzer
+            results[f'parse/lines={lines}'] = best_of(repeat, parse)
+            analyzer = parse()
+            bench_coverage(results, analyzer, lines, repeat)
+        finally:
+            os.unlink(script.name)
+            _PARSE_CACHE.clear()
+
+
+def bench_parser(results, lines, repeat):
+    # bash_parser alone, the tokenizer then the whole parse
+    text = synthetic_script(lines)
+    results[f'tokenize/lines={lines}'] = best_of(repeat, lambda: bash_parser.tokenize(text))
+    results[f'bash_parser/lines={lines}'] = best_of(repeat, lambda: bash_parser.parse(text))
+
+
+def bench_startup(results, repeat):
+    # What a test module pays before its first run: importing unittestbash (in a fresh interpreter, the time
+    # the import itself takes) and building an analyzer
+    code = 'import time; start = time.perf_counter(); import unittestbash; print(time.perf_counter() - start)'
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results['startup/import'] = min(float(subprocess.run([sys.executable, '-c', code], cwd=root, text=True,
+                                                         capture_output=True, check=True).stdout)
+                                    for _ in range(repeat))
+
+    def construct():
+        _PARSE_CACHE.clear()
+        for _ in range(100):
+            quiet(BashFunctionAnalyzer, MAIN_SCRIPT)
+    results['startup/construct_x100'] = best_of(repeat, construct)
+
+
+def bench_coverage(results, analyzer, lines, repeat):
+    # get_coverage of every function and of the script, every code line executed by one run or another. Both are
+    # repeated 100 times, once is too short to measure
+    runs = [LineSet((function_name, line_number) for line_number in analyzer.code_lines.lines(function_name))
+            for function_name in analyzer.code_lines.functions()]
+    for run in runs:
+        analyzer.executed_lines |= run
+    functions = list(analyzer.functions_info)
+
+    def coverage():
+        for _ in range(100):
+            for function_name in functions:
+                analyzer.get_coverage(function_name)
+            analyzer.get_coverage()
+    results[f'get_coverage/functions={len(functions)}'] = best_of(repeat, coverage)
+
+    def merge():
+        for _ in range(100):
+            merged = LineSet()
+            for run in runs:
+                merged |= run
+    results[f'merge_runs/functions={len(functions)}'] = best_of(repeat, merge)
+
+
+def bench_run_function(results, runs, script_lines):
+    # End to end latency (median) of a run: bash start, source, call, trace parsing
+    analyzer = quiet(BashFunctionAnalyzer, MAIN_SCRIPT)
+    for function_name, kwargs in (('say_hello', {}),
+                                  ('prompt_backup_confirmation', {'mock_read_values': ['yes'],
+                                                                  'mock_commands': {'exit': ['return', 0]}})):
+        latencies = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            quiet(analyzer.run_function, function_name, **kwargs)
+            latencies.append(time.perf_counter() - start)
+        results[f'run_function/{function_name}'] = statistics.median(latencies)
+
+    # The source time grows with the script, the persistent workers don't pay it per call
+    with tempfile.NamedTemporaryFile('w', suffix='.sh', delete=False) as script:
+        script.write(synthetic_script(script_lines))
+    try:
+        for persistent in (False, True):
+            analyzer = quiet(BashFunctionAnalyzer, script.name, persistent=persistent)
+            try:
+                quiet(analyzer.run_function, 'say_hello_0')
+                latencies = []
+                for _ in range(runs):
+                    start = time.perf_counter()
+                    quiet(analyzer.run_function, 'say_hello_0')
+                    latencies.append(time.perf_counter() - start)
+            finally:
+                analyzer.close()
+            mode = 'persistent' if persistent else 'one_shot'
+            results[f'run_function/{mode}/script_lines={script_lines}'] = statistics.median(latencies)
+    finally:
+        os.unlink(script.name)
+        _PARSE_CACHE.clear()
+
+
+def bench_trace(results, trace_lines, repeat):
+    # _process_output_lines on synthetic traces, then the assertion helpers on the indexed trace
+    with tempfile.NamedTemporaryFile('w', suffix='.sh', delete=False) as script:
+        script.write(TRACE_SCRIPT)
+    try:
+        analyzer = quiet(BashFunctionAnalyzer, script.name)
+        for lines in trace_lines:
+            trace = synthetic_trace(lines)
+
+            def process():
+                command_index = _CommandIndex()
+                analyzer._process_output_lines(list(trace), LineSet(), 'retry_service', command_index=command_index)
+                return command_index
+            results[f'process_output_lines/lines={lines}'] = best_of(repeat, process)
+
+            analyzer.last_result = BashRunResult('retry_service', '', trace, 0, LineSet(), process())
+
+            def assertions():
+                for i in range(20):
+                    analyzer.get_calls(f"sudo monit {'stop' if i % 2 else 'status'}")
+                    analyzer.assert_run("(( retry_count-=1 ))")
+                analyzer.assert_called_before('sudo monit stop', 'sudo monit status')
+                analyzer.assert_called_with('sudo', 'monit', 'stop', 'mysql')
+            results[f'assertions/lines={lines}'] = best_of(repeat, assertions)
+    finally:
+        os.unlink(script.name)
+
+
+def compare(results, baseline, threshold, min_delta):
+    # Names whose time grew by more than threshold (0.25 = 25%) and by more than min_delta seconds over the
+    # baseline, timings of a few milliseconds are too noisy for a ratio alone
+    regressions = []
+    for name, seconds in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            print(f"{name:<50} {seconds:10.4f}s  (new)")
+            continue
+        ratio = seconds / before if before else 1.0
+        regressed = ratio > 1 + threshold and seconds - before > min_delta
+        print(f"{name:<50} {seconds:10.4f}s  {before:10.4f}s  {ratio:6.2f}x{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="BashFunctionAnalyzer benchmark suite")
+    parser.add_argument('--quick', action='store_true', help="smaller scripts and traces, for CI")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--runs', type=int, default=20, help="run_function calls per latency")
+    parser.add_argument('-o', '--output', help="write the results as JSON")
+    parser.add_argument('--baseline', help="JSON of an earlier run to compare with")
+    parser.add_argument('--threshold', type=float, default=0.25, help="allowed slowdown, 0.25 = 25%%")
+    parser.add_argument('--min-delta', type=float, default=0.002, help="slowdowns below this many seconds are noise")
+    args = parser.parse_args(argv)
+
+    sizes = SIZES['quick' if args.quick else 'full']
+    results = {}
+    bench_startup(results, args.repeat)
+    bench_parser(results, sizes['parser_lines'], args.repeat)
+    bench_parse(results, sizes['script_lines'], args.repeat)
+    bench_run_function(results, args.runs, sizes['script_lines'][-1])
+    bench_trace(results, sizes['trace_lines'], args.repeat)
+
+    report = {'python': platform.python_version(), 'platform': platform.platform(),
+              'quick': args.quick, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=1, sort_keys=True)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+    regressions = compare(results, baseline, args.threshold, args.min_delta)
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) slower than the baseline by more than {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
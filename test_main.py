@@ -1,5 +1,18 @@
+import asyncio
+import gc
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
 import unittest
-from unittestbash import BashFunctionAnalyzer, patch_bash
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+from unittestbash import coverage_export
+from unittestbash.unittestbash import _PARSE_CACHE, _load_parse_cache, _parse_cache_path, _save_parse_cache
+from unittestbash import BashFunctionAnalyzer, BashMocks, BashProjectAnalyzer, BashSandbox, BashTestIndex, explore_inputs, patch_bash
 
 class TestMain(unittest.TestCase):
     @classmethod
@@ -346,10 +359,106 @@ class TestMain(unittest.TestCase):
         self.analyzer.assert_run_once("exit 1")
         self.analyzer.assertStatusOK()
 
+    @patch_bash('mock_commands', {
+        'sudo': ['echo', 'sudo'],
+        'sleep': ['echo', 'sleep'],
+        'grep': ['echo', '\'\''],
+        'exit': ['return', 0]
+    })
+    def test_stop_service_call_order(self,
+                                     mock_commands,
+                                     function_name='stop_service'):
+        print(f"Test function: {function_name} call order")
+
+        self.analyzer.run_function(function_name,
+                                   function_args=['\\"my service\\"'],
+                                   mock_commands=mock_commands)
+        self.analyzer.assert_called_with('sudo', 'monit', 'status', 'my service')
+        self.analyzer.assert_called_with('sudo', 'monit', 'stop', 'my service')
+        with self.assertRaises(AssertionError):
+            self.analyzer.assert_called_with('sudo', 'monit', 'stop', 'my')
+        # each distinct sudo command was split once, and a repeated check is a lookup
+        command_index = self.analyzer.last_result.command_index
+        self.assertEqual(set(command_index._words), {command for _, command in command_index.calls('sudo ')})
+        self.assertIs(command_index.calls_with('sudo', ('monit', 'stop', 'my service')),
+                      command_index.calls_with('sudo', ('monit', 'stop', 'my service')))
+        self.analyzer.assert_called_before('sudo monit status', 'sudo monit stop')
+        self.analyzer.assert_called_before('sudo monit stop', 'sleep 5')
+        self.analyzer.assertEqual([line for line, _ in self.analyzer.get_calls('sleep 5')], [76] * 9)
+        self.tested_functions.add(function_name)
+        self.analyzer.assertStatusOK()
+
+    @patch_bash('mock_variables', {
+        'sudo_counter': 1
+    })
+    @patch_bash('mock_commands', {
+        'sudo': ['sudo_counter=\\$((sudo_counter + 1));', ''],
+        'sleep': ['echo', 'sleep'],
+        'grep': ['echo', '\'\''],
+        'exit': ['return', 0]
+    })
+    def test_stop_service_streamed_trace(self,
+                                         mock_commands,
+                                         mock_variables,
+                                         function_name='stop_service'):
+        print(f"Test function: {function_name} with streamed trace")
+
+        analyzer = BashFunctionAnalyzer(self.script_path, trace_tail=5)
+        analyzer.run_function(function_name,
+                              function_args=['mysql'],
+                              mock_variables=mock_variables,
+                              mock_commands=mock_commands,
+                              show_variables=['retry_count'],
+                              stream=True)
+        # only the trace tail and the variables are kept, the call counts cover the whole run
+        self.assertLess(len(analyzer.get_function_output(function_name)), 20)
+        analyzer.assert_call_number("(( retry_count-=1 ))", 10)
+        analyzer.assert_run_once("exit 1")
+        analyzer.assertEqual(analyzer.get_variable_value('retry_count'), "0")
+        analyzer.assertStatusOK()
+
+        buffered = BashFunctionAnalyzer(self.script_path)
+        buffered.run_function(function_name,
+                              function_args=['mysql'],
+                              mock_variables=mock_variables,
+                              mock_commands=mock_commands,
+                              show_variables=['retry_count'])
+        analyzer.assertEqual(analyzer.executed_lines, buffered.executed_lines)
+
+    def test_streamed_trace_memory(self):
+        print("Test streamed runs keep a bounded amount of memory")
+
+        directory = tempfile.mkdtemp()
+        try:
+            script_path = os.path.join(directory, 'loop.sh')
+            with open(script_path, 'w') as script_file:
+                script_file.write('#!/bin/bash\ncount_up() {\n    local i\n    for ((i = 0; i < 20000; i++)); do\n'
+                                  '        echo tick "$i" > /dev/null\n    done\n    echo done\n}\n')
+            analyzer = BashFunctionAnalyzer(script_path, trace_tail=10)
+            analyzer.functions_info
+            tracemalloc.start()
+            try:
+                result = analyzer.run_function('count_up', stream=True)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            # 20000 distinct commands indexed in memory would take several megabytes
+            self.assertLess(peak, 1024 * 1024)
+            self.assertLess(len(result.trace), 20)
+            analyzer.assert_call_number('echo tick', 20000, result=result)
+            analyzer.assert_run_once('echo done', result=result)
+            analyzer.assert_called_before('echo tick', 'echo done', result=result)
+            analyzer.assert_called_with('echo', 'tick', '19999', result=result)
+            self.assertEqual(analyzer.get_calls('echo tick 1999', result=result)[:2],
+                             [(5, 'echo tick 1999'), (5, 'echo tick 19990')])
+            self.assertEqual(analyzer.get_coverage('count_up'), 100)
+        finally:
+            shutil.rmtree(directory)
+
     @patch_bash('function_args',side_effect=[
                                         ["\'test message\'",'info'],
                                         ["\'test message\'",'warning'],
-                                        ["\'test message\'",'error']])
+                                        ["\'test message\'",'error']], batch=True)
     @patch_bash('mock_variables',{'LOG_FILE': '.\\test_log.log'})
     def test_log_message(self,
                               mock_variables,
@@ -369,6 +478,627 @@ class TestMain(unittest.TestCase):
         #self.analyzer.show_executed_lines(function_name)
         self.analyzer.assertStatusOK()
 
+    @patch_bash('mock_commands', {
+        'sudo': ['echo', 'sudo'],
+        'exit': ['return', 0]
+    })
+    def test_stop_service_virtual_time(self,
+                                       mock_commands,
+                                       function_name='stop_service'):
+        print(f"Test function: {function_name} with a virtual clock")
+
+        analyzer = BashFunctionAnalyzer(self.script_path)
+        result = analyzer.run_function(function_name,
+                                       function_args=['mysql'],
+                                       mock_commands=mock_commands,
+                                       virtual_time=1700000000)
+        # sleep is not mocked: 9 retries of 5 seconds, without waiting for them
+        analyzer.assert_call_number('sleep 5', 9)
+        self.assertEqual(result.virtual_time, 45.0)
+
+        result = analyzer.run_function('get_local_time', virtual_time=1700000000)
+        analyzer.assertOutputMatchesRegex(r'^Current time: 2023-11-1[45] \d{2}:\d{2}:20$', result=result)
+
+    def test_stop_service_mock_registry(self, function_name='stop_service'):
+        print(f"Test function: {function_name} with declared mocks")
+
+        mocks = (BashMocks()
+                 .mock('sudo')
+                 .mock('grep', side_effect=['', '', 'Not monitored'])  # stopped on the second retry
+                 .mock('sleep')
+                 .mock('exit', script='return "$1"'))
+        analyzer = BashFunctionAnalyzer(self.script_path)
+        analyzer.run_function(function_name, function_args=['mysql'], mocks=mocks, show_variables=['retry_count'])
+        analyzer.assertStatusOK()
+        analyzer.assertEqual(analyzer.get_variable_value('retry_count'), '8')
+        analyzer.assert_mock_call_number('sleep', 2)
+        analyzer.assert_mock_called_with('sudo', 'monit', 'stop', 'mysql')
+        analyzer.assertEqual(analyzer.get_mock_calls('exit'), [['0']])
+        # the mocks themselves stay out of the trace
+        analyzer.assert_call_number('printf', 0)
+        self.assertEqual(mocks.path(), BashMocks().mock('sudo').mock('grep', side_effect=['', '', 'Not monitored'])
+                         .mock('sleep').mock('exit', script='return "$1"').path())
+
+        # calls from background jobs and pipelines all count
+        directory = tempfile.mkdtemp()
+        try:
+            script_path = os.path.join(directory, 'jobs.sh')
+            with open(script_path, 'w') as script_file:
+                script_file.write('#!/bin/bash\nprobe_all() {\n    for i in {1..50}; do probe & done\n    wait\n'
+                                  '    probe | cat > /dev/null\n    probe\n}\n')
+            counted = BashMocks().mock('probe', script='echo "call $__ubash_call"')
+            result = BashFunctionAnalyzer(script_path).run_function('probe_all', mocks=counted)
+            calls = result.stdout.splitlines()
+            # every call got a number of its own, the background ones included
+            self.assertEqual(sorted(calls[:-1]), sorted(f'call {call}' for call in range(50)))
+            self.assertEqual(calls[-1], 'call 51')
+            self.assertEqual(len(result.mock_calls), 52)
+        finally:
+            shutil.rmtree(directory)
+        # compiled in a directory only this user can write to
+        directory_stat = os.stat(os.path.dirname(mocks.path()))
+        self.assertEqual((directory_stat.st_uid, directory_stat.st_mode & 0o777), (os.getuid(), 0o700))
+
+    def test_fixture_setup(self, function_name='log_message'):
+        print(f"Test function: {function_name} from a set up fixture")
+
+        directory = tempfile.mkdtemp()
+        try:
+            setup = f'echo once >> {directory}/setup.log; LOG_FILE={directory}/messages.log'
+            fixture = BashFunctionAnalyzer(self.script_path, persistent=True, setup=setup)
+            one_shot = BashFunctionAnalyzer(self.script_path, setup=setup)
+            for message_type in ('info', 'error'):
+                result = fixture.run_function(function_name, function_args=['message', message_type])
+                fixture.assertStatusOK(result=result)
+                fixture.assertEqual(result.executed_lines,
+                                    one_shot.run_function(function_name, function_args=['message', message_type])
+                                    .executed_lines)
+            fixture.close()
+            with open(os.path.join(directory, 'setup.log')) as setup_log:
+                # once for the fixture, once per one-shot run
+                self.assertEqual(setup_log.read().count('once'), 3)
+            with open(os.path.join(directory, 'messages.log')) as messages_log:
+                self.assertEqual(len(messages_log.readlines()), 4)
+        finally:
+            shutil.rmtree(directory)
+
+    @patch_bash('mock_commands', {
+        'sudo': ['echo', 'sudo'],
+        'sleep': ['echo', 'sleep'],
+        'exit': ['return', 0]
+    })
+    def test_stop_service_profile(self,
+                                  mock_commands,
+                                  function_name='stop_service'):
+        print(f"Test function: {function_name} profiled")
+
+        analyzer = BashFunctionAnalyzer(self.script_path)
+        result = analyzer.run_function(function_name, function_args=['mysql'], mock_commands=mock_commands,
+                                       profile=True)
+        # the profile fields never reach the assertions
+        analyzer.assert_call_number('sleep 5', 9)
+        analyzer.assertEqual(result.executed_lines,
+                             BashFunctionAnalyzer(self.script_path).run_function(
+                                 function_name, function_args=['mysql'], mock_commands=mock_commands).executed_lines)
+
+        # line 76 is the "sleep 5" of every retry
+        self.assertEqual(result.profile.lines[(self.script_path, 76)][0], 9)
+        self.assertIn('stop_service;sleep', [line.rsplit(' ', 1)[0] for line in result.profile.folded_stacks()])
+        self.assertEqual(analyzer.profile.functions['sleep'][0], 9)
+
+    def test_run_batch(self, function_name='prompt_backup_confirmation'):
+        print(f"Test function: {function_name} batched")
+
+        analyzer = BashFunctionAnalyzer(self.script_path)
+        results = analyzer.run_batch(function_name, [{'mock_read_values': [answer]} for answer in ('yes', 'no', 'ok')])
+        # every case gets its own result, the failing one included
+        self.assertEqual([result.status for result in results], [0, 0, 1])
+        analyzer.assertOutputMatchesRegex(r'^.+Backup operation canceled by user\..+$', result=results[1])
+        self.assertIn('Unknown choice.', results[2].output)
+
+    def test_branch_coverage(self, function_name='prompt_backup_confirmation'):
+        print(f"Test function: {function_name} branches")
+
+        analyzer = BashFunctionAnalyzer(self.script_path)
+        analyzer.run_batch(function_name, [{'mock_read_values': ['yes']}, {'mock_read_values': ['no']}])
+        self.assertAlmostEqual(analyzer.get_branch_coverage(function_name), 200 / 3)
+        analyzer.run_function(function_name, mock_read_values=['ok'])
+        self.assertEqual(analyzer.get_branch_coverage(function_name), 100.0)
+        # the case of log_message has no *), an unknown type takes the implicit arm
+        analyzer.run_function('log_message', function_args=['test message', 'debug'], mock_variables={'LOG_FILE': '/dev/null'})
+        self.assertEqual(analyzer.get_branch_coverage('log_message'), 25.0)
+        analyzer.show_branches('log_message')
+
+    def test_parse_cache(self):
+        print("Test parse cache")
+
+        directory = tempfile.mkdtemp()
+        try:
+            script_path = shutil.copy(self.script_path, directory)
+            analyzer = BashFunctionAnalyzer(script_path, persist_parse_cache=True)
+            self.assertEqual(analyzer.functions_info, self.analyzer.functions_info)
+            self.assertTrue(os.listdir(os.path.join(directory, '__pycache__')))
+
+            # unchanged script: served from the cache, changed script: parsed again
+            self.assertEqual(BashFunctionAnalyzer(script_path).code_lines, analyzer.code_lines)
+            with open(script_path, 'a') as script_file:
+                script_file.write('\nsay_bye() {\n    echo "Bye"\n}\n')
+            changed = BashFunctionAnalyzer(script_path, persist_parse_cache=True)
+            self.assertIn('say_bye', changed.functions_info)
+            self.assertEqual(changed.total_lines, analyzer.total_lines + 2)
+
+            # Threads saving the same script at once each write a file of their own before the rename
+            parsed = _load_parse_cache(os.path.abspath(script_path))
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(lambda _: _save_parse_cache(os.path.abspath(script_path), parsed), range(64)))
+            self.assertEqual(_load_parse_cache(os.path.abspath(script_path))['digest'], parsed['digest'])
+            self.assertEqual(os.listdir(os.path.join(directory, '__pycache__')),
+                             [os.path.basename(_parse_cache_path(os.path.abspath(script_path)))])
+
+            # A cache file that doesn't load is parsed again, never an error
+            for garbage in (b'\x80\x05\x95', b'cno_such_module\nThing\n.', b'Inot a number\n.', b'\x80\x04K\x01.',
+                            b'\x80\x04]\x94.'):
+                with open(_parse_cache_path(os.path.abspath(script_path)), 'wb') as cache_file:
+                    cache_file.write(garbage)
+                _PARSE_CACHE.pop(os.path.abspath(script_path), None)
+                self.assertIn('say_bye', BashFunctionAnalyzer(script_path, persist_parse_cache=True).functions_info)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_script_parser(self):
+        print("Test script parser")
+
+        directory = tempfile.mkdtemp()
+        try:
+            script_path = os.path.join(directory, 'tricky.sh')
+            with open(script_path, 'w') as script_file:
+                script_file.write('''#!/bin/bash
+tricky() {
+    local hash="#" count=0  # a comment
+    local -a items=(one
+      two)
+    echo "${#items[@]}" "$hash" > /dev/null
+    cat <<EOF > /dev/null
+not_a_function() {
+    echo "}"
+}
+EOF
+    count=$((count +
+      1))
+    echo "$count" |
+      cat > /dev/null
+    { echo "grouped"; } > /dev/null
+}
+''')
+            analyzer = BashFunctionAnalyzer(script_path)
+            self.assertEqual(list(analyzer.functions_info), ['tricky'])
+            self.assertEqual(analyzer.code_lines.lines('tricky'), [2, 3, 4, 6, 7, 13, 14, 15, 16])
+            # every code line is a line bash reports in the trace
+            result = analyzer.run_function('tricky')
+            self.assertEqual(result.executed_lines, analyzer.code_lines)
+        finally:
+            shutil.rmtree(directory)
+
+    @patch_bash('mock_commands', {
+        'exit': ['echo', 'exit']
+    })
+    def test_explore_inputs(self,
+                            mock_commands,
+                            function_name='prompt_backup_confirmation'):
+        print(f"Test function: {function_name} explored")
+
+        analyzer = BashFunctionAnalyzer(self.script_path)
+        self.assertEqual(analyzer.function_inputs['main'], (('b', 'c', 'h', 'l', 'o', 'q', 's', 't'), 0))
+        self.assertEqual(analyzer.function_inputs['log_message'], (('error', 'info', 'warning'), 2))
+        inputs = explore_inputs(analyzer, function_name, time_budget=30, mock_commands=mock_commands)
+        # the empty answer takes the else branch, no and yes the other two
+        self.assertEqual([explored['mock_read_values'] for explored in inputs], [[], ['no'], ['yes']])
+        self.assertEqual(analyzer.get_coverage(function_name), 100)
+        self.assertEqual(analyzer.get_branch_coverage(function_name), 100)
+
+    def test_argv_arguments(self):
+        print("Test arguments passed through argv")
+
+        directory = tempfile.mkdtemp()
+        try:
+            script_path = os.path.join(directory, 'args.sh')
+            with open(script_path, 'w') as script_file:
+                script_file.write('#!/bin/bash\nshow_args() {\n    printf "<%s>\\n" "$@"\n    read -r answer\n'
+                                  '    echo "answer: $answer"\n}\n')
+            args = ['two words', 'it\'s "quoted"', '$HOME', '']
+            expected = [f'<{arg}>' for arg in args] + ['answer: a $b']
+            one_shot = BashFunctionAnalyzer(script_path)
+            persistent = BashFunctionAnalyzer(script_path, persistent=True)
+            try:
+                for analyzer in (one_shot, persistent):
+                    for stream in (False, True):
+                        result = analyzer.run_function('show_args', args=args, mock_read_values=['a $b'], stream=stream)
+                        self.assertEqual(result.stdout.splitlines(), expected)
+                result = asyncio.run(one_shot.run_function_async('show_args', args=args, mock_read_values=['a $b']))
+                self.assertEqual(result.stdout.splitlines(), expected)
+            finally:
+                persistent.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_sandbox(self):
+        print("Test sandboxed runs")
+
+        directory = tempfile.mkdtemp()
+        try:
+            fixture = os.path.join(directory, 'fixture')
+            os.makedirs(os.path.join(fixture, 'data'))
+            for name in ('state.txt', 'old.txt'):
+                with open(os.path.join(fixture, 'data', name), 'w') as fixture_file:
+                    fixture_file.write('initial\n')
+            script_path = os.path.join(directory, 'deploy.sh')
+            with open(script_path, 'w') as script_file:
+                script_file.write('#!/bin/bash\ndeploy() {\n    echo "deployed" >> data/state.txt\n    rm data/old.txt\n'
+                                  '    mkdir -p "$HOME/.cache" && touch "$HOME/.cache/deploy"\n'
+                                  '    deploy_tool --now "$1"\n    $UNKNOWN_TOOL run\n    cat data/state.txt\n}\n')
+            analyzer = BashFunctionAnalyzer(script_path)
+            self.assertIn('deploy_tool', analyzer.external_commands)
+            self.assertNotIn('echo', analyzer.external_commands)
+            with BashSandbox(fixture, env={'UNKNOWN_TOOL': 'helper'}) as sandbox:
+                for _ in range(2):  # Every run starts from the fixture again
+                    result = analyzer.run_function('deploy', args=['v2'], sandbox=sandbox)
+                    self.assertEqual(result.stdout, 'initial\ndeployed\n')
+                    self.assertEqual(result.sandbox.created, ['home/.cache/', 'home/.cache/deploy'])
+                    self.assertEqual(result.sandbox.modified, ['work/data/state.txt'])
+                    self.assertEqual(result.sandbox.deleted, ['work/data/old.txt'])
+                    self.assertEqual(result.sandbox.calls, [('deploy_tool', ['--now', 'v2']), ('helper', ['run'])])
+                    self.assertIsNone(result.sandbox.directory)
+                with open(os.path.join(fixture, 'data', 'state.txt')) as fixture_file:
+                    self.assertEqual(fixture_file.read(), 'initial\n')
+
+                # sudo is shimmed, the service never reports as running
+                main_analyzer = BashFunctionAnalyzer(self.script_path)
+                result = main_analyzer.run_function('stop_service', args=['nginx'], sandbox=sandbox, virtual_time=True)
+                self.assertEqual(result.status, 1)
+                self.assertEqual(result.sandbox.calls[:2], [('sudo', ['monit', 'status', 'nginx']),
+                                                            ('sudo', ['monit', 'stop', 'nginx'])])
+
+                # the script given by a relative path is still this script when the sandbox sources its absolute path
+                traced = BashFunctionAnalyzer(self.script_path, trace_sources=True)
+                result = traced.run_function('say_hello', sandbox=sandbox)
+                traced.assertStatusOK(result=result)
+                self.assertFalse([line for line in result.output if line.startswith('+ /')])
+                self.assertEqual(traced.get_coverage('say_hello'), 100)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_debug_tracer(self):
+        print("Test the DEBUG trap tracer")
+
+        mocks = BashMocks().mock('sudo', output='monit: Not monitored')
+        xtrace = BashFunctionAnalyzer(self.script_path)
+        xtrace.run_function('stop_service', args=['nginx'], mocks=mocks, virtual_time=True)
+        for persistent in (False, True):
+            analyzer = BashFunctionAnalyzer(self.script_path, tracer='debug', persistent=persistent)
+            try:
+                result = analyzer.run_function('stop_service', args=['nginx'], mocks=mocks, virtual_time=True)
+                self.assertEqual(result.executed_lines, xtrace.executed_lines)
+                self.assertEqual(result.executed_branches, xtrace.executed_branches)
+                self.assertEqual(analyzer.get_function_calls('stop_service'), [['nginx']])
+                # Commands are recorded as written, the mock internals are left out
+                self.assertEqual(analyzer.get_calls('sudo'), [(63, 'sudo monit status "$service_name"')])
+                self.assertFalse([record for record in result.records if 'mock_dir' in record.text])
+                sudo_call = next(record for record in result.records if record.kind == 'call' and record.text == 'sudo')
+                self.assertEqual((sudo_call.line, sudo_call.functions, sudo_call.args), (63, ('sudo', 'stop_service'), None))
+            finally:
+                analyzer.close()
+
+        directory = tempfile.mkdtemp()
+        try:
+            script_path = os.path.join(directory, 'nested.sh')
+            with open(script_path, 'w') as script_file:
+                script_file.write('#!/bin/bash\ninner() {\n    echo "$#"\n}\nouter() {\n'
+                                  '    local count=$(inner "$1" \'\' "it\'s")\n    ( inner )\n    state=done\n}\n')
+            analyzer = BashFunctionAnalyzer(script_path, tracer='debug')
+            result = analyzer.run_function('outer', args=['two words\nand a line'], show_variables=['state'])
+            self.assertEqual(result.variables, {'state': 'done'})
+            self.assertEqual(analyzer.get_function_calls('inner'), [['two words\nand a line', '', "it's"], []])
+            analyzer.assert_function_called_with('outer', 'two words\nand a line')
+            echo = [record for record in result.records if record.text == 'echo "$#"']
+            self.assertEqual([(record.function, record.depth, record.subshell) for record in echo],
+                             [('inner', 2, 1), ('inner', 2, 1)])
+            self.assertEqual(analyzer.get_coverage('inner'), 100)
+            with self.assertRaises(ValueError):
+                analyzer.run_function('outer', profile=True)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_lazy_start(self):
+        print("Test lazy parsing and imports")
+
+        analyzer = BashFunctionAnalyzer(self.script_path)
+        self.assertNotIn('functions_info', vars(analyzer))
+        self.assertIn('stop_service', analyzer.functions_info)
+        self.assertIn('code_lines', vars(analyzer))
+        self.assertEqual(analyzer.total_lines, analyzer.get_code_lines_count())
+        with self.assertRaises(AttributeError):
+            analyzer.no_such_attribute
+
+        # Threads using a fresh analyzer at once: a single parse, that none of them sees half done
+        _PARSE_CACHE.pop(os.path.abspath(self.script_path), None)
+        analyzer = BashFunctionAnalyzer(self.script_path)
+        parses = []
+        parse_script = analyzer._parse_script
+        analyzer._parse_script = lambda: parses.append(1) or parse_script()
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                seen = set(executor.map(lambda _: (len(analyzer.code_line_texts), len(analyzer.global_variables),
+                                                   analyzer.total_lines, analyzer.get_code_lines_count()), range(8)))
+        finally:
+            sys.setswitchinterval(switch_interval)
+        self.assertEqual(len(parses), 1)
+        self.assertEqual(seen, {(len(self.analyzer.code_line_texts), len(self.analyzer.global_variables),
+                                 self.analyzer.total_lines, self.analyzer.total_lines)})
+        analyzer = BashFunctionAnalyzer(self.script_path)
+        for result in analyzer.run_functions([{'function_name': 'say_hello'}] * 4, max_workers=4):
+            analyzer.assertStatusOK(result=result)
+
+        code = ("import sys, unittestbash; print(sorted({'asyncio', 'unittest', 'concurrent.futures', 'pickle'} & "
+                "set(sys.modules))); unittestbash.BashSandbox; print('unittestbash.sandbox' in sys.modules)")
+        output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                text=True, capture_output=True, check=True).stdout
+        self.assertEqual(output.splitlines(), ['[]', 'True'])
+
+    def test_run_result(self):
+        print("Test run results")
+
+        analyzer = BashFunctionAnalyzer(self.script_path)
+        hello = analyzer.run_function('say_hello')
+        self.assertFalse(hasattr(hello, '__dict__'))
+        self.assertEqual(hello.stdout, 'Hello, World!\n')
+        self.assertEqual(hello.output[0], 'Hello, World!')
+        self.assertEqual(hello.stderr, '')
+        self.assertTrue(hello.trace[0].startswith('+ line '))
+        self.assertGreater(hello.duration, 0)
+
+        local_time = analyzer.run_function('get_local_time', show_variables=['current_time'])
+        self.assertRegex(local_time.variables['current_time'], r'^\d{4}-\d{2}-\d{2} ')
+        self.assertIs(analyzer.last_result, local_time)
+        analyzer.assertOutputDoesNotMatchRegex('^Hello')
+        # the analyzer doesn't keep the trace of a run nobody refers to anymore
+        self.assertEqual(analyzer.get_function_output('say_hello'), hello.output)
+        del hello
+        gc.collect()
+        self.assertEqual(analyzer.get_function_output('say_hello'), [])
+
+        # a failed run has its output line by line like any other run
+        failed = analyzer.run_function('get_local_time', mock_commands={'echo': ['exit', '3']})
+        self.assertEqual(failed.status, 3)
+        self.assertIsInstance(failed.output, list)
+        analyzer.assertStatusNOK()
+
+    def test_test_index(self):
+        print("Test test selection index")
+
+        directory = tempfile.mkdtemp()
+        try:
+            script_path = os.path.join(directory, 'lib.sh')
+            with open(script_path, 'w') as script_file:
+                script_file.write('#!/bin/bash\nouter() {\n    inner\n}\ninner() {\n    echo inner\n}\n'
+                                  'other() {\n    echo other\n}\n')
+            index_path = os.path.join(directory, 'index.json')
+            index = BashTestIndex(index_path)
+            analyzer = BashFunctionAnalyzer(script_path, test_index=index)
+            with index.test('test_outer'):
+                analyzer.run_function('outer')
+            with index.test('test_other'):
+                analyzer.run_function('other')
+            # Without index.test() the run belongs to the test method it comes from
+            analyzer.run_function('inner')
+            self.assertEqual(sorted(index.tests['test_outer']['lib.sh']), ['(top level)', 'inner', 'outer'])
+            self.assertIn(self.id(), index.tests)
+            index.save()
+
+            index = BashTestIndex(index_path)
+            self.assertEqual(index.affected_tests(), set())
+            with open(script_path, 'w') as script_file:
+                script_file.write('#!/bin/bash\nouter() {\n    inner\n}\ninner() {\n    echo changed\n}\n'
+                                  'other() {\n    echo other\n}\n')
+            self.assertEqual(index.changed_functions(), {'lib.sh': {'inner'}})
+            self.assertEqual(index.affected_tests(), {'test_outer', self.id()})
+            suite = unittest.TestSuite([TestMain('test_line_sets'), TestMain('test_test_index')])
+            self.assertEqual([test.id() for test in index.select(suite)], [TestMain('test_line_sets').id(), self.id()])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_line_sets(self):
+        print("Test line sets")
+
+        analyzer = BashFunctionAnalyzer(self.script_path)
+        hello = analyzer.run_function(function_name='say_hello')
+        self.assertEqual(hello.executed_lines.lines('say_hello'), analyzer.code_lines.lines('say_hello'))
+        self.assertEqual(analyzer.get_coverage('say_hello'), 100.0)
+
+        local_time = analyzer.run_function(function_name='get_local_time')
+        self.assertEqual(analyzer.executed_lines, hello.executed_lines | local_time.executed_lines)
+        self.assertEqual((analyzer.executed_lines - hello.executed_lines).functions(), ['get_local_time'])
+        self.assertFalse(hello.executed_lines - analyzer.executed_lines)
+        self.assertEqual(len(analyzer.executed_lines),
+                         analyzer.executed_lines.count('say_hello') + analyzer.executed_lines.count('get_local_time'))
+
+    def test_coverage_export(self):
+        print("Test coverage export")
+
+        analyzer = BashFunctionAnalyzer(self.script_path)
+        analyzer.run_function(function_name='say_hello')
+        directory = tempfile.mkdtemp()
+        try:
+            for name in ('coverage.info', 'coverage.xml', 'coverage.json'):
+                analyzer.export_coverage(os.path.join(directory, name))
+            lcov = coverage_export.read_coverage(os.path.join(directory, 'coverage.info'))
+            self.assertEqual(lcov, coverage_export.read_coverage(os.path.join(directory, 'coverage.json')))
+            code_lines, executed_lines = lcov[self.script_path]['say_hello']
+            self.assertEqual(code_lines, executed_lines)
+            self.assertEqual(ElementTree.parse(os.path.join(directory, 'coverage.xml')).getroot().get('lines-covered'),
+                             str(len(executed_lines)))
+
+            # a shard that covered get_local_time as well
+            analyzer.run_function(function_name='get_local_time')
+            analyzer.export_coverage(os.path.join(directory, 'shard.json'))
+            coverage_export.main([os.path.join(directory, 'coverage.info'), os.path.join(directory, 'shard.json'),
+                                  '-o', os.path.join(directory, 'merged.json')])
+            merged = coverage_export.read_coverage(os.path.join(directory, 'merged.json'))
+            self.assertEqual(merged, {self.script_path: analyzer.get_line_coverage()})
+            self.assertTrue(merged[self.script_path]['get_local_time'][1])
+            # executed lines that aren't code lines of any shard are dropped, the unions come out sorted
+            self.assertEqual(coverage_export.merge_coverage([{'a.sh': {'f': ([3, 1], [3])}}, {'a.sh': {'f': ([2], [9, 1])}},
+                                                             {'b.sh': {'g': ([5], [])}}]),
+                             {'a.sh': {'f': ([1, 2, 3], [1, 3])}, 'b.sh': {'g': ([5], [])}})
+        finally:
+            shutil.rmtree(directory)
+
+    def test_project_coverage(self):
+        print("Test project coverage")
+
+        directory = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(directory, 'lib'))
+            with open(os.path.join(directory, 'lib', 'net.sh'), 'w') as script_file:
+                script_file.write('fetch() {\n    echo "fetch $1"\n    if [ "$1" = "x" ]; then\n'
+                                  '        echo never\n    fi\n}\n')
+            with open(os.path.join(directory, 'app.sh'), 'w') as script_file:
+                script_file.write('source "$(dirname "${BASH_SOURCE[0]}")/lib/net.sh"\n'
+                                  'main() {\n    fetch "$1"\n    echo done\n}\n')
+            project = BashProjectAnalyzer(directory)
+            project.parse_all()
+            self.assertEqual(project.scripts, [os.path.join(directory, 'app.sh'),
+                                               os.path.join(directory, 'lib', 'net.sh')])
+
+            result = project.run_function('app.sh', 'main', function_args=['a'])
+            project.get_analyzer('app.sh').assertStatusOK(result=result)
+            report = project.get_coverage_report()
+            self.assertEqual(report['app.sh']['percentage'], 100.0)
+            # lines 2 and 3 of fetch were traced from lib/net.sh, the echo in the if was not
+            self.assertEqual(report[os.path.join('lib', 'net.sh')]['functions']['fetch']['covered'], 2)
+            self.assertEqual(report[os.path.join('lib', 'net.sh')]['functions']['fetch']['total'], 4)
+
+            # The commands of lib/net.sh count for the assertions as they do without trace_sources
+            plain = BashFunctionAnalyzer(os.path.join(directory, 'app.sh'))
+            plain_result = plain.run_function('main', function_args=['a'])
+            analyzer = project.get_analyzer('app.sh')
+            for checked in (plain, analyzer):
+                run = plain_result if checked is plain else result
+                self.assertEqual(checked.get_calls('echo', result=run), [(2, "echo 'fetch a'"), (4, 'echo done')])
+                checked.assert_called_before('echo \'fetch', 'echo done', result=run)
+                checked.assert_called_with('echo', 'fetch a', result=run)
+                checked.assert_call_number("'['", 1, result=run)
+            self.assertEqual(list(result.command_index.sources.values()),
+                             [os.path.join(directory, 'lib', 'net.sh')] * 2)
+        finally:
+            shutil.rmtree(directory)
+
+    @patch_bash('mock_commands', {
+        'exit': ['echo', 'exit']
+    })
+    def test_parallel_runs(self,
+                           mock_commands,
+                           function_name='prompt_backup_confirmation'):
+        print(f"Test function: {function_name} in parallel")
+
+        answers = {
+            "yes": ('exit 0', r'^.+Backup operation started by user\..+$'),
+            "no": ('exit 0', r'^.+Backup operation canceled by user\..+$'),
+            "ok": ('exit 1', r'^.+Unknown choice\..+$'),
+        }
+        analyzer = BashFunctionAnalyzer(self.script_path)
+        results = analyzer.run_functions([{'function_name': function_name,
+                                           'mock_commands': mock_commands,
+                                           'mock_read_values': [answer]} for answer in answers],
+                                         max_workers=len(answers))
+
+        for result, (exit_command, output_regex) in zip(results, answers.values()):
+            analyzer.assert_run_once(exit_command, result=result)
+            analyzer.assertOutputMatchesRegex(output_regex, result=result)
+            analyzer.assertStatusOK(result=result)
+        # every branch was taken by one of the runs
+        self.analyzer.assertEqual(analyzer.get_coverage(function_name), 100)
+
+    @patch_bash('mock_commands', {
+        'exit': ['echo', 'exit']
+    })
+    def test_async_runs(self,
+                        mock_commands,
+                        function_name='prompt_backup_confirmation'):
+        print(f"Test function: {function_name} with asyncio")
+
+        answers = {
+            "yes": r'^.+Backup operation started by user\..+$',
+            "no": r'^.+Backup operation canceled by user\..+$',
+            "ok": r'^.+Unknown choice\..+$',
+        }
+        analyzer = BashFunctionAnalyzer(self.script_path)
+        results = asyncio.run(analyzer.run_functions_async([{'function_name': function_name,
+                                                             'mock_commands': mock_commands,
+                                                             'mock_read_values': [answer],
+                                                             'stream': answer == 'ok'} for answer in answers],
+                                                           max_concurrency=2))
+        for result, output_regex in zip(results, answers.values()):
+            analyzer.assertOutputMatchesRegex(output_regex, result=result)
+            analyzer.assertStatusOK(result=result)
+        self.analyzer.assertEqual(analyzer.get_coverage(function_name), 100)
+
+        # a timeout kills the whole process group, the background sleep included
+        directory = tempfile.mkdtemp()
+        try:
+            script_path = os.path.join(directory, 'slow.sh')
+            pid_path = os.path.join(directory, 'pid')
+            with open(script_path, 'w') as script_file:
+                script_file.write('#!/bin/bash\nslow() {\n    sleep 30 &\n    echo $! > "$1"\n    sleep 30\n}\n')
+            slow = BashFunctionAnalyzer(script_path)
+            with self.assertRaises(asyncio.TimeoutError):
+                asyncio.run(slow.run_function_async('slow', function_args=[pid_path], timeout=1))
+            with open(pid_path) as pid_file:
+                pid = int(pid_file.read())
+            for _ in range(50):
+                try:
+                    with open(f'/proc/{pid}/stat') as stat_file:
+                        if stat_file.read().split(') ')[1][0] == 'Z':
+                            break
+                except FileNotFoundError:
+                    break
+                time.sleep(0.1)
+            else:
+                self.fail("The background sleep is still running")
+        finally:
+            shutil.rmtree(directory)
+
+    @patch_bash('mock_read_values', ["no"])
+    @patch_bash('mock_commands', {
+        'exit': ['echo', 'exit']
+    })
+    def test_persistent_worker(self,
+                               mock_commands,
+                               mock_read_values,
+                               function_name='prompt_backup_confirmation'):
+        print(f"Test function: {function_name} in persistent bash worker")
+
+        analyzer = BashFunctionAnalyzer(self.script_path, persistent=True)
+        try:
+            for _ in range(2):  # second run reuses the already sourced script
+                analyzer.run_function(function_name,
+                                      mock_commands=mock_commands,
+                                      mock_read_values=mock_read_values)
+                analyzer.assert_run_once("read")
+                analyzer.assert_run_once('exit 0')
+                analyzer.assertOutputMatchesRegex(r'^.+Backup operation canceled by user\..+$')
+                analyzer.assertStatusOK()
+        finally:
+            analyzer.close()
+
+        one_shot = BashFunctionAnalyzer(self.script_path)
+        one_shot.run_function(function_name,
+                              mock_commands=mock_commands,
+                              mock_read_values=mock_read_values)
+        self.analyzer.assertEqual(sorted(analyzer.output), sorted(one_shot.output))
+        self.analyzer.assertEqual(analyzer.executed_lines, one_shot.executed_lines)
+
     @patch_bash('mock_commands',{
         'say_hello': ['echo', 'say_hello'],
         'get_local_time': ['echo', 'get_local_time'],
@@ -1,2 +1,30 @@
-import unittestbash
-from .unittestbash import BashFunctionAnalyzer, patch_bash
\ No newline at end of file
+from .mocks import BashMocks
+from .profiler import BashProfile
+from .unittestbash import BashCommandRecord, BashFunctionAnalyzer, BashRunResult, LineSet, batch_runs, patch_bash
+
+# Imported on first use, they bring in asyncio, unittest, concurrent.futures...
+_LAZY = {
+    'BashProjectAnalyzer': '.project',
+    'BashTestIndex': '.test_index',
+    'explore_inputs': '.explorer',
+    'explore_inputs_async': '.explorer',
+    'BashSandbox': '.sandbox',
+    'BashSandboxRun': '.sandbox',
+}
+
+__all__ = ['BashCommandRecord', 'BashFunctionAnalyzer', 'BashMocks', 'BashProfile', 'BashRunResult', 'LineSet',
+           'batch_runs', 'patch_bash', *_LAZY]
+
+
+def __getattr__(name):
+    module_name = _LAZY.get(name)
+    if module_name is None:
+        raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+    from importlib import import_module
+    value = getattr(import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
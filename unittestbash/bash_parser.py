@@ -0,0 +1,662 @@
+import re
+import sys
+from bisect import bisect_right
+
+# Tokenizer and recursive descent parser for the part of the bash grammar the analyzer needs: functions,
+# if/case/loops, groups, lists and pipelines, simple commands, [[ ]] and (( )). Words are opaque, quotes,
+# expansions and command substitutions are only scanned to find where the word ends, and here-document bodies
+# are skipped. One pass over the text, tokens are (kind, text, start offset, end offset) with kind 'word', 'op',
+# 'arith' (a whole (( ... )) command) or 'newline'. Line numbers are looked up from the offsets, only for the
+# tokens the parser keeps.
+
+WORD, OP, ARITH, NEWLINE, END = 'word', 'op', 'arith', 'newline', 'end'
+
+_OPERATORS = r';;&|;;|;&|\|\||\|&|&&|&>>|&>|<<<|<<-|<<|<>|<&|>>|>&|>\||[;&|<>()]'
+# The bulk of most words: plain characters, single quoted strings, and double quoted strings without command
+# substitutions. Anything else is finished by _scan_word one piece at a time
+_WORD = r'''(?:[^\s;&|<>()'"\\$`]++|'[^']*+'|"(?:[^"\\$`]++|\\.|\$(?![({'"\[]))*+"|\$(?![({'"\[]))'''
+# Blanks, line continuations and comments, then one token. Groups: redirection with a file descriptor number
+# (2>/dev/null), word, newline (with the blank and comment lines after it), arithmetic command, process
+# substitution, operator. The quantifiers are possessive: nothing is ever given back, and the regex engine
+# doesn't keep the backtracking state of every piece of a word
+_TOKEN_PATTERN = re.compile(r'[ \t\r\f\v]*+(?:(?:\\\n|#[^\n]*+)[ \t\r\f\v]*+)*+(?:(\d+(?:<<<|<<-|<<|<>|<&|>>|>&|>\||[<>]))|('
+                            + _WORD + r'++)|(\n(?:[ \t\r\f\v]*+(?:#[^\n]*+)?\n)*+)|(\(\()|([<>]\()|(' + _OPERATORS + r'))?',
+                            re.DOTALL)
+_WORD_PATTERN = re.compile(_WORD + '*+', re.DOTALL)
+_WORD_CONTINUATION = frozenset('\'"\\$`(')
+_IO_NUMBER_PATTERN = re.compile(r'\d+')
+_NEWLINE_PATTERN = re.compile('\n')
+_DOUBLE_QUOTED_PATTERN = re.compile(r'[^"\\$`]*')
+_BACKQUOTED_PATTERN = re.compile(r'[^`\\]*')
+_ANSI_QUOTED_PATTERN = re.compile(r"[^'\\]*")
+_BALANCED_PATTERNS = {('(', ')'): re.compile(r'''[^()'"\\`]*'''), ('{', '}'): re.compile(r'''[^{}'"\\`]*'''),
+                      ('[', ']'): re.compile(r'''[^\[\]'"\\`]*''')}
+_ASSIGNMENT_PATTERN = re.compile(r'^([A-Za-z_]\w*)(?:\[[^\]]*\])?\+?=(.*)$', re.DOTALL)
+_NAME_PATTERN = re.compile(r'^[A-Za-z_][\w.:-]*$')
+
+REDIRECTIONS = frozenset(['<', '>', '>>', '<<', '<<-', '<<<', '<>', '<&', '>&', '&>', '&>>', '>|'])
+_SEPARATORS = frozenset([';', '&', '\n'])
+# Words after which the next word is a command again, for the case/esac count inside $( ... )
+_COMMAND_KEYWORDS = frozenset(['if', 'then', 'elif', 'else', 'while', 'until', 'do', '{', '!', 'time'])
+_CASE_TERMINATORS = frozenset([';;', ';&', ';;&'])
+_LIST_OPERATORS = frozenset(['&&', '||', '|', '|&'])
+# Words that start something else than a simple command
+_COMMAND_WORDS = frozenset(['if', 'while', 'until', 'for', 'select', 'case', '{', '[[', 'function'])
+_THEN, _IF_ARMS_END, _FI = frozenset(['then']), frozenset(['elif', 'else', 'fi']), frozenset(['fi'])
+_DO, _DONE, _ESAC, _GROUP_END = frozenset(['do']), frozenset(['done']), frozenset(['esac']), frozenset(['}'])
+
+
+class Command:
+    # A simple command, a [[ ]] test or a (( )) evaluation. line is the line bash reports in $LINENO (and so in
+    # the trace): the line the token after the first word ends on for simple commands, the last line otherwise
+    def __init__(self, kind, line, start_line, end_line, start, end, words=()):
+        self.kind = kind  # 'simple', '[[' or '(('
+        self.line = line
+        self.start_line = start_line
+        self.end_line = end_line
+        self.start = start
+        self.end = end
+        self.words = words
+
+
+class Function:
+    def __init__(self, name, line, end_line, body):
+        self.name = sys.intern(name)  # The key of every table the analyzer keeps per function
+        self.line = line
+        self.end_line = end_line
+        self.body = body
+
+
+class If:
+    # clauses: [(condition, body)] for the if and every elif, else_body is None without else
+    def __init__(self, line, clauses, else_body, end_line):
+        self.line = line
+        self.clauses = clauses
+        self.else_body = else_body
+        self.end_line = end_line
+
+
+class Case:
+    # arms: [(patterns, body)]
+    def __init__(self, line, word, arms, end_line):
+        self.line = line
+        self.word = word
+        self.arms = arms
+        self.end_line = end_line
+
+
+class Loop:
+    # while/until loops have a condition, for/select loops only a header that bash traces as a whole
+    def __init__(self, kind, line, condition, body, end_line):
+        self.kind = kind
+        self.line = line
+        self.condition = condition
+        self.body = body
+        self.end_line = end_line
+
+
+class Group:
+    # { ... } or ( ... )
+    def __init__(self, kind, line, body, end_line):
+        self.kind = kind
+        self.line = line
+        self.body = body
+        self.end_line = end_line
+
+
+class _Tokenizer:
+    def __init__(self, text):
+        self.text = text
+        self.length = len(text)
+
+    def tokenize(self):
+        # Every token of the text. Plain tokens come straight from finditer, the scan restarts after the few
+        # that need more work (quotes with substitutions, here-documents, ...)
+        text, length = self.text, self.length
+        tokens = []
+        emit = tokens.append
+        heredocs = []  # (delimiter, strip tabs) waiting for the end of the line
+        heredoc_next = None
+        pos = 0
+        while pos < length:
+            restart = None
+            for match in _TOKEN_PATTERN.finditer(text, pos):
+                group = match.lastindex
+                if group == 2:
+                    start, end = match.span(2)
+                    if end < length and text[end] in _WORD_CONTINUATION:
+                        restart = end = self._scan_word(end, start)
+                    elif heredoc_next is None:
+                        emit((WORD, match.group(2), start, end))  # Most tokens end here
+                        continue
+                    kind = WORD
+                elif group == 3:
+                    start, end = match.span(3)
+                    if heredocs:
+                        restart = end = self._skip_heredocs(start + 1, heredocs)  # The body starts on the next line
+                        heredocs = []
+                    emit((NEWLINE, '\n', start, end))
+                    if restart is not None:
+                        break
+                    continue
+                elif group == 6 or group == 1:
+                    start, end = match.span(group)
+                    operator = text[_IO_NUMBER_PATTERN.match(text, start).end() if group == 1 else start:end]
+                    if operator == '<<' or operator == '<<-':
+                        heredoc_next = operator == '<<-'
+                    emit((OP, operator, start, end))
+                    continue
+                elif group == 4:
+                    start = match.start(4)
+                    restart = end = self._skip_balanced(start + 2, '(', ')', 2)
+                    kind = ARITH
+                elif group == 5:
+                    start = match.start(5)
+                    restart = end = self._scan_word(start)  # Process substitution
+                    kind = WORD
+                else:
+                    start = match.end()
+                    if start >= length:
+                        return tokens
+                    # Not a token start the pattern knows, e.g. a word opening with a quote or $(
+                    restart = end = max(self._scan_word(start), start + 1)
+                    kind = WORD
+                word = text[start:end]
+                if heredoc_next is not None:
+                    heredocs.append((_unquote(word), heredoc_next))
+                    heredoc_next = None
+                emit((kind, word, start, end))
+                if restart is not None:
+                    break
+            if restart is None:
+                break
+            pos = restart
+        return tokens
+
+    def _scan_substitution(self, pos):
+        # Offset after the parenthesis closing the $( ... ) (or <( ... )) whose content starts at pos. The same
+        # scan as tokenize without keeping the tokens, counting parentheses and the case arms (whose patterns
+        # end with one)
+        text, length = self.text, self.length
+        heredocs = []
+        heredoc_next = None
+        depth = case_depth = 0
+        command_position = True
+        while pos < length:
+            restart = None
+            for match in _TOKEN_PATTERN.finditer(text, pos):
+                group = match.lastindex
+                if group == 2:
+                    start, end = match.span(2)
+                    if end < length and text[end] in _WORD_CONTINUATION:
+                        restart = end = self._scan_word(end, start)
+                elif group == 3:
+                    command_position = True
+                    if heredocs:
+                        restart = self._skip_heredocs(match.start(3) + 1, heredocs)
+                        heredocs = []
+                        break
+                    continue
+                elif group == 6 or group == 1:
+                    start, end = match.span(group)
+                    operator = text[_IO_NUMBER_PATTERN.match(text, start).end() if group == 1 else start:end]
+                    if operator == '<<' or operator == '<<-':
+                        heredoc_next = operator == '<<-'
+                    elif operator == '(':
+                        depth += 1
+                    elif operator == ')':
+                        if depth:
+                            depth -= 1
+                        elif not case_depth:
+                            return end
+                    command_position = operator not in REDIRECTIONS and operator != ')'
+                    continue
+                elif group == 4:
+                    start = match.start(4)
+                    restart = end = self._skip_balanced(start + 2, '(', ')', 2)
+                elif group == 5:
+                    start = match.start(5)
+                    restart = end = self._scan_word(start)
+                else:
+                    start = match.end()
+                    if start >= length:
+                        return length
+                    restart = end = max(self._scan_word(start), start + 1)
+                word = text[start:end]
+                if heredoc_next is not None:
+                    heredocs.append((_unquote(word), heredoc_next))
+                    heredoc_next = None
+                if command_position:
+                    if word == 'case':
+                        case_depth += 1
+                    elif word == 'esac' and case_depth:
+                        case_depth -= 1
+                command_position = word in _COMMAND_KEYWORDS
+                if restart is not None:
+                    break
+            if restart is None:
+                return length
+            pos = restart
+        return length
+
+    def _skip_heredocs(self, pos, heredocs):
+        text = self.text
+        for delimiter, strip_tabs in heredocs:
+            while pos < self.length:
+                end = text.find('\n', pos)
+                if end < 0:
+                    end = self.length
+                body_line = text[pos:end]
+                pos = end + 1
+                if (body_line.lstrip('\t') if strip_tabs else body_line) == delimiter:
+                    break
+        return min(pos, self.length)
+
+    def _scan_word(self, pos, start=None):
+        # Offset after the word that goes on at pos. start is where the word began, a parenthesis inside a word
+        # (an array assignment or an extglob pattern) belongs to it
+        text, length = self.text, self.length
+        start = pos if start is None else start
+        while pos < length:
+            pos = _WORD_PATTERN.match(text, pos).end()
+            if pos >= length:
+                break
+            char = text[pos]
+            if char == "'":
+                end = text.find("'", pos + 1)
+                pos = length if end < 0 else end + 1
+            elif char == '"':
+                pos = self._scan_double_quoted(pos + 1)
+            elif char == '\\':
+                pos += 2
+            elif char == '`':
+                pos = self._scan_backquoted(pos + 1)
+            elif char == '$':
+                pos = self._scan_dollar(pos)
+            elif char == '(' and pos > start and text[pos - 1] in '=@!+*?':
+                pos = self._skip_balanced(pos + 1, '(', ')')
+            elif (char == '<' or char == '>') and pos == start and text.startswith('(', pos + 1):
+                pos = self._scan_substitution(pos + 2)
+            else:
+                break
+        return min(pos, length)
+
+    def _scan_dollar(self, pos):
+        text = self.text
+        following = text[pos + 1:pos + 2]
+        if following == '(':
+            if text.startswith('((', pos + 1):
+                return self._skip_balanced(pos + 3, '(', ')', 2)
+            return self._scan_substitution(pos + 2)
+        if following == '{':
+            return self._skip_balanced(pos + 2, '{', '}')
+        if following == '[':
+            return self._skip_balanced(pos + 2, '[', ']')
+        if following == "'":
+            pos += 2
+            while pos < self.length:
+                pos = _ANSI_QUOTED_PATTERN.match(text, pos).end()
+                if text.startswith("'", pos):
+                    return pos + 1
+                pos += 2
+            return self.length
+        if following == '"':
+            return self._scan_double_quoted(pos + 2)
+        return pos + 1
+
+    def _scan_double_quoted(self, pos):
+        text, length = self.text, self.length
+        while pos < length:
+            pos = _DOUBLE_QUOTED_PATTERN.match(text, pos).end()
+            if pos >= length:
+                break
+            char = text[pos]
+            if char == '"':
+                return pos + 1
+            if char == '\\':
+                pos += 2
+            elif char == '`':
+                pos = self._scan_backquoted(pos + 1)
+            else:
+                pos = self._scan_dollar(pos)
+        return length
+
+    def _scan_backquoted(self, pos):
+        text, length = self.text, self.length
+        while pos < length:
+            pos = _BACKQUOTED_PATTERN.match(text, pos).end()
+            if text.startswith('`', pos):
+                return pos + 1
+            pos += 2
+        return length
+
+    def _skip_balanced(self, pos, opening, closing, depth=1):
+        text, length = self.text, self.length
+        pattern = _BALANCED_PATTERNS[(opening, closing)]
+        while pos < length:
+            pos = pattern.match(text, pos).end()
+            if pos >= length:
+                break
+            char = text[pos]
+            if char == opening:
+                depth += 1
+                pos += 1
+            elif char == closing:
+                depth -= 1
+                pos += 1
+                if depth == 0:
+                    return pos
+            elif char == "'":
+                end = text.find("'", pos + 1)
+                pos = length if end < 0 else end + 1
+            elif char == '"':
+                pos = self._scan_double_quoted(pos + 1)
+            elif char == '`':
+                pos = self._scan_backquoted(pos + 1)
+            else:
+                pos += 2
+        return length
+
+
+def _unquote(word):
+    # Here-document delimiters are matched without their quotes
+    return word.replace('"', '').replace("'", '').replace('\\', '')
+
+
+def tokenize(text):
+    return _Tokenizer(text).tokenize()
+
+
+class _Parser:
+    def __init__(self, text, tokens):
+        self.text = text
+        self.tokens = tokens
+        self.tokens.append((END, '', len(text), len(text)))  # Sentinel, no bound checks while parsing
+        self.position = 0
+        self.line_starts = [match.end() for match in _NEWLINE_PATTERN.finditer(text)]
+
+    def _start_line(self, token):
+        return bisect_right(self.line_starts, token[2]) + 1
+
+    def _end_line(self, token):
+        # The line of the last character, a newline token is on the line it ends
+        return bisect_right(self.line_starts, token[2] if token[0] == NEWLINE else token[3] - 1) + 1
+
+    def _skip_newlines(self):
+        while self.tokens[self.position][0] == NEWLINE:
+            self.position += 1
+
+    def _last_line(self):
+        return self._end_line(self.tokens[self.position - 1]) if self.position else 1
+
+    def _expect_word(self, *words):
+        # Lenient: a missing keyword (a script cut short) ends the construct where the tokens end
+        token = self.tokens[self.position]
+        if token[0] == WORD and token[1] in words:
+            self.position += 1
+            return True
+        return False
+
+    def parse_list(self, stop_words=frozenset()):
+        nodes = []
+        tokens = self.tokens
+        while True:
+            kind, text = tokens[self.position][:2]
+            if kind == NEWLINE or kind == OP and text in _SEPARATORS:
+                self.position += 1
+            elif kind == WORD:
+                if text in stop_words:
+                    break
+                self._parse_and_or(nodes)
+            elif kind == END:
+                break
+            elif kind == OP and (text in _CASE_TERMINATORS or text == ')'):
+                if stop_words:
+                    break
+                self.position += 1  # Stray at the top level
+            else:
+                self._parse_and_or(nodes)
+        return nodes
+
+    def _parse_and_or(self, nodes):
+        # Pipelines joined by && and ||, flattened into nodes: only the commands matter here
+        tokens = self.tokens
+        while True:
+            token = tokens[self.position]
+            while token[0] == WORD and (token[1] == '!' or token[1] == 'time'):
+                self.position += 1
+                token = tokens[self.position]
+            if token[0] == WORD and token[1] not in _COMMAND_WORDS and tokens[self.position + 1][1] != '(':
+                nodes.append(self._parse_simple_command())  # Most commands, without the detour
+            else:
+                nodes.extend(self._parse_command())
+            token = tokens[self.position]
+            if token[0] != OP or token[1] not in _LIST_OPERATORS:
+                return
+            self.position += 1
+            self._skip_newlines()
+
+    def _parse_command(self):
+        tokens = self.tokens
+        token = tokens[self.position]
+        kind, text = token[:2]
+        if kind == WORD:
+            if text not in _COMMAND_WORDS and tokens[self.position + 1][1] != '(':
+                return [self._parse_simple_command()]
+            if text in _COMPOUND_PARSERS:
+                nodes = [_COMPOUND_PARSERS[text](self, token)]
+            elif text == '[[':
+                nodes = [self._parse_test(token)]
+            elif text == 'function':
+                nodes = [self._parse_function(token, keyword=True)]
+            elif tokens[self.position + 2][1] == ')' and _NAME_PATTERN.match(text):
+                nodes = [self._parse_function(token)]
+            else:
+                return [self._parse_simple_command()]
+        elif kind == ARITH:
+            self.position += 1
+            end_line = self._end_line(token)
+            nodes = [Command('((', end_line, self._start_line(token), end_line, token[2], token[3])]
+        elif kind == OP and text == '(':
+            self.position += 1
+            body = self.parse_list(frozenset([')']))
+            if tokens[self.position][1] == ')':
+                self.position += 1
+            nodes = [Group('(', self._start_line(token), body, self._last_line())]
+        elif kind == OP and text in REDIRECTIONS:
+            return [self._parse_simple_command()]
+        else:
+            if kind != END:
+                self.position += 1  # Unexpected operator, skipped
+            return []
+        self._skip_redirections()
+        return nodes
+
+    def _skip_redirections(self):
+        tokens = self.tokens
+        while tokens[self.position][0] == OP and tokens[self.position][1] in REDIRECTIONS:
+            self.position += 2
+        self.position = min(self.position, len(tokens) - 1)
+
+    def _parse_simple_command(self):
+        tokens, first = self.tokens, self.position
+        words = []
+        position = first
+        while True:
+            token = tokens[position]
+            kind = token[0]
+            if kind == WORD:
+                words.append(token[1])
+            elif kind == OP and token[1] in REDIRECTIONS and tokens[position + 1][0] != END:
+                position += 1  # The target of the redirection
+            else:
+                break
+            position += 1
+        self.position = position
+        first_token, last = tokens[first], tokens[position - 1]
+        # $LINENO is taken once the parser sees the token after the first element
+        lookahead = tokens[min(first + (2 if first_token[0] == OP else 1), position)]
+        if lookahead[0] == END:
+            lookahead = last
+        start_line = self._start_line(first_token)
+        if self.text.find('\n', first_token[2], max(last[3], lookahead[2] if lookahead[0] == NEWLINE
+                                                      else lookahead[3])) < 0:
+            # On one line, like most commands
+            return Command('simple', start_line, start_line, start_line, first_token[2], last[3], words)
+        return Command('simple', self._end_line(lookahead), start_line, self._end_line(last), first_token[2], last[3],
+                       words)
+
+    def _parse_test(self, token):
+        tokens = self.tokens
+        first = self.position
+        self.position += 1
+        while tokens[self.position][0] != END and not (tokens[self.position][0] == WORD
+                                                      and tokens[self.position][1] == ']]'):
+            self.position += 1
+        last = tokens[self.position] if tokens[self.position][0] != END else tokens[self.position - 1]
+        self._expect_word(']]')
+        end_line = self._end_line(last)
+        words = tuple(test_token[1] for test_token in tokens[first:self.position])
+        return Command('[[', end_line, self._start_line(token), end_line, token[2], last[3], words)
+
+    def _parse_function(self, token, keyword=False):
+        if keyword:
+            self.position += 1
+            token = self.tokens[self.position]
+        self.position += 1
+        if self.tokens[self.position][1] == '(':
+            self.position += 2
+        self._skip_newlines()
+        body = self._parse_command()
+        return Function(token[1], self._start_line(token), self._last_line(), body)
+
+    def _parse_if(self, token):
+        clauses = []
+        else_body = None
+        keyword = 'if'
+        while keyword == 'if' or keyword == 'elif':
+            self.position += 1
+            condition = self.parse_list(_THEN)
+            self._expect_word('then')
+            body = self.parse_list(_IF_ARMS_END)
+            clauses.append((condition, body))
+            keyword = self.tokens[self.position][1]
+        if keyword == 'else':
+            self.position += 1
+            else_body = self.parse_list(_FI)
+        self._expect_word('fi')
+        return If(self._start_line(token), clauses, else_body, self._last_line())
+
+    def _parse_loop(self, token):
+        tokens = self.tokens
+        self.position += 1
+        condition = []
+        if token[1] == 'while' or token[1] == 'until':
+            condition = self.parse_list(_DO)
+        else:
+            # for/select header: skipped up to do, (( ;; )) included
+            while tokens[self.position][0] != END and not (tokens[self.position][0] == WORD
+                                                          and tokens[self.position][1] in ('do', '{')):
+                self.position += 1
+        if tokens[self.position][0] == WORD and tokens[self.position][1] == '{':
+            body = [self._parse_group(tokens[self.position])]
+        else:
+            self._expect_word('do')
+            body = self.parse_list(_DONE)
+            self._expect_word('done')
+        return Loop(token[1], self._start_line(token), condition, body, self._last_line())
+
+    def _parse_case(self, token):
+        tokens = self.tokens
+        self.position += 1
+        word = tokens[self.position][1]
+        self.position += 1
+        self._skip_newlines()
+        self._expect_word('in')
+        arms = []
+        while True:
+            self._skip_newlines()
+            next_token = tokens[self.position]
+            if next_token[0] == END or next_token[0] == WORD and next_token[1] == 'esac':
+                break
+            if next_token[1] == '(':
+                self.position += 1
+            patterns = []
+            while tokens[self.position][0] != END and tokens[self.position][1] != ')':
+                if tokens[self.position][0] == WORD:
+                    patterns.append(tokens[self.position][1])
+                self.position += 1
+            if tokens[self.position][0] != END:
+                self.position += 1
+            body = self.parse_list(_ESAC)
+            arms.append((patterns, body))
+            if tokens[self.position][0] == OP and tokens[self.position][1] in _CASE_TERMINATORS:
+                self.position += 1
+        self._expect_word('esac')
+        return Case(self._start_line(token), word, arms, self._last_line())
+
+    def _parse_group(self, token):
+        self.position += 1
+        body = self.parse_list(_GROUP_END)
+        self._expect_word('}')
+        return Group('{', self._start_line(token), body, self._last_line())
+
+
+_COMPOUND_PARSERS = {
+    'if': _Parser._parse_if, 'while': _Parser._parse_loop, 'until': _Parser._parse_loop,
+    'for': _Parser._parse_loop, 'select': _Parser._parse_loop, 'case': _Parser._parse_case,
+    '{': _Parser._parse_group,
+}
+
+
+def parse(text):
+    # The top level commands of the script
+    return _Parser(text, tokenize(text)).parse_list()
+
+
+def walk(nodes, function=None, condition=False):
+    # [(node, innermost function holding it, part of an if/while/until test)] for every node, in source order
+    walked = []
+    stack = [(node, function, condition) for node in reversed(nodes)]
+    while stack:
+        item = stack.pop()
+        walked.append(item)
+        node, function, condition = item
+        node_type = type(node)
+        if node_type is Command:
+            continue
+        if node_type is Function:
+            children = [(child, node, False) for child in node.body]
+        elif node_type is If:
+            children = []
+            for test, body in node.clauses:
+                children.extend((child, function, True) for child in test)
+                children.extend((child, function, condition) for child in body)
+            children.extend((child, function, condition) for child in node.else_body or ())
+        elif node_type is Loop:
+            children = [(child, function, True) for child in node.condition]
+            children.extend((child, function, condition) for child in node.body)
+        elif node_type is Case:
+            children = [(child, function, condition) for _, body in node.arms for child in body]
+        else:
+            children = [(child, function, condition) for child in node.body]
+        stack.extend(reversed(children))
+    return walked
+
+
+def assignments(command):
+    # {name: value} of a simple command made of assignments only, e.g. LOG_FILE=/var/log/x.log
+    if command.kind != 'simple' or not command.words:
+        return {}
+    matches = [_ASSIGNMENT_PATTERN.match(word) for word in command.words]
+    if not all(matches):
+        return {}
+    return {match.group(1): match.group(2) for match in matches}
+
+
+def span_lines(nodes):
+    # First and last line of a list of nodes, (None, None) when empty
+    if not nodes:
+        return None, None
+    first = nodes[0]
+    return (first.start_line if isinstance(first, Command) else first.line), nodes[-1].end_line
@@ -0,0 +1,162 @@
+import os
+import queue
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# The driver sources the script once (with the same PS4/xtrace setup as the one-shot mode, so the
+# source-time trace is identical), then reads NUL-terminated jobs from stdin. Every job is evaluated in
+# a forked subshell, so mocks, exports and `exit` never leak into the next job. Job stdout/stderr are
+# spooled to files in the worker directory and the exit status is sent back over the stdout pipe.
+# Everything up to the job loop stays on line 1, like the `bash -c` one-liner of the one-shot mode. The
+# preamble ($3) can adjust the tracing setup before the script is sourced. The setup code is inserted in
+# place of __UBASH_SETUP__ (traced like in the one-shot command), it runs once and every job starts from the
+# state it leaves.
+_DRIVER = (
+    "PS4='+ line ${LINENO}: '; eval \"$3\"; "
+    'exec 3>&1 4<&0 >"$2/out" 2>"$2/err" </dev/null; '
+    'set -x; source "$1"; __UBASH_SETUP__{ __ubash_setup_status=$?; set +x; } 2>/dev/null; '
+    'exec 1>&3 2>&1 0<&4 3>&- 4<&-; '
+    'printf "ready %s\\n" "$__ubash_setup_status"; '
+    'while IFS= read -r -d "" __ubash_job; do '
+    '( eval "$__ubash_job" ) >"$2/out" 2>"$2/err" </dev/null; '
+    'printf "%s\\n" "$?"; '
+    'done'
+)
+
+# The job subshell adds one level of xtrace indirection ("+" -> "++"), which is stripped back. Lines of
+# sourced files may carry their path in front of "line N:" (trace_sources)
+_NESTED_TRACE_PATTERN = re.compile(r'^\+(\++ (?:.+? )?line \d+: )')
+
+
+def escape_double_quoted(text):
+    # Make text survive inside a "..." string of /bin/sh unchanged
+    return re.sub(r'([$`"\\])', r'\\\1', text)
+
+
+def unescape_double_quoted(text):
+    # Undo what /bin/sh does to the body of a "..." string: only \$, \`, \", \\ and \<newline> are escapes
+    return re.sub(r'\\([$`"\\\n])', lambda m: '' if m.group(1) == '\n' else m.group(1), text)
+
+
+class BashWorker:
+    def __init__(self, script_path, preamble='', setup=''):
+        self.script_path = script_path
+        self.directory = tempfile.mkdtemp(prefix='unittestbash-')
+        driver = _DRIVER.replace('__UBASH_SETUP__', f'{setup}; ' if setup else '')
+        self.process = subprocess.Popen(['bash', '-c', driver, 'bash', script_path, self.directory, preamble],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        ready = self.process.stdout.readline()
+        if not ready.startswith('ready '):
+            self.close()
+            raise RuntimeError(f"Bash worker failed to source '{script_path}'")
+        if ready != 'ready 0\n':
+            setup_stderr = self._read_spool('err')
+            self.close()
+            raise RuntimeError(f"Bash worker setup failed for '{script_path}' "
+                               f"(status {ready.split()[1]}):\n{setup_stderr}")
+        # Output produced while sourcing, replayed in front of every job like the one-shot mode does
+        self.source_stdout = self._read_spool('out')
+        self.source_stderr = self._read_spool('err')
+
+    def _read_spool(self, name):
+        with open(os.path.join(self.directory, name), 'r') as spool:
+            return spool.read()
+
+    def run(self, job):
+        status = self._send(job)
+        stderr_lines = [_NESTED_TRACE_PATTERN.sub(r'\1', line) for line in self._read_spool('err').splitlines()]
+        # Nothing is traced before the call, so earlier lines are parse-time messages (e.g. heredoc warnings)
+        # that `bash -c` prints before it even sources the script
+        parse_messages = next((i for i, line in enumerate(stderr_lines) if line.startswith('+')), len(stderr_lines))
+        stderr = ''.join(f'{line}\n' for line in stderr_lines[:parse_messages]) + self.source_stderr + \
+                 ''.join(f'{line}\n' for line in stderr_lines[parse_messages:])
+        return status, self.source_stdout + self._read_spool('out'), stderr
+
+    def run_streaming(self, job, consume):
+        # Like run, but the trace is handed to consume line by line instead of being returned
+        status = self._send(job)
+        for line in self.source_stderr.splitlines():
+            consume(line)
+        with open(os.path.join(self.directory, 'err'), 'r') as spool:
+            for line in spool:
+                consume(_NESTED_TRACE_PATTERN.sub(r'\1', line.rstrip('\n')))
+        return status, self.source_stdout + self._read_spool('out')
+
+    def _send(self, job):
+        self.process.stdin.write(job + '\0')
+        self.process.stdin.flush()
+        status = self.process.stdout.readline()
+        if not status:
+            raise RuntimeError(f"Bash worker for '{self.script_path}' exited unexpectedly")
+        return int(status)
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.poll() is None:
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process.stdout.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class BashWorkerPool:
+    def __init__(self, script_path, size=1, preamble='', setup=''):
+        self.script_path = script_path
+        self.size = size
+        self.preamble = preamble
+        self.setup = setup
+        self._started = 0
+        self._idle = queue.LifoQueue()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self):
+        worker = None
+        with self._lock:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                start = self._started < self.size
+                if start:
+                    self._started += 1
+        if worker is None:
+            if start:
+                try:
+                    worker = BashWorker(self.script_path, self.preamble, self.setup)
+                except Exception:
+                    with self._lock:
+                        self._started -= 1
+                    raise
+                with self._lock:
+                    self._workers.append(worker)
+            else:
+                worker = self._idle.get()
+        try:
+            yield worker
+        finally:
+            if worker.is_alive():
+                self._idle.put(worker)
+            else:
+                # Let the next caller start a fresh one instead of handing out a dead process
+                worker.close()
+                with self._lock:
+                    self._workers.remove(worker)
+                    self._started -= 1
+
+    def close(self):
+        for worker in self._workers:
+            worker.close()
+        self._workers = []
+        self._started = 0
+        self._idle = queue.LifoQueue()
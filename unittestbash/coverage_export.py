@@ -0,0 +1,197 @@
+import argparse
+import bisect
+import json
+import os
+import sys
+import time
+from xml.sax.saxutils import escape, quoteattr
+
+# Coverage is passed around as {file: {function: (code line numbers, executed line numbers)}}, the shape of
+# BashFunctionAnalyzer.get_line_coverage() per file. Writers stream it to disk record by record.
+
+_FORMATS = {'.info': 'lcov', '.lcov': 'lcov', '.xml': 'cobertura', '.json': 'json'}
+JSON_FORMAT_VERSION = 1
+
+
+def guess_format(path):
+    return _FORMATS.get(os.path.splitext(path)[1].lower(), 'lcov')
+
+
+def _rate(covered, total):
+    return f'{covered / total:.4f}' if total else '1'
+
+
+def _function_start(code_lines):
+    return code_lines[0] if code_lines else 0
+
+
+def write_lcov(coverage, output, test_name=''):
+    output.write(f'TN:{test_name}\n')
+    for filename, functions in coverage.items():
+        output.write(f'SF:{filename}\n')
+        for func, (code_lines, executed_lines) in functions.items():
+            output.write(f'FN:{_function_start(code_lines)},{func}\n')
+        for func, (code_lines, executed_lines) in functions.items():
+            output.write(f'FNDA:{1 if executed_lines else 0},{func}\n')
+        output.write(f'FNF:{len(functions)}\n')
+        output.write(f'FNH:{sum(1 for _, executed_lines in functions.values() if executed_lines)}\n')
+        found = hit = 0
+        for func, (code_lines, executed_lines) in functions.items():
+            executed = set(executed_lines)
+            for line_number in code_lines:
+                output.write(f'DA:{line_number},{1 if line_number in executed else 0}\n')
+            found += len(code_lines)
+            hit += len(executed)
+        output.write(f'LF:{found}\nLH:{hit}\nend_of_record\n')
+
+
+def write_cobertura(coverage, output, source=None):
+    # Totals go in the root element, counting them is cheap compared to writing the lines
+    total = sum(len(code_lines) for functions in coverage.values() for code_lines, _ in functions.values())
+    covered = sum(len(executed_lines) for functions in coverage.values() for _, executed_lines in functions.values())
+    packages = {}
+    for filename in coverage:
+        packages.setdefault(os.path.dirname(filename) or '.', []).append(filename)
+
+    output.write('<?xml version="1.0" ?>\n')
+    output.write('<!DOCTYPE coverage SYSTEM "http://cobertura.sourceforge.net/xml/coverage-04.dtd">\n')
+    output.write(f'<coverage line-rate="{_rate(covered, total)}" branch-rate="0" lines-covered="{covered}" '
+                 f'lines-valid="{total}" branches-covered="0" branches-valid="0" complexity="0" '
+                 f'timestamp="{int(time.time() * 1000)}" version="unittestbash">\n')
+    output.write(f'\t<sources>\n\t\t<source>{escape(source or os.getcwd())}</source>\n\t</sources>\n')
+    output.write('\t<packages>\n')
+    for package, filenames in packages.items():
+        package_total = sum(len(code_lines) for filename in filenames for code_lines, _ in coverage[filename].values())
+        package_covered = sum(len(executed_lines) for filename in filenames
+                              for _, executed_lines in coverage[filename].values())
+        output.write(f'\t\t<package name={quoteattr(package)} line-rate="{_rate(package_covered, package_total)}" '
+                     'branch-rate="0" complexity="0">\n\t\t\t<classes>\n')
+        for filename in filenames:
+            functions = coverage[filename]
+            file_total = sum(len(code_lines) for code_lines, _ in functions.values())
+            file_covered = sum(len(executed_lines) for _, executed_lines in functions.values())
+            output.write(f'\t\t\t\t<class name={quoteattr(os.path.basename(filename))} filename={quoteattr(filename)} '
+                         f'line-rate="{_rate(file_covered, file_total)}" branch-rate="0" complexity="0">\n')
+            output.write('\t\t\t\t\t<methods>\n')
+            for func, (code_lines, executed_lines) in functions.items():
+                executed = set(executed_lines)
+                output.write(f'\t\t\t\t\t\t<method name={quoteattr(func)} signature="" '
+                             f'line-rate="{_rate(len(executed), len(code_lines))}" branch-rate="0" complexity="0">\n'
+                             '\t\t\t\t\t\t\t<lines>\n')
+                for line_number in code_lines:
+                    output.write(f'\t\t\t\t\t\t\t\t<line number="{line_number}" '
+                                 f'hits="{1 if line_number in executed else 0}"/>\n')
+                output.write('\t\t\t\t\t\t\t</lines>\n\t\t\t\t\t\t</method>\n')
+            output.write('\t\t\t\t\t</methods>\n\t\t\t\t\t<lines>\n')
+            for func, (code_lines, executed_lines) in functions.items():
+                executed = set(executed_lines)
+                for line_number in code_lines:
+                    output.write(f'\t\t\t\t\t\t<line number="{line_number}" '
+                                 f'hits="{1 if line_number in executed else 0}"/>\n')
+            output.write('\t\t\t\t\t</lines>\n\t\t\t\t</class>\n')
+        output.write('\t\t\t</classes>\n\t\t</package>\n')
+    output.write('\t</packages>\n</coverage>\n')
+
+
+def write_json(coverage, output):
+    # {"version": 1, "files": {file: {function: {"lines": [...], "executed": [...]}}}}
+    output.write(f'{{"version": {JSON_FORMAT_VERSION}, "files": {{')
+    for file_index, (filename, functions) in enumerate(coverage.items()):
+        output.write(f'{", " if file_index else ""}{json.dumps(filename)}: {{')
+        for function_index, (func, (code_lines, executed_lines)) in enumerate(functions.items()):
+            output.write(f'{", " if function_index else ""}{json.dumps(func)}: '
+                         f'{{"lines": {json.dumps(list(code_lines))}, "executed": {json.dumps(list(executed_lines))}}}')
+        output.write('}')
+    output.write('}}\n')
+
+
+_WRITERS = {'lcov': write_lcov, 'cobertura': write_cobertura, 'json': write_json}
+
+
+def write_coverage(coverage, path, format=None):
+    # LCOV (.info), Cobertura (.xml) or JSON (.json), the format follows the extension unless it is given
+    with open(path, 'w', encoding='utf-8') as output:
+        _WRITERS[format or guess_format(path)](coverage, output)
+
+
+def read_json(path):
+    with open(path, 'r', encoding='utf-8') as coverage_file:
+        data = json.load(coverage_file)
+    if data.get('version') != JSON_FORMAT_VERSION:
+        raise ValueError(f"Unsupported coverage file version in '{path}'")
+    return {filename: {func: (entry['lines'], entry['executed']) for func, entry in functions.items()}
+            for filename, functions in data['files'].items()}
+
+
+def read_lcov(path):
+    # Functions are not delimited in LCOV, a line belongs to the function starting last before it
+    coverage = {}
+    with open(path, 'r', encoding='utf-8') as coverage_file:
+        filename, starts, lines = None, {}, []
+        for line in coverage_file:
+            record, _, value = line.rstrip('\n').partition(':')
+            if record == 'SF':
+                filename, starts, lines = value, {}, []
+            elif record == 'FN':
+                start, _, func = value.partition(',')
+                starts[func] = int(start)
+            elif record == 'DA':
+                line_number, hits = value.split(',')[:2]
+                lines.append((int(line_number), int(hits)))
+            elif record == 'end_of_record' and filename is not None:
+                ordered = sorted(starts.items(), key=lambda item: item[1])
+                start_lines = [start for _, start in ordered]
+                functions = {func: ([], []) for func, _ in ordered}
+                for line_number, hits in lines:
+                    owner = bisect.bisect_right(start_lines, line_number) - 1
+                    if owner < 0:
+                        continue  # Outside of any function, the analyzer doesn't count those either
+                    code_lines, executed_lines = functions[ordered[owner][0]]
+                    code_lines.append(line_number)
+                    if hits:
+                        executed_lines.append(line_number)
+                coverage[filename] = functions
+                filename = None
+    return coverage
+
+
+def read_coverage(path):
+    format = guess_format(path)
+    if format == 'json':
+        return read_json(path)
+    if format == 'lcov':
+        return read_lcov(path)
+    raise ValueError(f"Can't read {format} coverage from '{path}', use LCOV or JSON shards")
+
+
+def merge_coverage(coverages):
+    # Union of the code and executed lines: every input only adds its lines to one pair of sets per file and
+    # function, made the first time the function shows up. Each union is sorted once, for the output
+    merged = {}
+    for coverage in coverages:
+        for filename, functions in coverage.items():
+            merged_functions = merged.get(filename)
+            if merged_functions is None:
+                merged_functions = merged[filename] = {}
+            for func, (code_lines, executed_lines) in functions.items():
+                entry = merged_functions.get(func)
+                if entry is None:
+                    entry = merged_functions[func] = (set(), set())
+                entry[0].update(code_lines)
+                entry[1].update(executed_lines)
+    return {filename: {func: (sorted(code), sorted(executed & code)) for func, (code, executed) in functions.items()}
+            for filename, functions in merged.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merge unittestbash coverage files (LCOV or JSON) of CI shards")
+    parser.add_argument('inputs', nargs='+')
+    parser.add_argument('-o', '--output', required=True)
+    parser.add_argument('--format', choices=sorted(_WRITERS), help="Guessed from the output extension by default")
+    args = parser.parse_args(argv)
+
+    write_coverage(merge_coverage(read_coverage(path) for path in args.inputs), args.output, args.format)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+import asyncio
+import os
+import time
+
+from .mocks import BashMocks
+from .unittestbash import LineSet
+
+# `read` for the exploration runs: a read past the end of the input fails as usual once, the next one ends the
+# run (with status 0, so its coverage counts), otherwise a menu loop waiting for its quit command never ends
+_READ_STUB = ('builtin read "$@" && return 0; __ubash_read_status=$?; '
+              'if (( ++__ubash_eof_reads < 2 )); then return $__ubash_read_status; fi; exit 0')
+
+
+def _reachable_literals(analyzer, function_name):
+    # Literals of the function and of every function it may call, '' (an empty answer) included
+    literals = {''}
+    reached = set()
+    pending = [function_name]
+    while pending:
+        name = pending.pop()
+        if name not in reached:
+            reached.add(name)
+            literals.update(analyzer.function_inputs.get(name, ((), 0))[0])
+            pending.extend(analyzer.function_calls.get(name, ()))
+    return sorted(literals)
+
+
+def _mutations(candidate, literals, arguments, max_reads):
+    # One more read value, or one argument set to a literal
+    args, reads = candidate
+    if len(reads) < max_reads:
+        for literal in literals:
+            yield args, reads + (literal,)
+    for position in range(arguments):
+        padded = args + ('',) * (position + 1 - len(args))
+        for literal in literals:
+            yield padded[:position] + (literal,) + padded[position + 1:], reads
+
+
+async def explore_inputs_async(analyzer, function_name, time_budget=30.0, timeout=5.0, max_concurrency=None,
+                               max_reads=8, **run_kwargs):
+    # Coverage guided search for the inputs of a function: the values its case patterns and comparisons look for
+    # (see BashFunctionAnalyzer.function_inputs) are tried as read values (mock_read_values) and as arguments
+    # (args). An input is kept when its run adds executed lines or branch arms, and is then extended by one more
+    # value. Stops when nothing is left to try or after time_budget seconds. run_kwargs go to every run
+    # (mock_commands, virtual_time=True, ...). Returns the kept inputs as run_function keyword arguments
+    if function_name not in analyzer.functions_info:
+        print(f"No function named '{function_name}' found.")
+        return []
+    deadline = time.monotonic() + time_budget
+    literals = _reachable_literals(analyzer, function_name)
+    arguments = analyzer.function_inputs.get(function_name, ((), 0))[1]
+    mocks = BashMocks()
+    user_mocks = run_kwargs.pop('mocks', None)
+    if user_mocks:
+        mocks.commands.update(user_mocks.commands)
+        mocks.variables.update(user_mocks.variables)
+    mocks.mock('read', script=_READ_STUB)
+    semaphore = asyncio.Semaphore(max_concurrency or os.cpu_count())
+
+    async def run(candidate):
+        args, reads = candidate
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        return await analyzer.run_function_async(function_name, timeout=min(timeout, remaining), semaphore=semaphore,
+                                                 args=list(args), mock_read_values=list(reads), mocks=mocks,
+                                                 **run_kwargs)
+
+    covered_lines = LineSet()
+    covered_branches = set()
+    kept = []
+    pending = [((), ())]
+    seen = set(pending)
+    chunk = (max_concurrency or os.cpu_count()) * 4
+    while pending and time.monotonic() < deadline:
+        batch, pending = pending[:chunk], pending[chunk:]
+        results = await asyncio.gather(*(run(candidate) for candidate in batch), return_exceptions=True)
+        for candidate, result in zip(batch, results):
+            if result is None or isinstance(result, BaseException):
+                continue  # Timed out, or the budget is spent
+            new_lines = result.executed_lines - covered_lines
+            new_branches = result.executed_branches - covered_branches
+            if not new_lines and not new_branches:
+                continue
+            covered_lines |= new_lines
+            covered_branches |= new_branches
+            kept.append(candidate)
+            for mutation in _mutations(candidate, literals, arguments, max_reads):
+                if mutation not in seen:
+                    seen.add(mutation)
+                    pending.append(mutation)
+    return [{'args': list(args), 'mock_read_values': list(reads)} for args, reads in kept]
+
+
+def explore_inputs(analyzer, function_name, **options):
+    # explore_inputs_async for code without an event loop
+    return asyncio.run(explore_inputs_async(analyzer, function_name, **options))
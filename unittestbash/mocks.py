@@ -0,0 +1,125 @@
+import atexit
+import hashlib
+import os
+import re
+import shlex
+import shutil
+import tempfile
+import threading
+
+# Compiled mock sets are written once per content, in a directory of the process made by mkdtemp (mode 0o700)
+# and removed at exit. Runs source these files: in a shared directory with predictable names, anyone could plant
+# one first
+_COMPILED = {}  # digest -> preamble path
+_COMPILED_LOCK = threading.Lock()
+_MOCKS_DIRECTORY = []  # The directory once made
+
+_MOCK_NAME_PATTERN = re.compile(r'^[A-Za-z_][\w.:+-]*$')
+_VARIABLE_NAME_PATTERN = re.compile(r'^[A-Za-z_]\w*$')
+
+# Every mock appends one byte per call to <run directory>/<name>.count, on a file descriptor of its own opened with
+# O_APPEND: the write lands at the end of the file in one step, and the offset of the descriptor after it (read in
+# /proc/<pid>/fdinfo) numbers the call, whatever the number of calls before, in subshells, pipelines and background
+# jobs alike. Without /proc (not Linux) the lines of the file are counted instead, which costs O(calls) and can give
+# two concurrent background calls the same number. Every call then logs "name\0argc\0args...\0" to
+# <run directory>/calls. That bookkeeping is hidden from the trace, fd 4 keeps the real stderr for the body of the
+# mock. The builtins are called as such, read and printf can be mocked too
+_MOCK_TEMPLATE = (
+    '{name}() {{ {{ local __ubash_call __ubash_calls; '
+    '{{ builtin printf "\\n" >&5; builtin read -r __ubash_calls __ubash_call < "/proc/$BASHPID/fdinfo/5" || '
+    '{{ builtin mapfile -t __ubash_calls < "$__ubash_mock_dir/{name}.count"; '
+    '__ubash_call=${{#__ubash_calls[@]}}; }}; }} 5>> "$__ubash_mock_dir/{name}.count"; '
+    '__ubash_call=$((__ubash_call - 1)); '
+    'builtin printf "%s\\0" {quoted_name} "$#" "$@" >> "$__ubash_mock_dir/calls"; '
+    '{dispatch}'
+    '}} 4>&2 2>/dev/null; }}\n'
+)
+
+
+def _effect_script(effect):
+    # An effect is the output of a call, (output, status) or a bash snippet given as {'script': ...}
+    if isinstance(effect, dict):
+        return f'{{ {effect["script"]}\n}} 2>&4; '
+    output, status = effect if isinstance(effect, tuple) else (effect, 0)
+    script = f'printf "%s\\n" {shlex.quote(str(output))}; ' if output is not None else ''
+    return script + f'return {int(status)}; '
+
+
+class BashMocks:
+    # Commands and variables to mock, compiled into a bash file that the run sources instead of defining
+    # everything on the command line. The calls of the mocks are logged aside, see BashRunResult.mock_calls
+    def __init__(self):
+        self.commands = {}
+        self.variables = {}
+        self._path = None
+
+    def mock(self, name, output=None, status=0, side_effect=None, script=None):
+        # output/status for every call; side_effect: one effect per call (an output, an (output, status) tuple
+        # or {'script': ...}), the last one repeats; script: a bash snippet run with the arguments of the call
+        if not _MOCK_NAME_PATTERN.match(name):
+            raise ValueError(f"Can't mock command '{name}'")
+        if script is not None:
+            effects = [{'script': script}]
+        elif side_effect is not None:
+            effects = list(side_effect)
+            if not effects:
+                raise ValueError(f"Empty side_effect for mock '{name}'")
+        else:
+            effects = [(output, status)]
+        self.commands[name] = effects
+        self._path = None
+        return self
+
+    def set_variable(self, name, value):
+        if not _VARIABLE_NAME_PATTERN.match(name):
+            raise ValueError(f"Can't mock variable '{name}'")
+        self.variables[name] = str(value)
+        self._path = None
+        return self
+
+    def compile(self):
+        lines = ['__ubash_mock_dir=$1\n']
+        for name, value in self.variables.items():
+            lines.append(f'export {name}={shlex.quote(value)}\n')
+        for name, effects in self.commands.items():
+            if len(effects) == 1:
+                dispatch = _effect_script(effects[0])
+            else:
+                cases = ''.join(f'{call}) {_effect_script(effect)};; ' for call, effect in enumerate(effects[:-1]))
+                dispatch = f'case $__ubash_call in {cases}*) {_effect_script(effects[-1])};; esac; '
+            lines.append(_MOCK_TEMPLATE.format(name=name, quoted_name=shlex.quote(name), dispatch=dispatch))
+        return ''.join(lines)
+
+    def path(self):
+        # The compiled file, shared by every mock set with the same content
+        if self._path is None:
+            script = self.compile()
+            digest = hashlib.sha256(script.encode()).hexdigest()
+            with _COMPILED_LOCK:
+                path = _COMPILED.get(digest)
+                if path is None:
+                    if not _MOCKS_DIRECTORY:
+                        _MOCKS_DIRECTORY.append(tempfile.mkdtemp(prefix='unittestbash-mocks-'))
+                        atexit.register(shutil.rmtree, _MOCKS_DIRECTORY[0], True)
+                    path = os.path.join(_MOCKS_DIRECTORY[0], f'{digest}.sh')
+                    with open(path, 'x') as mocks_file:  # Only ever a file written here
+                        mocks_file.write(script)
+                    _COMPILED[digest] = path
+            self._path = path
+        return self._path
+
+
+def read_mock_calls(run_directory):
+    # [(name, [args]), ...] in call order
+    try:
+        with open(os.path.join(run_directory, 'calls'), 'rb') as calls_file:
+            fields = calls_file.read().decode(errors='replace').split('\0')
+    except OSError:
+        return []
+    calls = []
+    position = 0
+    while position + 1 < len(fields):
+        name, argc = fields[position], int(fields[position + 1])
+        calls.append((name, fields[position + 2:position + 2 + argc]))
+        position += 2 + argc
+    return calls
@@ -0,0 +1,83 @@
+import re
+
+# run_function(profile=True) puts the time, the source file and the function stack in front of the usual PS4
+# fields: "+ <EPOCHREALTIME>\x1f<BASH_SOURCE>\x1f<FUNCNAME[*]>\x1f line N: command". The profile fields are
+# stripped again before the trace reaches the analyzer, which sees "+ line N: command" as always.
+# It is set after the source (and setup), only the call itself is profiled.
+PROFILE_PS4 = "{ PS4=$'+ ${EPOCHREALTIME}\\x1f${BASH_SOURCE[0]}\\x1f${FUNCNAME[*]}\\x1f'\"${PS4:1}\"; } 2>/dev/null"
+
+_PROFILE_TRACE_PATTERN = re.compile(r'^(\++) ([^\x1f]*)\x1f([^\x1f]*)\x1f([^\x1f]*)\x1f (.*)$')
+_LINE_NUMBER_PATTERN = re.compile(r'line (\d+): ')
+
+
+class BashProfile:
+    # Hit counts and wall time per line, per function and per call stack. A traced command is charged with
+    # the time until the next traced command, like most xtrace based bash profilers do
+    def __init__(self):
+        self.lines = {}  # (source, line number) -> [hits, seconds]
+        self.functions = {}  # function -> [hits, seconds]
+        self.stacks = {}  # "outer;inner" -> seconds
+        self._previous = None  # (time, line key, function, stack) of the last traced command
+
+    def feed(self, line):
+        # Records a trace line and returns it without the profile fields
+        match = _PROFILE_TRACE_PATTERN.match(line)
+        if not match:
+            return line
+        depth, timestamp, source, function_stack, trace = match.groups()
+        line_number = _LINE_NUMBER_PATTERN.match(trace)
+        try:
+            now = float(timestamp.replace(',', '.'))  # EPOCHREALTIME follows the locale decimal point
+        except ValueError:
+            return f'{depth} {trace}'
+        functions = function_stack.split()
+        stack = ';'.join(reversed(functions)) or '(top level)'
+        key = (source, int(line_number.group(1)) if line_number else 0)
+        self._charge(now)
+        self._previous = (now, key, functions[0] if functions else '(top level)', stack)
+        return f'{depth} {trace}'
+
+    def _charge(self, now):
+        if self._previous is None:
+            return
+        started, key, function, stack = self._previous
+        elapsed = max(now - started, 0.0)
+        for table, entry_key in ((self.lines, key), (self.functions, function)):
+            entry = table.setdefault(entry_key, [0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+        self.stacks[stack] = self.stacks.get(stack, 0.0) + elapsed
+
+    def finish(self):
+        # The last command is charged with nothing, there is no later timestamp to measure it with
+        if self._previous is not None:
+            self._charge(self._previous[0])
+            self._previous = None
+        return self
+
+    def merge(self, other):
+        for table, other_table in ((self.lines, other.lines), (self.functions, other.functions)):
+            for key, (hits, seconds) in other_table.items():
+                entry = table.setdefault(key, [0, 0.0])
+                entry[0] += hits
+                entry[1] += seconds
+        for stack, seconds in other.stacks.items():
+            self.stacks[stack] = self.stacks.get(stack, 0.0) + seconds
+        return self
+
+    def folded_stacks(self):
+        # flamegraph.pl / speedscope input: "outer;inner <microseconds>" per line
+        return [f'{stack} {round(seconds * 1_000_000)}' for stack, seconds in sorted(self.stacks.items())]
+
+    def write_folded(self, path):
+        with open(path, 'w') as folded_file:
+            for folded_line in self.folded_stacks():
+                folded_file.write(f'{folded_line}\n')
+
+    def show(self, top=20):
+        print("Hottest lines:")
+        for (source, line_number), (hits, seconds) in sorted(self.lines.items(), key=lambda item: -item[1][1])[:top]:
+            print(f" - {source or '(command line)'}:{line_number}: {hits} hits, {seconds * 1000:.3f} ms")
+        print("Functions:")
+        for function, (hits, seconds) in sorted(self.functions.items(), key=lambda item: -item[1][1])[:top]:
+            print(f" - {function}: {hits} lines run, {seconds * 1000:.3f} ms")
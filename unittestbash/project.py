@@ -0,0 +1,113 @@
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from .coverage_export import write_coverage
+from .unittestbash import BashFunctionAnalyzer, _PARSE_CACHE
+
+# Trace line of a sourced file, see BashFunctionAnalyzer(trace_sources=True): "+ lib/net.sh line 12: curl ..."
+_SOURCED_TRACE_PATTERN = re.compile(r'^\++ (.+?) line (\d+): ')
+
+
+def _parse_script(script_path):
+    # Runs in a worker process, the parse result is sent back to seed the parse cache of the parent
+    BashFunctionAnalyzer(script_path)._parse_script()
+    path = os.path.abspath(script_path)
+    return path, _PARSE_CACHE[path]
+
+
+class BashProjectAnalyzer:
+    def __init__(self, root, pattern='*.sh', workers=None, **analyzer_options):
+        self.root = os.path.abspath(root)
+        self.pattern = pattern
+        self.workers = workers
+        # Passed to every BashFunctionAnalyzer (persistent, workers, persist_parse_cache, ...)
+        self.analyzer_options = analyzer_options
+        self._scripts = None
+        self.analyzers = {}
+        # Line numbers executed in files other than the one whose function was run, keyed by absolute path
+        self.sourced_lines = {}
+        self._lock = threading.Lock()
+
+    @property
+    def scripts(self):
+        # Discovered on first use, sorted so reports are stable
+        if self._scripts is None:
+            self._scripts = sorted(str(path) for path in Path(self.root).rglob(self.pattern) if path.is_file())
+        return self._scripts
+
+    def _resolve(self, script):
+        return os.path.abspath(os.path.join(self.root, script))
+
+    def parse_all(self):
+        # Parse every script in parallel up front, instead of one by one on first use
+        pending = [path for path in self.scripts if path not in _PARSE_CACHE]
+        if len(pending) > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                for path, parsed in executor.map(_parse_script, pending):
+                    _PARSE_CACHE.setdefault(path, parsed)
+        for path in self.scripts:
+            self.get_analyzer(path)
+
+    def get_analyzer(self, script):
+        path = self._resolve(script)
+        with self._lock:
+            analyzer = self.analyzers.get(path)
+            if analyzer is None:
+                analyzer = BashFunctionAnalyzer(path, trace_sources=True, **self.analyzer_options)
+                self.analyzers[path] = analyzer
+        return analyzer
+
+    def run_function(self, script, function_name, **kwargs):
+        result = self.get_analyzer(script).run_function(function_name, **kwargs)
+        if result is None:
+            return None
+        # The analyzer of the script only counts its own lines, the sourced ones are attributed here
+        sourced_lines = {}
+        for line in result.trace:
+            match = _SOURCED_TRACE_PATTERN.match(line)
+            if match:
+                sourced_lines.setdefault(match.group(1), set()).add(int(match.group(2)))
+        with self._lock:
+            for source, line_numbers in sourced_lines.items():
+                self.sourced_lines.setdefault(os.path.abspath(source), set()).update(line_numbers)
+        return result
+
+    def get_line_coverage(self):
+        # {script: {function: (code line numbers, executed line numbers)}}, scripts relative to the root
+        return {os.path.relpath(path, self.root):
+                    self.get_analyzer(path).get_line_coverage(self.sourced_lines.get(path, ()))
+                for path in sorted(set(self.scripts) | set(self.analyzers))}
+
+    def export_coverage(self, path, format=None):
+        # Every script in one file, see coverage_export.write_coverage for the formats
+        write_coverage(self.get_line_coverage(), path, format)
+
+    def get_coverage_report(self):
+        # {script: {'covered', 'total', 'percentage', 'functions': {function: {'covered', 'total', 'percentage'}}}}
+        report = {}
+        for script, line_coverage in self.get_line_coverage().items():
+            functions = {func: _coverage_entry(len(executed), len(code))
+                         for func, (code, executed) in sorted(line_coverage.items())}
+            report[script] = dict(
+                _coverage_entry(sum(entry['covered'] for entry in functions.values()),
+                                sum(entry['total'] for entry in functions.values())),
+                functions=functions)
+        return report
+
+    def show_coverage_report(self):
+        for script, entry in self.get_coverage_report().items():
+            print(f"{script}: {entry['covered']}/{entry['total']} lines ({entry['percentage']:.1f}%)")
+            for func, function_entry in entry['functions'].items():
+                print(f" - {func}: {function_entry['covered']}/{function_entry['total']} lines "
+                      f"({function_entry['percentage']:.1f}%)")
+
+    def close(self):
+        for analyzer in self.analyzers.values():
+            analyzer.close()
+
+
+def _coverage_entry(covered, total):
+    return {'covered': covered, 'total': total, 'percentage': (covered / total) * 100 if total else 0.0}
@@ -0,0 +1,195 @@
+import errno
+import fcntl
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import weakref
+from itertools import count
+
+from .mocks import read_mock_calls
+
+_FICLONE = 0x40049409  # ioctl of Linux btrfs, XFS, bcachefs...: the copy shares the blocks until one side writes
+_NO_REFLINK = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.ENOSYS)
+
+# Commands found on the host and put on the PATH of the runs, everything else the script runs is a shim
+DEFAULT_ALLOWED_COMMANDS = (
+    'awk', 'basename', 'bash', 'cat', 'chmod', 'cp', 'cut', 'date', 'dirname', 'env', 'expr', 'find', 'grep', 'head',
+    'ln', 'ls', 'mkdir', 'mktemp', 'mv', 'od', 'readlink', 'realpath', 'rm', 'sed', 'seq', 'sleep', 'sort', 'stat',
+    'tail', 'tee', 'touch', 'tr', 'uniq', 'wc', 'xargs',
+)
+
+# The shims log "name\0argc\0args...\0" like the mocks (see read_mock_calls) and succeed. Commands that aren't
+# found at all (not in the script, or given by a variable) end in command_not_found_handle, which does the same
+_SHIM = '#!{bash}\nbuiltin printf "%s\\0" "${{0##*/}}" "$#" "$@" >> "$UBASH_SANDBOX_CALLS"\nexit 0\n'
+_NOT_FOUND_HANDLE = ('command_not_found_handle() { { builtin printf "%s\\0" "$1" "$(($# - 1))" "${@:2}" '
+                     '>> "$UBASH_SANDBOX_CALLS"; } 2>/dev/null; }; ')
+_PASSED_VARIABLES = ('LANG', 'LC_ALL', 'TZ')
+
+
+def _snapshot(directory, prefix, snapshot):
+    # relative path -> (size, mtime) of the files, the target of the links, None for the directories
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            path = prefix + entry.name
+            if entry.is_symlink():
+                snapshot[path] = os.readlink(entry.path)
+            elif entry.is_dir():
+                snapshot[path + '/'] = None
+                _snapshot(entry.path, path + '/', snapshot)
+            else:
+                status = entry.stat()
+                snapshot[path] = (status.st_size, status.st_mtime_ns)
+    return snapshot
+
+
+class BashSandboxRun:
+    # The files a sandboxed run created, modified and deleted (paths relative to the run directory, starting with
+    # work/, home/ or tmp/, directories end with /), and the calls of shimmed commands
+    def __init__(self, directory, environment):
+        self.directory = directory  # Removed after the run, unless BashSandbox(keep=True)
+        self.environment = environment
+        self.created = []
+        self.modified = []
+        self.deleted = []
+        self.calls = []  # (name, [args]) of every call of a command that isn't allowed
+
+    def _finish(self, before):
+        after = {}
+        for name in ('work', 'home', 'tmp'):
+            _snapshot(os.path.join(self.directory, name), f'{name}/', after)
+        self.created = sorted(after.keys() - before.keys())
+        self.deleted = sorted(before.keys() - after.keys())
+        self.modified = sorted(path for path, state in after.items()
+                               if path in before and state is not None and state != before[path])
+        self.calls = read_mock_calls(self.directory)
+
+
+class BashSandbox:
+    # Runs functions with run_function(sandbox=...) in a directory of their own: a private HOME, TMPDIR and
+    # working directory that holds a copy of the fixture directory, and a PATH of the allowed commands and of
+    # shims that record the calls of every other command. The fixture is copied once into a template, every run
+    # gets its files by reflink (shared blocks, where the filesystem supports it), hard link or copy.
+    # Not a security boundary: absolute paths (and the commands given by one) still reach the real system
+    def __init__(self, fixture=None, allowed_commands=DEFAULT_ALLOWED_COMMANDS, link='reflink', env=None, keep=False):
+        if link not in ('reflink', 'hardlink', 'copy'):
+            raise ValueError(f"Unknown link mode '{link}'")
+        # link='hardlink' shares the files with the template: a write in place (echo x > file) changes the
+        # template for the next runs, only use it for fixtures the scripts don't write to
+        self.link = link
+        self.env = dict(env or {})  # Variables set in every run, on top of HOME, TMPDIR, PATH, LANG, LC_ALL, TZ
+        self.keep = keep
+        self.bash = shutil.which('bash') or '/bin/bash'
+        self.directory = tempfile.mkdtemp(prefix='unittestbash-sandbox-')
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.directory, True)
+        self._reflink = link == 'reflink'  # Until the filesystem says otherwise
+        self._shim_directories = {}  # frozenset of names -> directory
+
+        self.template = os.path.join(self.directory, 'template')
+        if fixture:
+            shutil.copytree(fixture, self.template, symlinks=True)
+        else:
+            os.mkdir(self.template)
+        self._entries = []  # (relative path, lstat) of the template, directories first
+        for directory, directory_names, file_names in os.walk(self.template):
+            relative_directory = os.path.relpath(directory, self.template)
+            for name in directory_names + file_names:
+                relative_path = os.path.normpath(os.path.join(relative_directory, name))
+                self._entries.append((relative_path, os.lstat(os.path.join(directory, name))))
+        self._before = _snapshot(self.template, 'work/', {})
+
+        self.allowed_directory = os.path.join(self.directory, 'bin')
+        os.mkdir(self.allowed_directory)
+        self.allowed_commands = set()
+        for name in allowed_commands:
+            path = shutil.which(name)
+            if path:
+                os.symlink(path, os.path.join(self.allowed_directory, name))
+                self.allowed_commands.add(name)
+        self._shim_path = os.path.join(self.directory, 'shim')
+        with open(self._shim_path, 'w') as shim_file:
+            shim_file.write(_SHIM.format(bash=self.bash))
+        os.chmod(self._shim_path, 0o755)
+        self._run_numbers = count(1)
+        self._lock = threading.Lock()
+
+    def _shim_directory(self, names):
+        # One directory of links to the shim per set of command names, shared by the runs
+        names = frozenset(names) - self.allowed_commands
+        with self._lock:
+            directory = self._shim_directories.get(names)
+            if directory is None:
+                directory = os.path.join(self.directory, f'shims-{len(self._shim_directories)}')
+                os.mkdir(directory)
+                for name in names:
+                    os.symlink(self._shim_path, os.path.join(directory, name))
+                self._shim_directories[names] = directory
+        return directory
+
+    def _clone(self, source, destination, status):
+        if self.link == 'hardlink':
+            os.link(source, destination)
+            return
+        if self._reflink:
+            try:
+                with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+                    fcntl.ioctl(destination_file.fileno(), _FICLONE, source_file.fileno())
+            except OSError as error:
+                if error.errno not in _NO_REFLINK:
+                    raise
+                self._reflink = False  # ext4, tmpfs...: copies from now on
+                shutil.copyfile(source, destination)
+        else:
+            shutil.copyfile(source, destination)
+        os.chmod(destination, stat.S_IMODE(status.st_mode))
+        # The template times, any write of the run shows up as a change even within the same clock tick
+        os.utime(destination, ns=(status.st_atime_ns, status.st_mtime_ns))
+
+    def prepare(self, command_names=()):
+        # A fresh run directory; command_names are the external commands to shim, BashFunctionAnalyzer passes
+        # the ones its script runs (external_commands)
+        directory = os.path.join(self.directory, f'run-{os.getpid()}-{next(self._run_numbers)}')
+        work = os.path.join(directory, 'work')
+        for name in ('work', 'home', 'tmp'):
+            os.makedirs(os.path.join(directory, name))
+        for relative_path, status in self._entries:
+            source = os.path.join(self.template, relative_path)
+            destination = os.path.join(work, relative_path)
+            if stat.S_ISDIR(status.st_mode):
+                os.mkdir(destination, stat.S_IMODE(status.st_mode))
+            elif stat.S_ISLNK(status.st_mode):
+                os.symlink(os.readlink(source), destination)
+            else:
+                self._clone(source, destination, status)
+        environment = {name: os.environ[name] for name in _PASSED_VARIABLES if name in os.environ}
+        environment.update({
+            'HOME': os.path.join(directory, 'home'),
+            'TMPDIR': os.path.join(directory, 'tmp'),
+            'PATH': f'{self._shim_directory(command_names)}:{self.allowed_directory}',
+            'UBASH_SANDBOX_CALLS': os.path.join(directory, 'calls'),
+        })
+        environment.update(self.env)
+        return BashSandboxRun(directory, environment)
+
+    def preamble(self):
+        # Bash code run before the script is sourced
+        return _NOT_FOUND_HANDLE
+
+    def finish(self, sandbox_run):
+        sandbox_run._finish(self._before)
+
+    def cleanup(self, sandbox_run):
+        if not self.keep and sandbox_run.directory:
+            shutil.rmtree(sandbox_run.directory, ignore_errors=True)
+            sandbox_run.directory = None
+
+    def close(self):
+        # Removes the template and the run directories left by keep=True
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
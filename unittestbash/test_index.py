@@ -0,0 +1,135 @@
+import json
+import os
+import sys
+import threading
+import unittest
+from contextlib import contextmanager
+
+from .unittestbash import BashFunctionAnalyzer, _write_atomically
+
+_INDEX_FORMAT = 1
+_CURRENT_TEST = threading.local()
+
+
+def _reachable(function_calls, function_names):
+    # The functions and everything they may call, following the static call graph of the script
+    reached = set()
+    pending = list(function_names)
+    while pending:
+        function_name = pending.pop()
+        if function_name not in reached:
+            reached.add(function_name)
+            pending.extend(function_calls.get(function_name, ()))
+    return reached
+
+
+def _current_test():
+    # The test given to BashTestIndex.test(), or the unittest.TestCase method the call comes from
+    test_id = getattr(_CURRENT_TEST, 'test_id', None)
+    if test_id is not None:
+        return test_id
+    frame = sys._getframe(2)
+    while frame is not None:
+        test_case = frame.f_locals.get('self')
+        if isinstance(test_case, unittest.TestCase):
+            return test_case.id()
+        frame = frame.f_back
+    return None
+
+
+class BashTestIndex:
+    # Which test reached which functions, with the hash the function had then. A function is reached when its
+    # lines show up in the trace of a run, or when a reached function may call it. After an edit only the tests
+    # that reached a changed function need to run again, see select(). Kept as JSON between test runs
+    def __init__(self, path='.unittestbash-index.json'):
+        self.path = os.path.abspath(path)
+        self.tests = {}  # test id -> {script (relative to the index): {function: hash}}
+        self._recorded = set()  # Tests recorded in this session, their previous entry is gone
+        self._current_hashes = {}
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as index_file:
+                index = json.load(index_file)
+            if index.get('format') == _INDEX_FORMAT:
+                self.tests = index['tests']
+        except (OSError, ValueError):
+            pass  # No index yet, every test is selected
+
+    @contextmanager
+    def test(self, test_id):
+        # Runs of the block are recorded for test_id, for runners that aren't unittest
+        previous = getattr(_CURRENT_TEST, 'test_id', None)
+        _CURRENT_TEST.test_id = test_id
+        try:
+            yield self
+        finally:
+            _CURRENT_TEST.test_id = previous
+
+    def _script_key(self, script_path):
+        return os.path.relpath(os.path.abspath(script_path), os.path.dirname(self.path))
+
+    def record(self, analyzer, result):
+        # Called by BashFunctionAnalyzer.run_function for every run of an analyzer created with test_index=...
+        test_id = _current_test()
+        if test_id is None:
+            return
+        reached = _reachable(analyzer.function_calls, {result.function_name, *result.executed_lines.functions()})
+        reached.add('(top level)')
+        hashes = {name: analyzer.function_hashes[name] for name in reached if name in analyzer.function_hashes}
+        with self._lock:
+            if test_id not in self._recorded:
+                self._recorded.add(test_id)
+                self.tests[test_id] = {}
+            self.tests[test_id].setdefault(self._script_key(analyzer.script_path), {}).update(hashes)
+
+    def forget(self, test_id):
+        # E.g. for a failed test, so the next selection runs it again
+        with self._lock:
+            self.tests.pop(test_id, None)
+            self._recorded.discard(test_id)
+
+    def _hashes(self, script):
+        hashes = self._current_hashes.get(script)
+        if hashes is None:
+            script_path = os.path.join(os.path.dirname(self.path), script)
+            hashes = BashFunctionAnalyzer(script_path).function_hashes if os.path.isfile(script_path) else {}
+            self._current_hashes[script] = hashes
+        return hashes
+
+    def changed_functions(self):
+        # {script: {function, ...}} of the recorded functions whose code changed (or is gone) since it was recorded
+        self._current_hashes = {}
+        changed = {}
+        for scripts in self.tests.values():
+            for script, hashes in scripts.items():
+                current = self._hashes(script)
+                changed_names = {name for name, digest in hashes.items() if current.get(name) != digest}
+                if changed_names:
+                    changed.setdefault(script, set()).update(changed_names)
+        return changed
+
+    def affected_tests(self):
+        # Recorded tests that reached a function that changed since the test ran
+        changed = self.changed_functions()
+        return {test_id for test_id, scripts in self.tests.items()
+                if any(changed.get(script, set()) & hashes.keys() for script, hashes in scripts.items())}
+
+    def select(self, suite):
+        # A flat unittest.TestSuite of the tests that are affected or not in the index yet. Tests that don't run
+        # bash functions never get into the index and are always selected
+        affected = self.affected_tests()
+        selected = unittest.TestSuite()
+        pending = [suite]
+        while pending:
+            test = pending.pop(0)
+            if isinstance(test, unittest.TestSuite):
+                pending[:0] = list(test)
+            elif test.id() not in self.tests or test.id() in affected:
+                selected.addTest(test)
+        return selected
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock:
+            _write_atomically(self.path, lambda index_file: json.dump({'format': _INDEX_FORMAT, 'tests': self.tests},
+                                                                      index_file, indent=1, sort_keys=True))
@@ -1,136 +1,1081 @@
+import hashlib
+import io
+import os
 import re
+import shlex
+import shutil
+import signal
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import weakref
+from array import array
+from collections import deque
+from contextlib import contextmanager, nullcontext
 from functools import wraps
 
-def patch_bash(key, value=None, side_effect=None):
+from . import bash_parser
+from .bash_worker import BashWorkerPool, unescape_double_quoted
+from .mocks import read_mock_calls
+from .profiler import PROFILE_PS4, BashProfile
+
+# asyncio, concurrent.futures, pickle and the coverage writers are imported where they are used: a test module
+# importing unittestbash doesn't pay for them
+
+# Script parsing patterns
+_PARAM_PATTERN = re.compile(r'\$(\w+)')
+_CONTINUATION_PATTERN = re.compile(r'[ \t]*\\?\n\s*')  # Commands spanning lines are shown on one
+_NAME_PATTERN = re.compile(r'[A-Za-z_][\w.:-]*')
+_POSITIONAL_PATTERN = re.compile(r'\$\{?([1-9])')
+_GLOB_CLASS_PATTERN = re.compile(r'\[([^\]!^])[^\]]*\]')
+_COMPARISONS = frozenset(['==', '=', '!=', '-eq', '-ne'])
+_COMMAND_NAME_PATTERN = re.compile(r'^[A-Za-z_][\w.+-]*$')
+_SUBSTITUTED_COMMAND_PATTERN = re.compile(r'(?:\$\(|`|\|)\s*([A-Za-z_][\w.+-]*)')
+_ASSIGNMENT_WORD_PATTERN = re.compile(r'^[A-Za-z_]\w*(?:\[[^\]]*\])?\+?=')
+_COMMAND_PREFIXES = frozenset(['command', 'exec', 'nohup', 'xargs', '!'])
+_BASH_BUILTINS = frozenset(
+    '. : [ alias bg bind break builtin caller cd command compgen complete compopt continue declare dirs disown echo '
+    'enable eval exec exit export false fc fg getopts hash help history jobs kill let local logout mapfile popd '
+    'printf pushd pwd read readarray readonly return set shift shopt source suspend test times trap true type '
+    'typeset ulimit umask unalias unset wait'.split())
+_BASH_KEYWORDS = frozenset(
+    '! [[ ]] { } case coproc do done elif else esac fi for function if in select then time until while'.split())
+
+# Trace parsing patterns, for lines produced by PS4='+ line ${LINENO}: ', and by the PS4 of trace_sources=True
+# that puts the path of other files first: '+ lib.sh line N: '
+_TRACE_LINE_PATTERN = re.compile(r'^\+\+? (?:(.+?) )??(line \d{1,}:) (.+)$')
+_SOURCED_COMMAND_PATTERN = re.compile(r'\+ (.+?) line (\d+): ')
+_HARNESS_LINES = ('line 0:', 'line 1:', 'line 2:')  # The "bash -c" command line itself, not the script
+_SHOW_VARIABLE_PATTERN = re.compile(r'^\+ line [12]: echo var_(.+)=(.+)$')
+_LOCAL_VARIABLE_PATTERN = re.compile(r"(local |)\'?(\S+)=(\S+);?\'?$")
+
+# Worker pools of the batch_runs() block of the current thread, per analyzer
+_BATCH = threading.local()
+
+# Longest trace line run_function_async reads in one piece
+_ASYNC_LINE_LIMIT = 16 * 1024 * 1024
+
+@contextmanager
+def batch_runs():
+    # Inside the block every analyzer runs its functions in one bash process, which sources the script once;
+    # every run is a subshell of it
+    if getattr(_BATCH, 'pools', None) is not None:
+        yield  # Nested, the outer block owns the processes
+        return
+    _BATCH.pools = {}
+    try:
+        yield
+    finally:
+        pools, _BATCH.pools = _BATCH.pools, None
+        for pool in pools.values():
+            pool.close()
+
+def patch_bash(key, value=None, side_effect=None, batch=False):
+    # batch=True runs all side_effect values in one bash process (see batch_runs) and reports every failing
+    # value as a subTest, instead of stopping at the first one
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
             if side_effect:
-                for value_set in side_effect:
-                    kwargs[key] = value_set
-                    func(*args, **kwargs)
+                test_case = args[0] if batch and args and hasattr(args[0], 'subTest') else None
+                with batch_runs() if batch else nullcontext():
+                    for value_set in side_effect:
+                        kwargs[key] = value_set
+                        with test_case.subTest(**{key: value_set}) if test_case else nullcontext():
+                            func(*args, **kwargs)
             else:
                 if value: kwargs[key] = value
                 return func(*args, **kwargs)
         return wrapper
     return decorator
 
+# Parsed scripts shared by all analyzers of the process, keyed by absolute path
+_PARSE_CACHE = {}
+# What BashFunctionAnalyzer._parse_script sets, the analyzer parses its script the first time one is needed
+_PARSED_ATTRIBUTES = frozenset(['functions_info', 'code_lines', 'code_line_texts', 'global_variables', 'branches',
+                                'function_hashes', 'function_calls', 'function_inputs', 'external_commands',
+                                'total_lines', '_line_owners', '_branch_anchors'])
+# Bump when the parse result changes, so stale __pycache__ entries are ignored
+_PARSE_CACHE_FORMAT = 7
+
+def _parse_cache_path(script_path):
+    directory, name = os.path.split(script_path)
+    return os.path.join(directory, '__pycache__', f'{name}.unittestbash-{_PARSE_CACHE_FORMAT}.pickle')
+
+def _load_parse_cache(script_path):
+    import pickle
+    # Any file that doesn't load, whatever the error (truncated, written by an older unittestbash whose classes
+    # moved, not a pickle at all...), is a cache miss and the script is parsed again
+    try:
+        with open(_parse_cache_path(script_path), 'rb') as cache_file:
+            parsed = pickle.load(cache_file)
+    except Exception:
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+def _write_atomically(path, write, mode='w'):
+    # write(file) fills a temporary file of its own next to path, which is then renamed over it: a concurrent
+    # reader never sees half a file, and concurrent writers (threads or processes) never share a temporary file
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                                       prefix=f'{os.path.basename(path)}.', suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, mode) as output:
+            write(output)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+def _save_parse_cache(script_path, parsed):
+    import pickle
+    cache_path = _parse_cache_path(script_path)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        _write_atomically(cache_path, lambda cache_file: pickle.dump(parsed, cache_file,
+                                                                     protocol=pickle.HIGHEST_PROTOCOL), 'wb')
+    except OSError:
+        pass  # A read-only checkout just doesn't get a persistent cache
+
+def _input_sample(word):
+    # A value matching a case pattern or the operand of a comparison, None when it depends on the run
+    if not word or '$' in word or '`' in word or word in ('*', '[', ']]', '-eq', '-ne'):
+        return None
+    if len(word) > 1 and word[0] == word[-1] and word[0] in '\'"':
+        return word[1:-1]
+    if '[!' in word or '[^' in word:
+        return None
+    sample = _GLOB_CLASS_PATTERN.sub(r'\1', word).replace('*', '').replace('?', 'x')
+    return sample.replace('\\', '').replace('"', '').replace("'", '') or None
+
+class LineSet:
+    # Script line numbers per function, one int bitset per function (bit N = base line + N). Sets of runs are
+    # merged, compared and counted per function in O(lines of the function), whatever the size of the script
+    def __init__(self, lines=()):
+        self._functions = {}  # function name (interned) -> [base line, bits]
+        for function_name, line_number in lines:
+            self.add(function_name, line_number)
+
+    def _add_bits(self, function_name, base, bits):
+        entry = self._functions.get(function_name)
+        if entry is None:
+            self._functions[sys.intern(function_name)] = [base, bits]
+            return
+        if base < entry[0]:
+            entry[1] <<= entry[0] - base
+            entry[0] = base
+        entry[1] |= bits << (base - entry[0])
+
+    def add(self, function_name, line_number):
+        self._add_bits(function_name, line_number, 1)
+
+    def update(self, other):
+        for function_name, (base, bits) in other._functions.items():
+            self._add_bits(function_name, base, bits)
+        return self
+
+    def __ior__(self, other):
+        return self.update(other)
+
+    def __or__(self, other):
+        return self.copy().update(other)
+
+    def __sub__(self, other):
+        # Lines of self that other doesn't have, e.g. what a run added to the coverage of the previous ones
+        difference = LineSet()
+        for function_name, (base, bits) in self._functions.items():
+            other_entry = other._functions.get(function_name)
+            if other_entry is not None:
+                other_base, other_bits = other_entry
+                other_bits = other_bits << (other_base - base) if other_base >= base else other_bits >> (base - other_base)
+                bits &= ~other_bits
+            if bits:
+                difference._add_bits(function_name, base, bits)
+        return difference
+
+    def copy(self):
+        line_set = LineSet()
+        line_set._functions = {function_name: list(entry) for function_name, entry in self._functions.items()}
+        return line_set
+
+    def _normalized(self):
+        normalized = {}
+        for function_name, (base, bits) in self._functions.items():
+            if bits:
+                shift = (bits & -bits).bit_length() - 1
+                normalized[function_name] = (base + shift, bits >> shift)
+        return normalized
+
+    def __eq__(self, other):
+        return isinstance(other, LineSet) and self._normalized() == other._normalized()
+
+    def functions(self):
+        return [function_name for function_name, (_, bits) in self._functions.items() if bits]
+
+    def count(self, function_name=None):
+        if function_name is None:
+            return sum(bits.bit_count() for _, bits in self._functions.values())
+        entry = self._functions.get(function_name)
+        return entry[1].bit_count() if entry else 0
+
+    def lines(self, function_name):
+        # Sorted line numbers of the function
+        base, bits = self._functions.get(function_name, (0, 0))
+        line_numbers = []
+        while bits:
+            lowest = bits & -bits
+            line_numbers.append(base + lowest.bit_length() - 1)
+            bits ^= lowest
+        return line_numbers
+
+    def first(self, function_name):
+        line_numbers = self.lines(function_name)[:1]
+        return line_numbers[0] if line_numbers else None
+
+    def __contains__(self, item):
+        function_name, line_number = item
+        base, bits = self._functions.get(function_name, (0, 0))
+        return line_number >= base and bool(bits >> (line_number - base) & 1)
+
+    def __iter__(self):
+        for function_name in self.functions():
+            for line_number in self.lines(function_name):
+                yield function_name, line_number
+
+    def __len__(self):
+        return self.count()
+
+    def __bool__(self):
+        return any(bits for _, bits in self._functions.values())
+
+    def __repr__(self):
+        return f"LineSet({ {function_name: self.lines(function_name) for function_name in self.functions()} })"
+
+class _TraceProcessor:
+    # Classifies trace lines one at a time, adding executed lines to lines_set (a LineSet) under the function
+    # that holds them. process() returns the lines that are derived from the trace line (variable values,
+    # inline commands) for the output
+    def __init__(self, function_name, lines_set, func_pattern, line_owners, first_line):
+        self.function_name = function_name
+        self.lines_set = lines_set
+        self.func_pattern = func_pattern
+        self.line_owners = line_owners
+        self.first_line = first_line  # The call itself counts for the first line of the function
+        self.in_function = False
+        self._counted = set()  # Lines already added, loops trace the same lines over and over
+
+    def process(self, line):
+        #print(f"Debug: Line: {line}")
+        if not line.startswith('+'):
+            return ()
+        line_match = _TRACE_LINE_PATTERN.match(line)
+        if not line_match:
+            return ()
+
+        derived_lines = []
+        source, line_number, command = line_match.groups()
+        #print(f"Debug: Line to analyze: {line}")
+        # validate for function name OR variable echo
+        if line[1] == ' ' and source is None and line_number in _HARNESS_LINES:
+            #print(f"Debug: Line from external command: {line}")
+            # Validate for variable value
+            if command.startswith('echo var_'):
+                var_match = _SHOW_VARIABLE_PATTERN.match(line)
+                if var_match:
+                    derived_lines.append(f"+ line 0: variable {var_match.group(1)}={var_match.group(2)}")
+
+            # Validate for function name
+            if self.func_pattern.match(line):
+                self.in_function = True
+                self.lines_set.add(self.function_name, self.first_line)
+        elif self.in_function:
+            #print(f"Debug: Regular code line: {line}")
+            local_var_match = '=' in command and _LOCAL_VARIABLE_PATTERN.match(command)
+            if local_var_match:
+                derived_lines.append(f"+ line 0: variable {local_var_match.group(2)}={local_var_match.group(3)}")
+                #print(f"Debug: added variable: {local_var_match.group(2)}={local_var_match.group(3)}")
+
+            if line[1] == '+':
+                # Inline command ("++" from $( ... )), re-emitted as a regular trace line
+                derived_lines.append(f"+ {source} {line_number} {command}" if source else f"+ {line_number} {command}")
+                #print(f"Debug: added executed command to output: {command}")
+            elif source is None:  # Lines of sourced files are credited by BashProjectAnalyzer
+                if line_number not in self._counted:
+                    self._counted.add(line_number)
+                    executed_line = int(line_number[5:-1])
+                    owner = self.line_owners.get(executed_line)
+                    if owner:  # Lines that aren't code lines (e.g. an if test, a `for` header) don't count
+                        self.lines_set.add(owner, executed_line)
+                #print(f"Debug: added executed command: {command}")
+        return derived_lines
+
+def _traced_command(line):
+    # (line number, command, source) of a trace line, source is the file of the trace_sources=True lines of other
+    # files and None for the script itself. None for anything else
+    if line.startswith('+ line '):
+        line_number, separator, command = line[7:].partition(': ')
+        if separator and line_number.isdigit():
+            return int(line_number), command, None
+    elif line.startswith('+ '):
+        match = _SOURCED_COMMAND_PATTERN.match(line)
+        if match:
+            return int(match.group(2)), line[match.end():], match.group(1)
+    return None
+
+def _split_command(command):
+    # The words of a traced command as a tuple, None when shlex can't split it
+    try:
+        return tuple(shlex.split(command))
+    except ValueError:
+        return None
+
+class _CommandIndex:
+    # Every traced command of a run ("+ line N: <command>"), in trace order, grouped by its first word, so the
+    # assertions are lookups instead of a regex scan of the whole output. Commands of other files (trace_sources=True)
+    # are in it too, sources has their file
+    def __init__(self, lines=()):
+        self.commands = []
+        self.by_head = {}
+        self.sources = {}  # trace position -> file, for the commands of other files
+        self._texts = {}  # Loops repeat the same commands: text -> (the text stored once, its by_head positions)
+        self._positions_cache = {}
+        self._words = {}  # text -> its words as shlex splits them (None when it can't), see calls_with
+        for line in lines:
+            self.add(line)
+
+    def add(self, line):
+        traced_command = _traced_command(line)
+        if traced_command:
+            self.add_command(*traced_command)
+
+    def add_command(self, line_number, command, source=None):
+        entry = self._texts.get(command)
+        if entry is None:
+            head = command.partition(' ')[0]
+            head_positions = self.by_head.get(head)
+            if head_positions is None:
+                head_positions = self.by_head[head] = array('L')
+            entry = self._texts[command] = (command, head_positions)
+        command, head_positions = entry
+        position = len(self.commands)
+        self.commands.append((line_number, command))
+        head_positions.append(position)
+        if source is not None:
+            self.sources[position] = source
+        if self._positions_cache:
+            self._positions_cache.clear()
+
+    def positions(self, prefix):
+        # Trace positions of the commands starting with prefix
+        positions = self._positions_cache.get(prefix)
+        if positions is None:
+            head, separator, _ = prefix.partition(' ')
+            if separator:
+                positions = [position for position in self.by_head.get(head, ())
+                             if self.commands[position][1].startswith(prefix)]
+            else:
+                # The prefix ends inside the first word, any first word starting with it matches
+                positions = sorted(position for command_head, head_positions in self.by_head.items()
+                                   if command_head.startswith(prefix) for position in head_positions)
+            self._positions_cache[prefix] = positions
+        return positions
+
+    def count(self, prefix):
+        return len(self.positions(prefix))
+
+    def first(self, prefix):
+        # Trace position of the first command starting with prefix, None when there is none
+        positions = self.positions(prefix)
+        return positions[0] if positions else None
+
+    def calls(self, prefix):
+        return [self.commands[position] for position in self.positions(prefix)]
+
+    def calls_with(self, command, args):
+        # Positions of the calls of command with exactly these arguments, as xtrace quoted them. Every distinct
+        # command text is split once, and the positions are cached like those of positions()
+        key = (command, *args)
+        positions = self._positions_cache.get(key)
+        if positions is None:
+            commands, words_of = self.commands, self._words
+            positions = []
+            for position in self.by_head.get(command, ()):
+                text = commands[position][1]
+                words = words_of.get(text, False)
+                if words is False:
+                    words = words_of[text] = _split_command(text)
+                if words == key:
+                    positions.append(position)
+            self._positions_cache[key] = positions
+        return positions
+
+    def executed_branches(self, branch_anchors):
+        branches = _BranchTracker(branch_anchors)
+        for position, (line_number, _) in enumerate(self.commands):
+            if position not in self.sources:  # Line numbers of other files
+                branches.feed(line_number)
+        return branches.finish()
+
+class _BranchTracker:
+    # Arms taken in a run, from the order of the traced commands: once the test of a branch is traced, the
+    # next command of the same function tells which arm ran (commands of called functions are skipped)
+    def __init__(self, branch_anchors):
+        self.branch_anchors = branch_anchors  # line number -> branch, see _extract_branches
+        self.taken = set()
+        self.pending = None  # Branch whose test was the last traced command
+
+    def feed(self, line_number):
+        pending = self.pending
+        if pending:
+            start, end = pending['span']
+            if line_number in pending['conditions'] or not start <= line_number <= end:
+                return  # Still testing (elif included), or in a called function
+            arm = next((arm for arm in pending['arms']
+                        if arm['start'] is not None and arm['start'] <= line_number <= arm['end']), None)
+            if arm is None and pending['fallthrough'] is not None:
+                arm = pending['arms'][pending['fallthrough']]
+            if arm is not None:
+                self.taken.add(arm['id'])
+        self.pending = self.branch_anchors.get(line_number)
+
+    def finish(self):
+        pending = self.pending
+        if pending and pending['fallthrough'] is not None:
+            # The function returned right after the test
+            self.taken.add(pending['arms'][pending['fallthrough']]['id'])
+        return self.taken
+
+class _SpooledCommandIndex:
+    # The command index of run_function(stream=True): the commands go to an unnamed temporary file instead of
+    # memory and the lookups read them back, so a streamed run holds the same few kilobytes whatever its length.
+    # Branches are followed while the commands come in. Same lookups as _CommandIndex, each one a scan of the
+    # file (counts and first positions are cached per prefix)
+    def __init__(self, branch_anchors):
+        self._spool = tempfile.TemporaryFile('w+', encoding='utf-8', errors='surrogateescape', newline='\n')
+        weakref.finalize(self, self._spool.close)
+        self._branches = _BranchTracker(branch_anchors)
+        self._cache = {}
+        self.length = 0
+
+    def add(self, line):
+        traced_command = _traced_command(line)
+        if traced_command:
+            self.add_command(*traced_command)
+
+    def add_command(self, line_number, command, source=None):
+        # "N\0source\0command", bash strings can't hold a NUL
+        self._spool.write(f'{line_number}\0{source or ""}\0{command}\n')
+        if source is None:
+            self._branches.feed(line_number)
+        self.length += 1
+        if self._cache:
+            self._cache.clear()
+
+    def _records(self):
+        # (line number, command, source) of every traced command, read from the file one at a time
+        self._spool.flush()
+        self._spool.seek(0)
+        try:
+            for record in self._spool:
+                line_number, source, command = record[:-1].split('\0', 2)
+                yield int(line_number), command, source or None
+        finally:
+            self._spool.seek(0, os.SEEK_END)
+
+    @property
+    def commands(self):
+        return ((line_number, command) for line_number, command, _ in self._records())
+
+    @property
+    def sources(self):
+        return {position: source for position, (_, _, source) in enumerate(self._records()) if source}
+
+    def _matching(self, prefix):
+        for position, (line_number, command, _) in enumerate(self._records()):
+            if command.startswith(prefix):
+                yield position, line_number, command
+
+    def positions(self, prefix):
+        return [position for position, _, _ in self._matching(prefix)]
+
+    def count(self, prefix):
+        key = ('count', prefix)
+        if key not in self._cache:
+            self._cache[key] = sum(1 for _ in self._matching(prefix))
+        return self._cache[key]
+
+    def first(self, prefix):
+        key = ('first', prefix)
+        if key not in self._cache:
+            self._cache[key] = next((position for position, _, _ in self._matching(prefix)), None)
+        return self._cache[key]
+
+    def calls(self, prefix):
+        return [(line_number, command) for _, line_number, command in self._matching(prefix)]
+
+    def calls_with(self, command, args):
+        key = ('with', command, *args)
+        if key not in self._cache:
+            expected = key[1:]
+            words_of = {}  # Each distinct command text split once per scan
+            positions = []
+            for position, _, traced_command in self._matching(command):
+                if traced_command.partition(' ')[0] != command:
+                    continue
+                words = words_of.get(traced_command, False)
+                if words is False:
+                    words = words_of[traced_command] = _split_command(traced_command)
+                if words == expected:
+                    positions.append(position)
+            self._cache[key] = positions
+        return self._cache[key]
+
+    def executed_branches(self, branch_anchors):
+        return set(self._branches.finish())
+
+class _TraceStream:
+    # Streaming counterpart of _process_output_lines: the trace is consumed line by line and only a bounded
+    # tail of it is kept, with the last value of every variable. The traced commands are spooled to a file
+    def __init__(self, processor, tail_lines, branch_anchors):
+        self.processor = processor
+        self.tail = deque(maxlen=tail_lines)
+        self.variables = {}
+        self.command_index = _SpooledCommandIndex(branch_anchors)
+        self.rewrite = None  # e.g. BashProfile.feed, applied before anything else sees the line
+
+    def feed(self, line):
+        if self.rewrite:
+            line = self.rewrite(line)
+        self.tail.append(line)
+        pending = [line]
+        while pending:
+            line = pending.pop()
+            self.command_index.add(line)
+            for derived_line in self.processor.process(line):
+                if derived_line.startswith('+ line 0: variable '):
+                    self.variables[derived_line.partition('=')[0]] = derived_line
+                pending.append(derived_line)
+
+    def finish(self, stdout):
+        # The trace kept for the result: its tail and the variables
+        for line in stdout.splitlines():
+            self.command_index.add(line)
+        return list(self.tail) + list(self.variables.values())
+
+# run_function(virtual_time=...) replaces sleep, date, timeout and $SECONDS with a simulated clock: the
+# milliseconds elapsed since the call are kept in a file (__UBASH_CLOCK__), so sleeps in subshells count too,
+# and sleep only adds to it. The function bodies send their own trace to /dev/null (fd 4 is the real stderr),
+# the trace shows the calls as if the real commands ran
+_VIRTUAL_CLOCK = (
+    '__ubash_duration() { __ubash_duration_ms=0; local __ubash_arg __ubash_unit __ubash_frac; '
+    'for __ubash_arg in "$@"; do '
+    'if [[ $__ubash_arg =~ ^([0-9]*)\\.?([0-9]*)([smhd]?)$ && -n ${BASH_REMATCH[1]}${BASH_REMATCH[2]} ]]; then '
+    'case ${BASH_REMATCH[3]} in m) __ubash_unit=60;; h) __ubash_unit=3600;; d) __ubash_unit=86400;; '
+    '*) __ubash_unit=1;; esac; '
+    '__ubash_frac=${BASH_REMATCH[2]}000; '
+    '__ubash_duration_ms=$(( __ubash_duration_ms + (10#0${BASH_REMATCH[1]} * 1000 + 10#${__ubash_frac:0:3}) '
+    '* __ubash_unit )); '
+    'else echo "${FUNCNAME[1]}: invalid time interval \'$__ubash_arg\'" >&4; return 1; fi; done; }; '
+    'sleep() { { local __ubash_now; __ubash_duration "$@" || return 1; builtin read -r __ubash_now < __UBASH_CLOCK__; '
+    '__ubash_now=$(( __ubash_now + __ubash_duration_ms )); builtin printf "%s\\n" "$__ubash_now" > __UBASH_CLOCK__; '
+    'SECONDS=$(( __ubash_now / 1000 )); } 4>&2 2>/dev/null; }; '
+    # An explicit date (-d, -r, -f) is left alone, otherwise date shows the simulated now
+    'date() { { local __ubash_now; builtin read -r __ubash_now < __UBASH_CLOCK__; case " $* " in '
+    '*" -d"*|*" --date"*|*" -r"*|*" --reference"*|*" -f"*|*" --file"*|*" -s"*|*" --set"*) command date "$@" 2>&4;; '
+    '*) command date -d "@$(( __UBASH_START__ + __ubash_now / 1000 ))" "$@" 2>&4;; esac; } 4>&2 2>/dev/null; }; '
+    # The command runs to its end, when it took longer than the limit the clock is set back to the limit and
+    # 124 is returned like a real timeout
+    'timeout() { { local __ubash_start __ubash_now __ubash_status __ubash_limit; while [[ $1 == -* ]]; do '
+    'case $1 in -s|-k|--signal|--kill-after) shift 2;; *) shift;; esac; done; '
+    '__ubash_duration "$1" || return 125; __ubash_limit=$__ubash_duration_ms; shift; '
+    'builtin read -r __ubash_start < __UBASH_CLOCK__; "$@" 2>&4; __ubash_status=$?; builtin read -r __ubash_now < __UBASH_CLOCK__; '
+    'if (( __ubash_limit > 0 && __ubash_now - __ubash_start > __ubash_limit )); then '
+    'builtin printf "%s\\n" "$(( __ubash_start + __ubash_limit ))" > __UBASH_CLOCK__; '
+    'SECONDS=$(( (__ubash_start + __ubash_limit) / 1000 )); return 124; fi; '
+    'return $__ubash_status; } 4>&2 2>/dev/null; }; '
+    '{ SECONDS=0; } 2>/dev/null'
+)
+
+# BashFunctionAnalyzer(tracer='debug') records the commands with a DEBUG trap instead of xtrace, on a file
+# descriptor of its own. A record is "LINENO\x1fBASH_SOURCE\x1fFUNCNAME[*]\x1fBASH_SUBSHELL\x1fargs\x1fBASH_COMMAND\x1e":
+# the command about to run as written (before expansion), where it is and the function stack it runs in. At the
+# first line of a function of the script (the trap runs there when the function is entered) args holds the
+# arguments of the function, quoted by ${@@Q}. set -T hands the trap down to functions, command substitutions and
+# subshells. It is one echo per command, bash spends most of the time of a trap in the statements it runs.
+# "V\x1fname\x1fvalue\x1e" are the run_function(show_variables=...) values
+_DEBUG_RECORDER = (
+    "{ exec {__ubash_records}>>__UBASH_RECORDS__; __ubash_us=$'\\x1f'; __ubash_rs=$'\\x1e'; "
+    "__ubash_definitions=(__UBASH_DEFINITIONS__); set -T; "
+    "trap 'builtin echo -En \"$LINENO$__ubash_us$BASH_SOURCE$__ubash_us${FUNCNAME[*]}$__ubash_us$BASH_SUBSHELL"
+    "$__ubash_us${__ubash_definitions[LINENO]:+${@@Q}}$__ubash_us$BASH_COMMAND$__ubash_rs\" >&$__ubash_records' DEBUG; "
+    "} 2>/dev/null; "
+    "__ubash_show() { builtin echo -En \"V$__ubash_us$1$__ubash_us$2$__ubash_rs\" >&$__ubash_records; }; "
+)
+_QUOTED_WORD_PATTERN = re.compile(r"\$'(?P<ansi_c>(?:[^'\\]|\\.)*)'|'(?P<quoted>[^']*)'|\\(?P<escaped>.)|(?P<space>\s+)")
+_ANSI_C_ESCAPE_PATTERN = re.compile(r'\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)')
+_ANSI_C_ESCAPES = {'n': 10, 't': 9, 'r': 13, 'a': 7, 'b': 8, 'e': 27, 'E': 27, 'f': 12, 'v': 11}
+
+
+def _ansi_c_unquote(text):
+    # The content of $'...' as ${@@Q} writes it: escapes of bytes, non-ASCII characters included (\303\251)
+    pieces = []
+    position = 0
+    for match in _ANSI_C_ESCAPE_PATTERN.finditer(text):
+        pieces.append(text[position:match.start()].encode())
+        escape = match.group(1)
+        if escape[0] == 'x':
+            pieces.append(bytes([int(escape[1:], 16)]))
+        elif escape[0] in '01234567':
+            pieces.append(bytes([int(escape, 8) & 0xff]))
+        elif escape in _ANSI_C_ESCAPES:
+            pieces.append(bytes([_ANSI_C_ESCAPES[escape]]))
+        else:
+            pieces.append(escape.encode())
+        position = match.end()
+    pieces.append(text[position:].encode())
+    return b''.join(pieces).decode(errors='replace')
+
+
+def _quoted_words(text):
+    # The words of ${@@Q}: '...' and $'...' strings, with \' between them, separated by spaces
+    words = []
+    word = None
+    for match in _QUOTED_WORD_PATTERN.finditer(text):
+        kind = match.lastgroup
+        if kind == 'space':
+            if word is not None:
+                words.append(word)
+            word = None
+            continue
+        value = match.group(kind)
+        word = (word or '') + (_ansi_c_unquote(value) if kind == 'ansi_c' else value)
+    if word is not None:
+        words.append(word)
+    return words
+
+
+class BashCommandRecord:
+    # A command or a function call of a run_function call with BashFunctionAnalyzer(tracer='debug')
+    __slots__ = ('kind', 'line', 'source', 'functions', 'subshell', 'text', 'args')
+
+    def __init__(self, kind, line, source, functions, subshell, text, args=None):
+        self.kind = kind  # 'command' or 'call'
+        self.line = line  # Of the command, of the command that made the call for a 'call'
+        self.source = source  # The file of the line, '' for the run_function command line
+        self.functions = functions  # FUNCNAME, innermost first ('source' while a file is sourced)
+        self.subshell = subshell  # BASH_SUBSHELL, it grows in $( ), ( ) and pipelines
+        self.text = text  # The command as written (not expanded), the function name for a 'call'
+        self.args = args  # The arguments a function of the script got, None for other functions and commands
+
+    @property
+    def function(self):
+        return self.functions[0] if self.functions else '(top level)'
+
+    @property
+    def depth(self):
+        return len(self.functions)
+
+    def __repr__(self):
+        return f'BashCommandRecord({self.kind}, {self.source or "-"}:{self.line}, {self.function}, {self.text!r})'
+
+
+def _read_records(path, script_path, mocks_source=None):
+    # ([BashCommandRecord], [(name, value)]) of a records file. A function call is a record one function deeper
+    # than the previous record of its subshell (or of the enclosing one), it is made by that record. The harness (__ubash_*, the functions
+    # defined on the command line like the virtual clock, the BashMocks file) is left out, as it is out of the trace
+    try:
+        with open(path, 'rb') as records_file:
+            chunks = records_file.read().decode(errors='replace').split('\x1e')
+    except OSError:
+        return [], []
+    records = []
+    variables = []
+    callers = {}  # subshell -> (depth, line, source) of its last record
+    stacks = {}  # FUNCNAME[*] -> tuple, loops repeat the same few
+    for chunk in chunks:
+        if chunk.startswith('V\x1f'):
+            name, _, value = chunk[2:].partition('\x1f')
+            variables.append((name, value))
+            continue
+        fields = chunk.split('\x1f', 5)
+        if len(fields) != 6:
+            continue
+        line, source, functions, subshell, args, text = fields
+        line = int(line)
+        stack = stacks.get(functions)
+        if stack is None:
+            stack = stacks[functions] = tuple(functions.split())
+        functions = stack
+        subshell = int(subshell)
+        caller = callers.get(subshell) or callers.get(subshell - 1)  # The first command of a subshell
+        callers[subshell] = (len(functions), line, source)
+        if caller and len(functions) > caller[0] and not functions[0].startswith('__ubash'):
+            records.append(BashCommandRecord('call', caller[1], caller[2], functions, subshell, functions[0],
+                                             _quoted_words(args) if source == script_path else None))
+        if text.startswith('__ubash') or source == mocks_source or not source and functions:
+            continue
+        records.append(BashCommandRecord('command', line, source, functions, subshell, text))
+    return records, variables
+
+class _PreparedRun:
+    # The command of a run_function call and what the run leaves behind to read back and clean up
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.argv = []  # bash -c <script> bash <args>
+        self.call_script = ''  # The part of the script after the source, what the persistent workers run
+        self.args = []
+        self.stdin = None
+        self.profile = None
+        self.clock_path = None
+        self.mock_directory = None
+        self.started = None
+        self.sandbox = None  # The BashSandbox of the run, with the BashSandboxRun of its directory and environment
+        self.sandbox_run = None
+        self.records_path = None  # With tracer='debug'
+        self.script_path = None  # As sourced, the source of its records
+        self.mocks_source = None
+
+    def cleanup(self):
+        if self.records_path:
+            os.unlink(self.records_path)
+            self.records_path = None
+        if self.clock_path:
+            os.unlink(self.clock_path)
+            self.clock_path = None
+        if self.mock_directory:
+            shutil.rmtree(self.mock_directory, ignore_errors=True)
+            self.mock_directory = None
+        if self.sandbox_run:
+            self.sandbox.cleanup(self.sandbox_run)
+
+class BashRunResult:
+    # Outcome of a single run_function call, kept apart from the analyzer state so parallel runs can be asserted on.
+    # The analyzer only keeps the last result, the trace of a run is gone with its result
+    __slots__ = ('function_name', 'stdout', 'trace', 'status', 'executed_lines', 'command_index', 'virtual_time',
+                 'mock_calls', 'profile', 'executed_branches', 'duration', 'sandbox', 'records',
+                 '__weakref__')
+
+    def __init__(self, function_name, stdout, trace, status, executed_lines, command_index,
+                 virtual_time=None, mock_calls=(), profile=None):
+        self.function_name = function_name
+        self.stdout = stdout
+        # The stderr lines (xtrace and the rest) and the lines the analyzer derived from them ("+ line 0: variable
+        # name=value"). With run_function(stream=True) only the trace tail and the variables
+        self.trace = trace
+        self.status = status
+        self.executed_lines = executed_lines
+        self.command_index = command_index  # The traced commands, see get_calls
+        self.virtual_time = virtual_time  # Simulated seconds the run took, with run_function(virtual_time=...)
+        self.mock_calls = list(mock_calls)  # (name, [args]) of every call of a run_function(mocks=...) command
+        self.profile = profile  # BashProfile of the run, with run_function(profile=True)
+        self.executed_branches = set()  # Ids of the branch arms taken, see BashFunctionAnalyzer.branches
+        self.duration = None  # Wall clock seconds of the run, trace parsing included
+        self.sandbox = None  # BashSandboxRun with the file changes and shim calls, with run_function(sandbox=...)
+        self.records = []  # BashCommandRecord of every command and function call, with tracer='debug'
+
+    @property
+    def output(self):
+        # stdout then the trace, line by line
+        return self.stdout.splitlines() + self.trace
+
+    function_output = output
+
+    @property
+    def stderr(self):
+        # What the function wrote to stderr, without the trace
+        return '\n'.join(line for line in self.trace if not line.startswith('+'))
+
+    @property
+    def variables(self):
+        # {name: value} of the variables assigned in the function and of run_function(show_variables=...)
+        variables = {}
+        for line in self.trace:
+            if line.startswith('+ line 0: variable '):
+                name, _, value = line[19:].partition('=')
+                variables[name] = value
+        return variables
+
 class BashFunctionAnalyzer:
-    def __init__(self, script_path=None):
+    def __init__(self, script_path=None, persistent=False, workers=1, trace_tail=1000, persist_parse_cache=False,
+                 trace_sources=False, setup='', test_index=None, tracer='xtrace'):
         self.script_path = script_path
-        self.function_output = {}
-        self.global_variables = {}
+        self._parse_lock = threading.Lock()  # One parse per analyzer, whichever thread needs it first
+        # 'xtrace' parses the set -x trace, 'debug' records the commands with a DEBUG trap (see BashCommandRecord):
+        # exact lines, functions and call arguments, but the commands as written, before expansion
+        if tracer not in ('xtrace', 'debug'):
+            raise ValueError(f"Unknown tracer '{tracer}'")
+        self.tracer = tracer
+        # Bash code run right after the script is sourced, e.g. sourcing configuration or building fixtures.
+        # With persistent=True it runs once per worker and every run forks from the state it leaves
+        self.setup = setup
+        # trace_sources=True prefixes trace lines of other (sourced) files with their path: "+ lib.sh line N: ".
+        # Lines of this script keep the usual format, so only they count for its coverage. The script is known by
+        # the path it was given and by its absolute path, the one sandboxed runs source
+        self.trace_preamble = ''
+        if trace_sources:
+            script_paths = {script_path, os.path.abspath(script_path)}
+            keys = ' '.join(f'[{shlex.quote(path)}]=' for path in sorted(script_paths))
+            self.trace_preamble = (f"declare -A __ubash_sources=({keys} [_]=); "
+                                   "PS4='+ ${__ubash_sources[${BASH_SOURCE:-_}]-${BASH_SOURCE} }line ${LINENO}: '")
+        # Trace lines kept in function_output by run_function(stream=True)
+        self.trace_tail = trace_tail
+        # persistent=True keeps `workers` long-lived bash processes that source the script once
+        self.persistent = persistent
+        self.worker_pool = BashWorkerPool(script_path, size=workers, preamble=self.trace_preamble,
+                                          setup=setup) if persistent else None
+        if self.worker_pool:
+            weakref.finalize(self, self.worker_pool.close)  # Don't leave workers behind if close() is never called
+        self.last_result = None  # The last finished run, what the assertions check without result=
+        self._results = weakref.WeakValueDictionary()  # The last run of every function, while its result is alive
         self.func_variables = {}
         self.last_run_function = ""
-        self.executed_lines = set()  # To track executed lines
-        self.code_lines = set()
-        self.output = ""
-        self.status = 0
-        self.functions_info = self._extract_functions_info()
-        self.total_lines = self.get_code_lines_count()
+        self.executed_lines = LineSet()  # To track executed lines
+        self.executed_branches = set()  # Ids of the branch arms taken, see _extract_branches
+        self.profile = BashProfile()  # Accumulated over the run_function(profile=True) calls
+        self._lock = threading.Lock()
+        self._call_patterns = {}
+        # The parse result is cached per script (path, mtime, content hash), persist_parse_cache also keeps it
+        # in the __pycache__ directory next to the script for the next test run
+        self.persist_parse_cache = persist_parse_cache
+        # A BashTestIndex that records which functions every test reached, see test_index
+        self.test_index = test_index
+
+    def __getattr__(self, name):
+        # The script is parsed on first use of what the parse gives (functions_info, code_lines...), building
+        # an analyzer in a test module costs nothing until it runs or reports something
+        if name in _PARSED_ATTRIBUTES and '_parse_lock' in self.__dict__:
+            with self._parse_lock:
+                if name not in self.__dict__:  # Unless another thread parsed it while this one waited
+                    self._parse_script()
+            return self.__dict__[name]
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def _parse_script(self):
+        path = os.path.abspath(self.script_path)
+        script_stat = os.stat(path)
+        parsed = _PARSE_CACHE.get(path)
+        if parsed is None and self.persist_parse_cache:
+            parsed = _load_parse_cache(path)
+
+        if not parsed or (parsed['mtime'], parsed['size']) != (script_stat.st_mtime_ns, script_stat.st_size):
+            with open(path, 'rb') as script_file:
+                content = script_file.read()
+            digest = hashlib.sha256(content).hexdigest()
+            if not parsed or parsed['digest'] != digest:
+                # Decoded the same way as open(path, 'r') would
+                text = io.TextIOWrapper(io.BytesIO(content)).read()
+                nodes = bash_parser.walk(bash_parser.parse(text))
+                functions_info, code_lines, code_line_texts, global_variables = self._extract_functions_info(nodes,
+                                                                                                             text)
+                function_hashes, function_calls = self._extract_call_graph(nodes, text)
+                function_inputs = self._extract_inputs(nodes)
+                external_commands = self._extract_external_commands(nodes)
+                parsed = {'digest': digest, 'functions_info': functions_info,
+                          'branches': self._extract_branches(nodes, text), 'code_lines': code_lines,
+                          'code_line_texts': code_line_texts, 'global_variables': global_variables,
+                          'line_owners': {line_number: func for func, line_number in code_lines},
+                          'function_hashes': function_hashes, 'function_calls': function_calls,
+                          'function_inputs': function_inputs, 'external_commands': external_commands}
+            else:
+                parsed = dict(parsed)  # Touched but unchanged, only the stat part is refreshed
+            parsed['mtime'], parsed['size'] = script_stat.st_mtime_ns, script_stat.st_size
+            if self.persist_parse_cache:
+                _save_parse_cache(path, parsed)
+        _PARSE_CACHE[path] = parsed
+
+        # Every analyzer gets its own containers, the cached ones stay untouched. Nothing is set on the analyzer
+        # until all of it is ready: another thread sees either no parse at all or the whole of it
+        functions_info = {name: dict(info) for name, info in parsed['functions_info'].items()}
+        self.__dict__.update({
+            'functions_info': functions_info,
+            'code_lines': parsed['code_lines'].copy(),
+            'code_line_texts': parsed['code_line_texts'],
+            'global_variables': dict(parsed['global_variables']),
+            '_line_owners': parsed['line_owners'],  # Read only, shared with the cache
+            'branches': parsed['branches'],  # Read only, shared with the cache
+            'function_hashes': parsed['function_hashes'],  # Read only, shared with the cache
+            'function_calls': parsed['function_calls'],  # Read only, shared with the cache
+            'function_inputs': parsed['function_inputs'],  # Read only, shared with the cache
+            'external_commands': parsed['external_commands'],  # Read only, shared with the cache
+            '_branch_anchors': {line_number: branch for branch in parsed['branches']
+                                for line_number in branch['anchors']},
+            'total_lines': sum(info['lines_count'] for info in functions_info.values()),
+        })
 
     def get_code_lines_count(self):
         return sum(info['lines_count'] for info in self.functions_info.values())
 
-    def _extract_functions_info(self):
+    def _extract_functions_info(self, nodes, text):
+        # Code lines are the lines bash reports for the commands of a function (see bash_parser.Command), plus the
+        # definition line that the call itself covers. Tests of if/while/until written with [[ ]] or (( )) are
+        # control structures and don't count, the branch coverage looks after them
+        # Returns functions_info, the code lines (LineSet), their texts and the global variables
         functions_info = {}
-        with open(self.script_path, 'r') as script_file:
-            lines = script_file.readlines()
-            in_function = False
-            function_name = None
-            function_lines = []
-
-            for i, line in enumerate(lines):
-                # Match function definition with or without '{' on the same line
-                match_func = re.match(r'^\s*function\s+(\w+)\s*\(\s*\)\s*', line) or \
-                             re.match(r'^\s*(\w+)\s*\(\s*\)\s*', line)
-                # Match global variable definitions
-                match_var = re.match(r'^\s*([A-Za-z_][A-Za-z0-9_]*)\s*=\s*(.*)', line)
-
-                if match_func:
-                    if in_function:
-                        # Save previous function info before starting a new one
-                        functions_info[function_name] = {
-                            'params': self._extract_params(function_name, function_lines),
-                            'lines_count': len(function_lines)
-                        }
-
-                    function_name = match_func.group(1)
-                    in_function = True
-                    function_lines = []
-
-                    # Check if '{' is on the next line
-                    if not line.strip().endswith('{') and (i + 1 < len(lines) and lines[i + 1].strip() == '{'):
-                        continue  # Move to the next line to start capturing function content
-
-                # Capture function content if inside a function
-                if in_function:
-                    cleaned_line = line.split('#', 1)[0].rstrip() # remove comments to escape garbage content
-                    cleaned_line = cleaned_line.replace(';;','')
-                    stripped_line = cleaned_line.strip()
-                    if stripped_line and not stripped_line.startswith('#') and stripped_line != '}':
-                        # Split the line by '&&' and process each command
-                        commands = re.split(r' && | (?<!\|)\|(?!\|)', stripped_line)
-                        content_line = ""
-                        for command in commands:
-                            if not self._is_control_structure(command):
-                                content_line += command
-
-                        if content_line:  # Ensure the command is not empty
-                            function_lines.append(f"Line {i}: {content_line}\n")  # Keep newline for later use
-                            self.code_lines.add((function_name, f"Line {i+1}: {content_line}\n"))
-
-                # End function block if '}' is found
-                if in_function and line.strip() == '}':
-                    functions_info[function_name] = {
-                        'params': self._extract_params(function_name, function_lines),
-                        'lines_count': len(function_lines)
-                    }
-                    in_function = False
-
-                # Capture global variables if not in a function
-                if not in_function and match_var:
-                    variable_name = match_var.group(1)
-                    variable_value = match_var.group(2).strip()
-                    # Remove quotes if present
-                    variable_value = variable_value.strip('"').strip("'")
-                    self.global_variables[variable_name] = variable_value
-
-        return functions_info
-
-    def _is_control_structure(self, line):
-        # Strips leading text (like "line 365: ") before checking for control structures
-        line = re.sub(r'^[^:]*:\s*', '', line)  # Remove any prefix of the form "line N: "
-        #print(f"Debug: {line}")
-        # Checks if the line is a control structure and should be excluded
-        control_structures = [
-            #r'^\s*if.*?$',  # If statement
-            r'^\s*then.*?$',  # Then keyword
-            r'^\s*else.*?$',  # Else keyword
-            r'^\s*elif.*?$',  # Elif keyword
-            r'^\s*fi.*?$',  # Fi keyword
-            #r'^\s*while.*?$',  # For loop
-            r'^\s*for.*?$',  # For loop
-            r'^\s*do.*?$',  # Do keyword
-            r'^\s*done.*?$',  # Done keyword
-            r'^\s*case.*?$',  # Case statement
-            r'^\s*[a-zA-Z_][a-zA-Z0-9_]*\s*\|\s*[a-zA-Z_][a-zA-Z0-9_]*\)\s*$', # case option alone in line
-            r'^\"?[a-zA-Z0-9_*]*\"?\)$', # case option alone in line
-            r'^\s*esac.*?$',  # Esac keyword
-            r'^.*?\[\[\s.*\s?(?:<|>|<=|>=|<>|==|!=|-eq|-ne|-lt|-le|-gt|-ge)\s.*?\]\].*?$',  # Double brackets condition [[ ... ]]
-            #r'^.*?\[\s.*\s?(?:<|>|<=|>=|<>|==|!=|-eq|-ne|-lt|-le|-gt|-ge)\s.*?\].*?$',  # Single brackets condition [ ... ]
-            r'^.*?\(\(\s.*\s?(?:<|>|<=|>=|<>|==|!=|-eq|-ne|-lt|-le|-gt|-ge)\s.*?\)\).*?$',  # Double brackets condition (( ... ))
-            r'^.*?\(\s.*\s?(?:<|>|<=|>=|<>|==|!=|-eq|-ne|-lt|-le|-gt|-ge)\s.*?\).*?$'  # Single brackets condition ( ... )
-        ]
-        is_control = any(re.match(pattern, line) for pattern in control_structures)
-        #print(f"Debug: Control? - {is_control}")
-        return is_control
+        code_lines = LineSet()
+        code_line_texts = {}
+        global_variables = {}
+        source_lines = text.split('\n')
+        function_lines = {}
+        line_commands = {}
+        for node, function, condition in nodes:
+            node_type = type(node)
+            if node_type is bash_parser.Command:
+                if function is None:
+                    # Top level assignments are the global variables
+                    for variable_name, variable_value in bash_parser.assignments(node).items():
+                        global_variables[variable_name] = variable_value.strip().strip('"').strip("'")
+                elif node.kind == 'simple' or not condition:
+                    key = (function.name, node.line)
+                    commands = line_commands.get(key)
+                    if commands is None:
+                        line_commands[key] = [node]
+                    else:
+                        commands.append(node)
+            elif node_type is bash_parser.Function:
+                function_lines[node.name] = {node.line: source_lines[node.line - 1].strip()}
+                functions_info[node.name] = None
+
+        for (function_name, line_number), commands in line_commands.items():
+            # From the start of the line, so the text keeps its `if`, `while` or case pattern
+            source = text[text.rfind('\n', 0, commands[0].start) + 1:max(command.end for command in commands)].strip()
+            function_lines[function_name][line_number] = (_CONTINUATION_PATTERN.sub(' ', source) if '\n' in source
+                                                          else source)
+        for function_name, lines in function_lines.items():
+            # One bitset per function, see LineSet
+            base = min(lines)
+            bits = 0
+            for line_number in lines:
+                bits |= 1 << (line_number - base)
+            code_lines._add_bits(function_name, base, bits)
+            code_line_texts.update(lines)
+            functions_info[function_name] = {
+                'params': self._extract_params(function_name, [content for _, content in sorted(lines.items())]),
+                'lines_count': len(lines)
+            }
+        return functions_info, code_lines, code_line_texts, global_variables
+
+    def _extract_call_graph(self, nodes, text):
+        # {function: content hash} and {function: functions of the script it may call}. Any word naming a function
+        # counts as a call, $(...), trap and xargs included, so a function is never missed as a callee. The code
+        # outside the functions is hashed as '(top level)'
+        source_lines = text.split('\n')
+        function_names = {node.name for node, _, _ in nodes if type(node) is bash_parser.Function}
+        function_hashes = {}
+        function_words = {}  # The names used by the commands of every function, matched against function_names once
+        top_level = set(range(1, len(source_lines) + 1))
+        for node, function, _ in nodes:
+            node_type = type(node)
+            if node_type is bash_parser.Command:
+                if function is not None:
+                    function_words[function.name].update(_NAME_PATTERN.findall(' '.join(node.words)))
+            elif node_type is bash_parser.Function:
+                source = '\n'.join(source_lines[node.line - 1:node.end_line])
+                function_hashes[node.name] = hashlib.sha256(source.encode()).hexdigest()[:16]
+                function_words.setdefault(node.name, set())
+                if function is None:
+                    top_level.difference_update(range(node.line, node.end_line + 1))
+        source = '\n'.join(source_lines[line_number - 1] for line_number in sorted(top_level))
+        function_hashes['(top level)'] = hashlib.sha256(source.encode()).hexdigest()[:16]
+        return function_hashes, {name: frozenset((words & function_names) - {name})
+                                 for name, words in function_words.items()}
+
+    def _extract_inputs(self, nodes):
+        # {function: (literals, positional arguments)}: the values its case patterns and [[ ]], [ ] and test
+        # comparisons look for (a sample value for glob patterns), and the highest $N it uses. See explorer
+        literals = {}
+        arguments = {}
+        for node, function, _ in nodes:
+            if function is None:
+                continue
+            function_name = function.name
+            function_literals = literals.get(function_name)
+            if function_literals is None:
+                function_literals = literals[function_name] = set()
+            words = ()
+            node_type = type(node)
+            if node_type is bash_parser.Command:
+                words = node.words
+                if node.kind == '[[' or words and words[0] in ('[', 'test'):
+                    for position, word in enumerate(words[1:-1], 1):
+                        if word in _COMPARISONS:
+                            function_literals.update((_input_sample(words[position - 1]),
+                                                      _input_sample(words[position + 1])))
+            elif node_type is bash_parser.Case:
+                words = [node.word]
+                function_literals.update(_input_sample(pattern) for patterns, _ in node.arms for pattern in patterns)
+            for word in words:
+                if '$' in word:
+                    for number in _POSITIONAL_PATTERN.findall(word):
+                        arguments[function_name] = max(arguments.get(function_name, 0), int(number))
+        return {function_name: (tuple(sorted(function_literals - {None})), arguments.get(function_name, 0))
+                for function_name, function_literals in literals.items()}
+
+    def _extract_external_commands(self, nodes):
+        # Names the script runs as commands that are neither its functions nor bash builtins, in $(...) and
+        # pipes too (see BashSandbox). Names given by variables or with a path can't be known
+        function_names = {node.name for node, _, _ in nodes if type(node) is bash_parser.Function}
+        names = set()
+        for node, _, _ in nodes:
+            if type(node) is not bash_parser.Command:
+                continue
+            if node.kind == 'simple':
+                words = [word for word in node.words if '=' not in word or not _ASSIGNMENT_WORD_PATTERN.match(word)]
+                while len(words) > 1 and words[0] in _COMMAND_PREFIXES:
+                    names.add(words[0])
+                    words = words[1:]
+                if words and _COMMAND_NAME_PATTERN.match(words[0]):
+                    names.add(words[0])
+            for word in node.words:
+                if '$(' in word or '`' in word:
+                    names.update(_SUBSTITUTED_COMMAND_PATTERN.findall(word))
+        return frozenset(names - function_names - _BASH_BUILTINS - _BASH_KEYWORDS)
+
+    def _extract_branches(self, nodes, text):
+        # if/elif/else and case arms of the functions: {'function', 'kind', 'line', 'text', 'anchors' (lines of the
+        # first test), 'conditions' (lines of every test), 'span' (lines of the function), 'arms': [{'id', 'label',
+        # 'start', 'end'}], 'fallthrough' (index of the arm taken when the trace leaves the branch without entering
+        # an arm)}. An if without else and a case without *) get an implicit arm (start None). Branches whose arms
+        # share lines with their tests (one-line ifs and cases) can't be told apart in the trace, they are left out
+        branches = []
+        source_lines = text.split('\n')
+        arm_id = 0
+        for node, function, _ in nodes:
+            node_type = type(node)
+            if function is None or node_type is not bash_parser.If and node_type is not bash_parser.Case:
+                continue
+            if node_type is bash_parser.If:
+                tests = [[test_node.line for test_node, _, _ in bash_parser.walk(test)
+                          if isinstance(test_node, bash_parser.Command)] for test, _ in node.clauses]
+                anchors, conditions = tests[0], {line_number for test in tests for line_number in test}
+                bodies = [('then' if index == 0 else 'elif', body) for index, (_, body) in enumerate(node.clauses)]
+                if node.else_body is not None:
+                    bodies.append(('else', node.else_body))
+                implicit = None if node.else_body is not None else 'else'
+            else:
+                anchors, conditions = [node.line], {node.line}
+                bodies = [('|'.join(patterns), body) for patterns, body in node.arms if body]
+                implicit = None if any(pattern == '*' for patterns, _ in node.arms for pattern in patterns) else 'no match'
+            spans = [bash_parser.span_lines(body) for _, body in bodies]
+            ordered = sorted(spans)
+            if (not anchors or any(start <= line_number <= end for start, end in spans for line_number in conditions)
+                    or any(previous[1] >= following[0] for previous, following in zip(ordered, ordered[1:]))):
+                continue
+            arms = [{'id': arm_id + index, 'label': label, 'start': start, 'end': end}
+                    for index, ((label, _), (start, end)) in enumerate(zip(bodies, spans))]
+            if implicit:
+                arms.append({'id': arm_id + len(arms), 'label': implicit, 'start': None, 'end': None})
+            arm_id += len(arms)
+            branches.append({'function': function.name, 'kind': 'if' if isinstance(node, bash_parser.If) else 'case',
+                             'line': node.line, 'text': source_lines[node.line - 1].strip(), 'anchors': frozenset(anchors),
+                             'conditions': frozenset(conditions), 'span': (function.line, function.end_line),
+                             'arms': arms, 'fallthrough': len(arms) - 1 if implicit or isinstance(node, bash_parser.If) else None})
+        return branches
 
     def _extract_params(self, function_name, function_lines):
         params_line = next((line for line in function_lines if '(' in line), None)
         if params_line:
-            params = re.findall(r'\$(\w+)', params_line)
+            params = _PARAM_PATTERN.findall(params_line)
             return params
         return []
 
@@ -149,149 +1094,523 @@ class BashFunctionAnalyzer:
                 print(f"Parameters: {info['params']}")
                 print(f"Lines of Code: {info['lines_count']}\n")
 
-    def _process_output_lines(self, combined_output, lines_set, function_name):
+    def _process_output_lines(self, combined_output, lines_set, function_name, command_index=None):
+        # Single pass over the trace. Lines appended to the output below are visited by the same loop later on,
+        # they are indexed right away, in the trace position of the line they come from
         processed_output = combined_output
-        in_function = False
-        for line in combined_output:
-            #print(f"Debug: Line: {line}")
-            line_pattern = r'^\+\+? (line \d{1,}:) (.+)$'
-            line_match = re.match(line_pattern,line)
-            if not line_match:
-                continue
+        process = self._trace_processor(function_name, lines_set).process
+        if command_index is None:
+            for line in combined_output:
+                derived_lines = process(line)
+                if derived_lines:
+                    processed_output.extend(derived_lines)
+            return processed_output
+        index = command_index.add
+        trace_lines = len(combined_output)
+        for position, line in enumerate(combined_output):
+            derived_lines = process(line)
+            if position < trace_lines:
+                index(line)
+            if derived_lines:
+                for derived_line in derived_lines:
+                    index(derived_line)
+                processed_output.extend(derived_lines)
+        return processed_output
 
-            #print(f"Debug: Line to analyze: {line}")
-            # validate for function name OR variable echo
-            pattern = r"^\+ line [012]:"
-            match_command_line = re.match(pattern, line)
-            if match_command_line:
-                #print(f"Debug: Line from external command: {line}")
-                # Validate for variable value
-                var_pattern = r"^\+ line [12]: echo var_(.+)=(.+)$"
-                var_match = re.match(var_pattern, line)
-                if var_match:
-                    processed_output.append(f"+ line 0: variable {var_match.group(1)}={var_match.group(2)}")
+    def _trace_processor(self, function_name, lines_set):
+        return _TraceProcessor(function_name, lines_set, self._function_call_pattern(function_name), self._line_owners,
+                               self.code_lines.first(function_name))
 
-                # Validate for function name
-                func_pattern = r'^\+ line [12]: ' + function_name + '\\s?(.+)?$'
-                func_match = re.match(func_pattern, line)
-                if func_match:
-                    in_function = True
-                    lines_set.add((function_name,f"line 1: {function_name}"))
-            else:
-                #print(f"Debug: Regular code line: {line}")
-                inline_command_pattern = r'^\+\+ (line \d{1,}:) (.+)$'
-                inline_command_match = re.match(inline_command_pattern,line)
-                executed_command = f"{line_match.group(1)} {line_match.group(2)}"
-                command_parts = executed_command.split()
-                #print(f"Debug: {command_parts}")
-
-                if in_function:
-                    #print(f"Debug: in control structure {self._is_control_structure(executed_command)}")
-                    if not self._is_control_structure(executed_command):
-                        local_var_pattern = r"line \d{1,}: ?(local |)\'?(\S+)=(\S+);?\'?$"
-                        local_var_match = re.match(local_var_pattern, executed_command)
-                        if local_var_match:
-                            processed_output.append(f"+ line 0: variable {local_var_match.group(2)}={local_var_match.group(3)}")
-                            #print(f"Debug: added variable: {local_var_match.group(2)}={local_var_match.group(3)}")
-
-                        if inline_command_match:
-                            processed_output.append(f"+ {inline_command_match.group(1)} {inline_command_match.group(2)}")
-                            #print(f"Debug: added executed command to output: {inline_command_match.group(2)}")
-                        else:
-                            lines_set.add((function_name, f"{command_parts[0]} {command_parts[1]}"))
-                            #print(f"Debug: added executed command: {line_match.group(2)}")
-        return processed_output
+    def _function_call_pattern(self, function_name):
+        pattern = self._call_patterns.get(function_name)
+        if pattern is None:
+            pattern = re.compile(r'^\+ line [12]: ' + function_name + '\\s?(.+)?$')
+            self._call_patterns[function_name] = pattern
+        return pattern
 
-    def run_function(self, function_name, mock_variables=None, function_args=None, mock_commands=None, mock_read_values=None, show_variables=None):
+    def _prepare_run(self, function_name, mock_variables=None, function_args=None, mock_commands=None,
+                     mock_read_values=None, show_variables=None, virtual_time=None, mocks=None, profile=False,
+                     args=None, sandbox=None):
         if function_name not in self.functions_info:
             print(f"No function named '{function_name}' found.")
-            return
+            return None
+        run = _PreparedRun(function_name)
+
+        # The script bash runs with "bash -c", argv and stdin carry the rest: no /bin/sh in between and nothing
+        # to escape. function_args, mock_commands and mock_variables are bash code as they always were (written
+        # for a "..." string of /bin/sh), args are passed as they are
+        script = "PS4='+ line ${LINENO}: '; "
+        if self.trace_preamble:
+            script += f'{self.trace_preamble}; '
+        if self.tracer == 'xtrace':
+            script += 'set -x; '
+        elif profile:
+            raise ValueError("run_function(profile=True) needs tracer='xtrace'")
 
-        # Prepare the command
-        command = 'bash -c "PS4=\'+ line \\${LINENO}: \'; set -x; '
+        # A sandboxed run works in a directory of its own, the script is sourced by its absolute path
+        script_path = self.script_path
+        if sandbox:
+            run.sandbox = sandbox
+            run.sandbox_run = sandbox.prepare(self.external_commands)
+            script = sandbox.preamble() + script
+            script_path = os.path.abspath(script_path)
 
         # Source the script and call the function
-        command += f'source {self.script_path}; '
+        script += f'source {shlex.quote(script_path)}; '
+        run.script_path = script_path
+        if self.setup:
+            script += f'{self.setup}; '
+
+        # Everything after the source is shared with the persistent workers, which sourced the script already
+        call_script = ''
+
+        # The simulated clock comes first, so mock_commands can still replace any of its commands
+        if virtual_time is not None:
+            clock_file, run.clock_path = tempfile.mkstemp(prefix='unittestbash-clock-')
+            with os.fdopen(clock_file, 'w') as clock:
+                clock.write('0\n')
+            start = int(time.time() if virtual_time is True else virtual_time)
+            clock_script = _VIRTUAL_CLOCK.replace('__UBASH_CLOCK__', shlex.quote(run.clock_path))
+            call_script += clock_script.replace('__UBASH_START__', str(start)) + '; '
+
+        if profile:
+            run.profile = BashProfile()
+            call_script += PROFILE_PS4 + '; '
+
+        # BashMocks are a file sourced (out of the trace) with the directory that receives their call log
+        if mocks:
+            run.mock_directory = tempfile.mkdtemp(prefix='unittestbash-run-')
+            call_script += f'{{ source {shlex.quote(mocks.path())} {shlex.quote(run.mock_directory)}; }} 2>/dev/null; '
+            run.mocks_source = mocks.path()
 
         # Include mock commands in the same command
         if mock_commands:
             # Define each mock command as a function
             mock_statements = '; '.join(
                 [f'{cmd}() {{ {mock_cmd} {'' if mock_data=='' else f"\'{mock_data}\';"} }}' for cmd, [mock_cmd, mock_data] in mock_commands.items()])
-            command += f"{mock_statements}; "
+            call_script += f"{unescape_double_quoted(mock_statements)}; "
 
         if mock_variables:
             mock_statements = '; '.join([f'export {var}={mock_var}' for var, mock_var in mock_variables.items()])
-            command += f"{mock_statements}; "
+            call_script += f"{unescape_double_quoted(mock_statements)}; "
+
+        # The recording starts with the call, the setup above is left out like it is out of the trace
+        if self.tracer == 'debug':
+            records_file, run.records_path = tempfile.mkstemp(prefix='unittestbash-records-')
+            os.close(records_file)
+            definitions = ' '.join(f'[{self.code_lines.first(name)}]=1' for name in self.functions_info)
+            call_script += _DEBUG_RECORDER.replace('__UBASH_RECORDS__', shlex.quote(run.records_path)).replace(
+                '__UBASH_DEFINITIONS__', definitions)
 
-        command += f' {function_name}'
+        call_script += f' {function_name}'
         if function_args:
-            args = ' '.join(arg for arg in function_args)
-            command += ' ' + args
+            call_script += ' ' + unescape_double_quoted(' '.join(arg for arg in function_args))
+        if args:
+            call_script += ' "$@"'
+            run.args = [str(arg) for arg in args]
+        call_script += "; "
 
+        # The read values are the stdin of the call
         if mock_read_values:
-            command += ' <<EOF\n'
-            for read_value in mock_read_values:
-                command += f'{read_value}\n'
-            command += 'EOF'
-
-        command += "; "
+            run.stdin = ''.join(f'{read_value}\n' for read_value in mock_read_values)
 
         if show_variables:
             for variable in show_variables:
-                command += f'echo var_{variable}=\\${variable}; '
-        command += '"'
+                if self.tracer == 'debug':
+                    call_script += f'__ubash_show {variable} "${variable}"; '
+                else:
+                    call_script += f'echo var_{variable}=${variable}; '
+        run.argv = [sandbox.bash if sandbox else 'bash', '-c', script + call_script, 'bash', *run.args]
+        run.call_script = call_script
+
+        print(f"Debug: resulting command: {shlex.join(run.argv)}")
+        run.started = time.perf_counter()
+        return run
+
+    def _trace_result(self, run, stdout, stderr, returncode):
+        stderr_lines = stderr.splitlines()
+        if run.profile:
+            stderr_lines = [run.profile.feed(line) for line in stderr_lines]
+        stdout_lines = stdout.splitlines()
 
-        print(f"Debug: resulting command: {command}")
+        # Track executed lines based on Bash trace output
+        executed_lines = LineSet()
+        command_index = _CommandIndex()
+        processed_output = self._process_output_lines(stdout_lines + stderr_lines, executed_lines,
+                                                      function_name=run.function_name, command_index=command_index)
+        return BashRunResult(run.function_name, stdout, processed_output[len(stdout_lines):], returncode,
+                             executed_lines, command_index)
+
+    def _streamed_result(self, run, trace, executed_lines, stdout, returncode):
+        return BashRunResult(run.function_name, stdout, trace.finish(stdout), returncode, executed_lines,
+                             trace.command_index)
+
+    def _failed_result(self, run, error, streamed=False):
+        print(f"An error occurred while executing the function: {error}")
+        # You might want to capture output even on error
+        function_output = error.stderr.splitlines()
+        if run.profile and not streamed:
+            function_output = [run.profile.feed(line) for line in function_output]
+        return BashRunResult(run.function_name, error.stdout, function_output, error.returncode, LineSet(),
+                             _CommandIndex(function_output))
+
+    def _apply_records(self, run, result):
+        # The records take the place of the trace: the command index, the variables and the executed lines
+        result.records, variables = _read_records(run.records_path, run.script_path, run.mocks_source)
+        result.command_index = _CommandIndex()
+        for record in result.records:
+            if record.kind == 'command':
+                result.command_index.add_command(record.line, record.text,
+                                                 None if record.source == run.script_path else record.source)
+        result.trace.extend(f'+ line 0: variable {name}={value}' for name, value in variables)
+        if result.status != 0:
+            return  # Failed runs have no executed lines, as with xtrace
+        executed_lines = LineSet()
+        script_path = run.script_path
+        in_function = False
+        for record in result.records:
+            if record.kind == 'call':
+                if not in_function and record.text == run.function_name:
+                    in_function = True
+                    executed_lines.add(run.function_name, self.code_lines.first(run.function_name))
+            elif in_function and record.source == script_path:
+                owner = self._line_owners.get(record.line)
+                if owner:
+                    executed_lines.add(owner, record.line)
+        result.executed_lines = executed_lines
+
+    def _finish_run(self, run, result):
+        if run.records_path:
+            self._apply_records(run, result)
+        if run.profile:
+            result.profile = run.profile.finish()
+        result.executed_branches = result.command_index.executed_branches(self._branch_anchors)
+        result.duration = time.perf_counter() - run.started
+        if run.clock_path:
+            with open(run.clock_path, 'r') as clock:
+                result.virtual_time = int(clock.read() or 0) / 1000
+        if run.mock_directory:
+            result.mock_calls = read_mock_calls(run.mock_directory)
+        if run.sandbox_run:
+            run.sandbox.finish(run.sandbox_run)
+            result.sandbox = run.sandbox_run
+
+        # Concurrent runs only meet here: the shared state keeps the last finished run, coverage is merged
+        with self._lock:
+            self.last_result = self._results[run.function_name] = result
+            if run.profile:
+                self.profile.merge(run.profile)
+            if result.status == 0:
+                self.last_run_function = run.function_name
+            self.executed_lines |= result.executed_lines
+            self.executed_branches |= result.executed_branches
+        if self.test_index is not None:
+            self.test_index.record(self, result)
+        return result
+
+    def run_function(self, function_name, mock_variables=None, function_args=None, mock_commands=None, mock_read_values=None, show_variables=None, stream=False, virtual_time=None, mocks=None, profile=False, args=None, sandbox=None):
+        run = self._prepare_run(function_name, mock_variables, function_args, mock_commands, mock_read_values,
+                                show_variables, virtual_time, mocks, profile, args, sandbox)
+        if run is None:
+            return
+        try:
+            try:
+                if stream:
+                    # Track executed lines while the trace is produced, it never sits in memory as a whole
+                    executed_lines = LineSet()
+                    trace = _TraceStream(self._trace_processor(function_name, executed_lines), self.trace_tail,
+                                         self._branch_anchors)
+                    if run.profile:
+                        trace.rewrite = run.profile.feed
+                    stdout, returncode = self._execute_streaming(run, trace)
+                    result = self._streamed_result(run, trace, executed_lines, stdout, returncode)
+                else:
+                    result = self._trace_result(run, *self._execute(run))
+            except subprocess.CalledProcessError as e:
+                result = self._failed_result(run, e, streamed=stream)
+            return self._finish_run(run, result)
+        finally:
+            run.cleanup()
+
+    async def run_function_async(self, function_name, timeout=None, semaphore=None, stream=False, **kwargs):
+        # run_function for asyncio: bash runs as a subprocess of the event loop, in a process group of its own
+        # that is killed when the call times out (asyncio.TimeoutError) or is cancelled. semaphore bounds the
+        # number of bash processes, it can be shared by the analyzers of several scripts. Every call gets a
+        # fresh bash process, the persistent workers and batch_runs() are blocking and are not used
+        import asyncio
+        run = self._prepare_run(function_name, **kwargs)
+        if run is None:
+            return None
+        try:
+            async with semaphore or nullcontext():
+                executed_lines = LineSet()
+                trace = None
+                if stream:
+                    trace = _TraceStream(self._trace_processor(function_name, executed_lines), self.trace_tail,
+                                         self._branch_anchors)
+                    if run.profile:
+                        trace.rewrite = run.profile.feed
+                try:
+                    stdout, stderr, returncode = await asyncio.wait_for(self._execute_async(run, trace), timeout)
+                    if stream:
+                        result = self._streamed_result(run, trace, executed_lines, stdout, returncode)
+                    else:
+                        result = self._trace_result(run, stdout, stderr, returncode)
+                except subprocess.CalledProcessError as e:
+                    result = self._failed_result(run, e, streamed=stream)
+            return self._finish_run(run, result)
+        finally:
+            run.cleanup()
+
+    async def run_functions_async(self, calls, max_concurrency=None):
+        # run_functions for asyncio, each item holds the run_function_async keyword arguments (function_name
+        # included). At most max_concurrency bash processes run at once
+        import asyncio
+        semaphore = asyncio.Semaphore(max_concurrency or os.cpu_count())
+        return await asyncio.gather(*(self.run_function_async(semaphore=semaphore, **call) for call in calls))
+
+    def run_batch(self, function_name, cases):
+        # Run the function once per case (run_function keyword arguments) in a single bash process, the results
+        # come back in order, failed cases included
+        with batch_runs():
+            return [self.run_function(function_name, **case) for case in cases]
+
+    def run_functions(self, calls, max_workers=None):
+        # Run many calls at once, each item holds the run_function keyword arguments (function_name included).
+        # Bash does the work, so threads are enough to keep every core busy
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+            return list(executor.map(lambda call: self.run_function(**call), calls))
+
+    def merge_coverage(self, other):
+        # Accepts another analyzer (e.g. from a CI shard), a run result or a LineSet of executed lines
+        executed_lines = getattr(other, 'executed_lines', other)
+        with self._lock:
+            self.executed_lines |= executed_lines
+            self.executed_branches |= getattr(other, 'executed_branches', set())
+
+    def _active_worker_pool(self, run):
+        # The persistent workers, or the bash process of the enclosing batch_runs() block. Sandboxed runs need
+        # a bash process of their own, started in the sandbox
+        if run.sandbox:
+            return None
+        if self.worker_pool:
+            return self.worker_pool
+        pools = getattr(_BATCH, 'pools', None)
+        if pools is None:
+            return None
+        pool = pools.get(self)
+        if pool is None:
+            pool = pools[self] = BashWorkerPool(self.script_path, preamble=self.trace_preamble, setup=self.setup)
+        return pool
+
+    def _sandbox_options(self, run):
+        if not run.sandbox_run:
+            return {}
+        return {'env': run.sandbox_run.environment, 'cwd': os.path.join(run.sandbox_run.directory, 'work')}
+
+    def _worker_job(self, run):
+        # A worker job has no argv or stdin of its own, they are set up first, out of the trace
+        job = 'set -x; ' if self.tracer == 'xtrace' else ''
+        if run.args or run.stdin is not None:
+            setup = [f'set -- {shlex.join(run.args)}'] if run.args else []
+            if run.stdin is not None:
+                setup.append(f'exec 0<<<{shlex.quote(run.stdin[:-1])}')  # <<< adds the last newline back
+            job += f'{{ {"; ".join(setup)}; }} 2>/dev/null; '
+        return job + run.call_script
+
+    def _execute(self, run):
+        worker_pool = self._active_worker_pool(run)
+        if not worker_pool:
+            result = subprocess.run(run.argv, text=True, capture_output=True, check=True, input=run.stdin,
+                                    stdin=subprocess.DEVNULL if run.stdin is None else None, **self._sandbox_options(run))
+            return result.stdout, result.stderr, result.returncode
+
+        with worker_pool.acquire() as worker:
+            returncode, stdout, stderr = worker.run(self._worker_job(run))
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, run.argv, output=stdout, stderr=stderr)
+        return stdout, stderr, returncode
+
+    def _execute_streaming(self, run, trace):
+        worker_pool = self._active_worker_pool(run)
+        if worker_pool:
+            with worker_pool.acquire() as worker:
+                returncode, stdout = worker.run_streaming(self._worker_job(run), trace.feed)
+        else:
+            with subprocess.Popen(run.argv, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                  stdin=subprocess.DEVNULL if run.stdin is None else subprocess.PIPE,
+                                  **self._sandbox_options(run)) as process:
+                if run.stdin is not None:
+                    process.stdin.write(run.stdin)
+                    process.stdin.close()
+                # stdout is read aside so a full pipe never blocks bash while the trace is consumed here
+                stdout_chunks = []
+                reader = threading.Thread(target=lambda: stdout_chunks.append(process.stdout.read()))
+                reader.start()
+                for line in process.stderr:
+                    trace.feed(line.rstrip('\n'))
+                reader.join()
+                returncode = process.wait()
+            stdout = stdout_chunks[0]
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, run.argv, output=stdout, stderr='\n'.join(trace.tail))
+        return stdout, returncode
+
+    async def _execute_async(self, run, trace=None):
+        import asyncio
+        stdin = None if run.stdin is None else run.stdin.encode()
+        process = await asyncio.create_subprocess_exec(*run.argv, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE, start_new_session=True,
+                                                       stdin=asyncio.subprocess.DEVNULL if stdin is None else asyncio.subprocess.PIPE,
+                                                       limit=_ASYNC_LINE_LIMIT, **self._sandbox_options(run))
         try:
-            result = subprocess.run(command, shell=True, text=True, capture_output=True, check=True)
-            combined_output = result.stdout.splitlines() + result.stderr.splitlines()
-            self.function_output[function_name] = combined_output
-            self.output = combined_output  # Capture standard output
-            self.status = result.returncode
-            self.last_run_function = function_name
-
-            # Track executed lines based on Bash trace output
-            processed_output = self._process_output_lines(combined_output, self.executed_lines, function_name=function_name)
-
-        except subprocess.CalledProcessError as e:
-            print(f"An error occurred while executing the function: {e}")
-            self.function_output[function_name] = e.stderr.splitlines()
-            self.output = e.stdout.strip()  # You might want to capture output even on error
-            self.status = e.returncode
+            if trace is None:
+                stdout, stderr = await process.communicate(stdin)
+                stdout, stderr = stdout.decode(errors='replace'), stderr.decode(errors='replace')
+            else:
+                if stdin is not None:
+                    process.stdin.write(stdin)
+                    await process.stdin.drain()
+                    process.stdin.close()
+                stdout_task = asyncio.ensure_future(process.stdout.read())
+                async for line in process.stderr:
+                    trace.feed(line.decode(errors='replace').rstrip('\n'))
+                stdout, stderr = (await stdout_task).decode(errors='replace'), '\n'.join(trace.tail)
+            returncode = await process.wait()
+        except BaseException:
+            # Timed out or cancelled: the function may have started commands of its own, they all go
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await process.wait()
+            raise
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, run.argv, output=stdout, stderr=stderr)
+        return stdout, stderr, returncode
+
+    def close(self):
+        # Stop the persistent bash workers, if any were started
+        if self.worker_pool:
+            self.worker_pool.close()
+
+    # The last run, for the assertions that don't get a result
+    @property
+    def output(self):
+        return self.last_result.output if self.last_result else []
+
+    @property
+    def status(self):
+        return self.last_result.status if self.last_result else 0
+
+    @property
+    def virtual_time(self):
+        return self.last_result.virtual_time if self.last_result else None
+
+    @property
+    def mock_calls(self):
+        return self.last_result.mock_calls if self.last_result else []
 
     def get_function_output(self, function_name):
-        return self.function_output.get(function_name, [])
+        # Output of the last run of the function, while its result is referenced (the last run always is)
+        result = self._results.get(function_name)
+        return result.output if result else []
+
+    def _run_output(self, result=None):
+        # Assertions check the given run result, or the last run when there is none
+        result = result or self.last_result
+        return result.output if result else []
+
+    def _command_index(self, result=None):
+        # Assertions check the given run result, or the last run when there is none
+        result = result or self.last_result
+        return result.command_index if result else _CommandIndex()
+
+    def _count_command(self, command, result=None):
+        return self._command_index(result).count(command)
 
-    def assert_run_once(self, command):
+    def get_calls(self, command, result=None):
+        # (line number, traced command) of every call starting with command
+        return self._command_index(result).calls(command)
+
+    def assert_run_once(self, command, result=None):
         # Count occurrences of the command in the output with a '+' prefix
-        output = self.get_function_output(self.last_run_function)  # Assuming analysis on the last function run
-        command_pattern = fr'^\+ line \d+: {re.escape(command)}'
-        count = sum(1 for line in output if re.match(command_pattern, line))
+        count = self._count_command(command, result)
 
         assert count == 1, f"Expected '{command}' to run exactly once, but found {count} times."
 
-    def assert_run(self, command):
+    def assert_run(self, command, result=None):
         # Count occurrences of the command in the output with a '+' prefix
-        output = self.get_function_output(self.last_run_function)  # Assuming analysis on the first function run
-        command_pattern = fr'^\+ line \d+: {re.escape(command)}'
-        count = sum(1 for line in output if re.match(command_pattern, line))
+        count = self._count_command(command, result)
 
         assert count >= 1, f"Expected '{command}' to run at least once, but not found."
 
-    def assert_call_number(self, command, number):
+    def assert_call_number(self, command, number, result=None):
         # Count occurrences of the command in the output with a '+' prefix
-        output = self.get_function_output(self.last_run_function)  # Assuming analysis on the first function run
-        command_pattern = fr'^\+ line \d+: {re.escape(command)}'
-        count = sum(1 for line in output if re.match(command_pattern, line))
+        count = self._count_command(command, result)
 
         assert count == number, f"Expected '{command}' to run exactly {number} times, but found {count} times."
 
+    def assert_called_before(self, first_command, second_command, result=None):
+        command_index = self._command_index(result)
+        first_position = command_index.first(first_command)
+        second_position = command_index.first(second_command)
+        assert first_position is not None, f"Expected '{first_command}' to run, but not found."
+        assert second_position is not None, f"Expected '{second_command}' to run, but not found."
+        assert first_position < second_position, \
+            f"Expected '{first_command}' to run before '{second_command}', but it ran after it."
+
+    def assert_called_with(self, command, *args, result=None):
+        calls = self._command_index(result).calls_with(command, args)
+        assert calls, f"Expected '{command}' to be called with {list(args)}, but not found."
+
+    def get_function_calls(self, function_name, result=None):
+        # Arguments of every call of a function of the script, as the function got them. Needs tracer='debug',
+        # the trace only has the calls as xtrace quoted them
+        result = result or self.last_result
+        return [record.args for record in (result.records if result else ())
+                if record.kind == 'call' and record.text == function_name and record.args is not None]
+
+    def assert_function_called_with(self, function_name, *args, result=None):
+        assert list(args) in self.get_function_calls(function_name, result), \
+            f"Expected function '{function_name}' to be called with {list(args)}, but not found."
+
+    def get_mock_calls(self, name, result=None):
+        # Arguments of every call of a BashMocks command, read from the call log instead of the trace
+        mock_calls = result.mock_calls if result else self.mock_calls
+        return [args for call_name, args in mock_calls if call_name == name]
+
+    def assert_mock_call_number(self, name, number, result=None):
+        count = len(self.get_mock_calls(name, result))
+        assert count == number, f"Expected mock '{name}' to be called exactly {number} times, but found {count} times."
+
+    def assert_mock_called_with(self, name, *args, result=None):
+        assert list(args) in self.get_mock_calls(name, result), \
+            f"Expected mock '{name}' to be called with {list(args)}, but not found."
+
+    def get_line_coverage(self, extra_executed_lines=()):
+        # {function: (code line numbers, executed code line numbers)}, both sorted. extra_executed_lines are
+        # line numbers executed elsewhere (e.g. while sourced by another script)
+        extra_executed_lines = LineSet((self._line_owners[line_number], line_number)
+                                       for line_number in extra_executed_lines if line_number in self._line_owners)
+        executed_lines = self.executed_lines | extra_executed_lines
+        return {func: (self.code_lines.lines(func), executed_lines.lines(func)) for func in self.code_lines.functions()}
+
+    def export_coverage(self, path, format=None):
+        # See coverage_export.write_coverage for the formats
+        from .coverage_export import write_coverage
+        write_coverage({self.script_path: self.get_line_coverage()}, path, format)
+
+    def show_profile(self, top=20):
+        # Hottest lines and functions of the run_function(profile=True) calls so far
+        self.profile.show(top)
+
     def get_coverage(self, function_name=None):
         total_lines = 0
         covered_lines = 0
         if function_name:
-            covered_lines = sum(1 for func, _ in self.executed_lines if func == function_name)
+            covered_lines = self.executed_lines.count(function_name)
             info = self.functions_info.get(function_name)
             if info:
                 total_lines = info["lines_count"]
@@ -307,31 +1626,54 @@ class BashFunctionAnalyzer:
         coverage = (covered_lines / total_lines) * 100
         return coverage
 
+    def _function_branches(self, function_name=None):
+        return [branch for branch in self.branches if function_name is None or branch['function'] == function_name]
+
+    def get_branch_coverage(self, function_name=None):
+        # Percentage of the if/case arms taken, 100 for code without branches
+        arms = [arm['id'] for branch in self._function_branches(function_name) for arm in branch['arms']]
+        if not arms:
+            return 100.0
+        return (sum(1 for arm_id in arms if arm_id in self.executed_branches) / len(arms)) * 100
+
+    def show_branches(self, function_name=None):
+        branches = self._function_branches(function_name)
+        if not branches:
+            print(f"No branches found for function '{function_name}'." if function_name else "No branches found.")
+        for branch in branches:
+            print(f"Function '{branch['function']}': Line {branch['line']}: {branch['text']}")
+            for arm in branch['arms']:
+                location = f"lines {arm['start']}-{arm['end']}" if arm['start'] is not None else "implicit"
+                taken = "taken" if arm['id'] in self.executed_branches else "not taken"
+                print(f" - {arm['label']} ({location}): {taken}")
+
     def assertEqual(self, param1, param2):
         if param1 != param2:
             raise AssertionError(f"Assertion failed: {param1} is not equal to {param2}")
 
-    def assertOutputMatchesRegex(self, regex_pattern):
-        for output_line in self.output:
+    def assertOutputMatchesRegex(self, regex_pattern, result=None):
+        for output_line in (result.output if result else self.output):
             #print(f"Debug: {output_line}")
             if re.match(regex_pattern, output_line):
                 return 0
         raise AssertionError(f"No line in output matches pattern: {regex_pattern}.")
 
-    def assertOutputDoesNotMatchRegex(self, regex_pattern):
-        if re.match(regex_pattern, self.output):
-            raise AssertionError(f"Output matches pattern: {regex_pattern}. Output was: {self.output}")
+    def assertOutputDoesNotMatchRegex(self, regex_pattern, result=None):
+        for output_line in (result.output if result else self.output):
+            if re.match(regex_pattern, output_line):
+                raise AssertionError(f"Output matches pattern: {regex_pattern}. Output line was: {output_line}")
 
-    def assertStatusOK(self):
-        if self.status != 0:
-            raise AssertionError(f"Assertion failed: status is {self.status}")
+    def assertStatusOK(self, result=None):
+        status = result.status if result else self.status
+        if status != 0:
+            raise AssertionError(f"Assertion failed: status is {status}")
 
-    def assertStatusNOK(self):
-        if self.status == 0:
+    def assertStatusNOK(self, result=None):
+        if (result.status if result else self.status) == 0:
             raise AssertionError(f"Assertion failed: status is OK, expected NOK")
 
-    def _get_local_variable(self, var_name):
-        output = self.get_function_output(self.last_run_function)
+    def _get_local_variable(self, var_name, result=None):
+        output = self._run_output(result)
         var_reg = r'^\+ line 0: variable ' + var_name + '=(.+)$'
         variable_value = None
         for line in output:
@@ -342,20 +1684,21 @@ class BashFunctionAnalyzer:
                 variable_value = var_match.group(1)
         return variable_value
 
-    def get_variable_value(self, var_name):
+    def get_variable_value(self, var_name, result=None):
         variable_value = self.global_variables.get(var_name)
         if variable_value:
             return variable_value
         else:
             #print(f"Debug: local variable check {var_name}")
-            variable_value = self._get_local_variable(var_name)
+            variable_value = self._get_local_variable(var_name, result)
             if variable_value:
                 return variable_value
 
         print(f"No variable '{var_name}' found")
 
     def _get_executed_lines(self, function_name):
-        return [line for func, line in self.executed_lines if func == function_name]
+        return [f"Line {line_number}: {self.code_line_texts[line_number]}"
+                for line_number in self.executed_lines.lines(function_name)]
 
     def show_executed_lines(self, function_name=None):
         if function_name:
@@ -369,14 +1712,15 @@ class BashFunctionAnalyzer:
                 print(f"No executed lines found for function '{function_name}'.")
         else:
             print("Executed lines for all functions:")
-            for func, executed_line in self.executed_lines:
-                print(f"Function '{func}': {executed_line}")
+            for func, line_number in self.executed_lines:
+                print(f"Function '{func}': Line {line_number}: {self.code_line_texts[line_number]}")
 
     def show_code_lines(self, function_name=None):
         if function_name:
             print(f"Code lines for function '{function_name}':")
             # Filter the executed lines by the specified function name
-            found_lines = [line for func, line in self.code_lines if func == function_name]
+            found_lines = [f"Line {line_number}: {self.code_line_texts[line_number]}"
+                           for line_number in self.code_lines.lines(function_name)]
             if found_lines:
                 for code_line in found_lines:
                     print(f" - {code_line}")
@@ -384,6 +1728,6 @@ class BashFunctionAnalyzer:
                 print(f"No code lines found for function '{function_name}'.")
         else:
             print("Code lines for all functions:")
-            for func, code_line in self.code_lines:
-                print(f"Function '{func}': {code_line}")
+            for func, line_number in self.code_lines:
+                print(f"Function '{func}': Line {line_number}: {self.code_line_texts[line_number]}")
 